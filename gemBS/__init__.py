@@ -5,22 +5,26 @@ ability to perform the different steps involved in the Bisulphite Pipeline"""
 import os
 import re
 import sys
+import time
 import logging
 import subprocess
-import pkg_resources
 import threading as th
 import tempfile
+import collections
+import heapq
 import csv
 import shutil
 import sqlite3
 import json
 import gzip
-import pkg_resources
+import zlib
+import struct
+import hashlib
+import gc
+import shlex
 import glob
-import distutils
-import distutils.util
 
-from .utils import run_tools, CommandException, try_get_exclusive
+from .utils import run_tools, run_supervised, ProcessError, CommandException, contigRegion, fileDigest, packageResource, strtobool, readCacheFile, writeCacheFile
 from .parser import gembsConfigParse
 from .database import *
 
@@ -33,8 +37,26 @@ class execs_dict(dict):
     the path to the bundled executable is returned.
     If nothing is found, the plain executable name is returned and we
     assume it can be found in PATH
+
+    The resolved paths are cached, and the cache is cleared if either
+    GEM_BS_PATH or PATH is changed.
     """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.cache = {}
+        self.cache_key = None
+
     def __getitem__(self, item):
+        key = (os.getenv("GEM_BS_PATH"), os.getenv("PATH"))
+        if key != self.cache_key:
+            self.cache = {}
+            self.cache_key = key
+        cache = self.cache
+        if not item in cache:
+            cache[item] = self.resolve(item)
+        return cache[item]
+
+    def resolve(self, item):
         # check if there is an environment variable set
         # to specify the path to the GEM executables
         
@@ -45,15 +67,11 @@ class execs_dict(dict):
                 logging.debug("Using binary from GEM_BS_PATH : %s" % file)
                 return file
 
-        if pkg_resources.resource_exists("gemBS", os.path.join('gemBSbinaries', item)):
-            f = pkg_resources.resource_filename("gemBS", os.path.join('gemBSbinaries', item))
-            logging.debug("Using bundled binary : %s" % f)
-            return f
-            
-        if pkg_resources.resource_exists("gemBS", os.path.join('bin', item)):
-            f = pkg_resources.resource_filename("gemBS", os.path.join('bin',item))
-            logging.debug("Using bundled binary : %s" % f)
-            return f
+        for bdir in ('gemBSbinaries', 'bin'):
+            f = packageResource(os.path.join(bdir, item))
+            if f != None:
+                logging.debug("Using bundled binary : %s" % f)
+                return f
         
         # try to find from static distribution
         if len(sys.argv) > 0:
@@ -98,7 +116,20 @@ executables = execs_dict({
     "tabix": "tabix",
     })
 
+def binaryVersion(binary):
+    """First line of the output of binary --version, or None if the version could not be obtained"""
+    try:
+        p = subprocess.run([binary, '--version'], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    if p.returncode == 0:
+        for line in p.stdout.decode('utf-8', 'replace').splitlines():
+            if line.strip():
+                return line.strip()
+    return None
+
 class Fli:
+    __slots__ = ('fli', 'alt_fli', 'sample_name', 'sample_barcode', 'description', 'library', 'type', 'file', 'centre', 'platform', 'bisulfite')
     
     def __init__(self):
         #fli Members
@@ -120,18 +151,68 @@ class Fli:
 
 class JSONdata:
     #Class to manage the flowcell lane index information of the project
+
+    # The processed data from a JSON file is cached in <json_file>.cache.  The cache is used if the modification
+    # time and size of the JSON file are unchanged, or otherwise if the hash of its contents is unchanged.
+    # The unprocessed JSON data (jsconfig) is not cached, and is read from the JSON file when needed
+    cache_version = 3
+    cache_members = ('sampleData', 'samples', 'sample_names', 'config', 'contigs', 'pools')
+    
     def __init__(self, json_file = None, jdict = None):
         self.json_file = json_file
+        self._jsconfig = None
         self.sampleData = {}
+        # Datasets for each sample barcode, and sample barcode for each sample name
+        self.samples = {}
+        self.sample_names = {}
         self.config = {}
         self.contigs = {}
         self.pools = {}
         if json_file != None:
-            with open(self.json_file, 'r') as fileJson:
-                self.JSONprocess(json.load(fileJson))
+            # Garbage collection is suspended while the many small objects for the datasets are made
+            gc_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                self.load(json_file)
+            finally:
+                if gc_enabled:
+                    gc.enable()
         elif jdict != None:
             self.JSONprocess(jdict)
 
+    @property
+    def jsconfig(self):
+        if self._jsconfig == None:
+            with open(self.json_file, 'r') as fileJson:
+                self._jsconfig = json.load(fileJson)
+        return self._jsconfig
+
+    @jsconfig.setter
+    def jsconfig(self, jsconfig):
+        self._jsconfig = jsconfig
+
+    def load(self, json_file):
+        cache_file = json_file + '.cache'
+        st = os.stat(json_file)
+        stat = (st.st_mtime_ns, st.st_size)
+        cache = readCacheFile(cache_file, JSONdata.cache_version)
+        # As with the git index, the modification time is not trusted if the JSON file could have been changed 
+        # again within the timestamp resolution after the cache was made
+        if cache != None and cache['stat'] == stat and st.st_mtime < cache['time'] - 2:
+            self.__dict__.update(cache['data'])
+            return
+        with open(json_file, 'rb') as fileJson:
+            jstring = fileJson.read()
+        digest = hashlib.sha1(jstring).hexdigest()
+        if cache != None and cache['digest'] == digest:
+            self.__dict__.update(cache['data'])
+        else:
+            self.JSONprocess(json.loads(jstring))
+        # Save the data now, before it is changed by check() etc.
+        cache = {'stat': stat, 'digest': digest, 'time': time.time(),
+                 'data': {x: getattr(self, x) for x in JSONdata.cache_members}}
+        writeCacheFile(cache_file, JSONdata.cache_version, cache, level = logging.DEBUG)
+
     def JSONprocess(self, jsconfig):
         self.jsconfig = jsconfig
         try:
@@ -153,7 +234,7 @@ class JSONdata:
             self.contigs[p] = []
             for ctg in v:
                 self.contigs[p].append(ctg)
-                self.pools[ctg]=p
+                self.pools[contigRegion(ctg)[0]]=p
                 
         data=jsconfig['sampleData']
         for fli in data:
@@ -181,7 +262,13 @@ class JSONdata:
                 elif key == "bisulfite":
                     fliCommands.bisulfite = json.loads(str(value).lower())
 
-                self.sampleData[fli] = fliCommands
+            self.sampleData[fli] = fliCommands
+            bc = fliCommands.sample_barcode
+            if not bc in self.samples:
+                self.samples[bc] = [fli]
+            else:
+                self.samples[bc].append(fli)
+            self.sample_names.setdefault(fliCommands.sample_name, bc)
 
     def check(self, section, key, arg=None, default=None, boolean=False, dir_type=False, list_type=False, int_type = False):
         if not section in self.config:
@@ -375,7 +462,7 @@ def prepareConfiguration(text_metadata=None,lims_cnag_json=None,configFile=None,
                             elif head == "file2":
                                 file2 = field
                             elif head == "bisulfite":
-                                sampleDirectory[head] = bool(distutils.util.strtobool(field.lower()))
+                                sampleDirectory[head] = strtobool(field)
                                 if not sampleDirectory[head]:
                                     nonbs_flag = True;
                             elif head == "type":
@@ -707,11 +794,63 @@ def makeChromSizes(index_name=None,output=None, omit=[]):
     else:
         raise ValueError("Info file {} (normally generated by gem-indexer) does not exist".format(info_file))        
 
+def scanInputDir(input_dir, fids):
+    """Match a set of dataset ids against the sequence files in input_dir in a single pass over the directory.
+
+    Returns a dictionary with the list of files (in directory order) containing each dataset id.  Rather than
+    matching every id against every file, each substring of a file name with the length of one of the ids is
+    looked up in the set of ids, so the cost depends on the number of files and not on the number of datasets.
+    """
+    found = {fid: [] for fid in fids}
+    lengths = set(len(fid) for fid in fids)
+    reg = re.compile("[.](fastq|fq|fasta|fa|bam|sam)([.][^.]+)?$")
+    for file in os.listdir(input_dir):
+        if not reg.search(file):
+            continue
+        hits = set()
+        for l in lengths:
+            for ix in range(len(file) - l + 1):
+                s = file[ix:ix + l]
+                if s in found:
+                    hits.add(s)
+        for fid in hits:
+            found[fid].append(file)
+    return found
+
+def chunkFilter(inputFiles, ftype, paired, chunk, threads):
+    """Shell command that writes one chunk of the input reads to stdout as FASTQ (interleaved for paired data).
+
+    chunk is (ix, n): the reads (or read pairs) are dealt round robin between the n chunks, and chunk ix (from 0)
+    gets every n-th read starting from read ix.  This gives chunks of the same size without the number of reads 
+    being known in advance, and the input files only have to be read (not mapped) once per chunk.
+    """
+    if ftype in ['STREAM', 'SINGLE_STREAM', 'PAIRED_STREAM', 'COMMAND', 'SINGLE_COMMAND', 'PAIRED_COMMAND']:
+        raise CommandException("Datasets of type {} can not be split into chunks".format(ftype))
+    def reader(fname):
+        if ftype in ['SAM', 'BAM']:
+            return "{} bam2fq --threads {} {}".format(executables['samtools'], threads, shlex.quote(fname))
+        if fname.endswith('|'):
+            return fname[:-1]
+        dcomp = {'.bz2': 'bzip2', '.xz': 'xz'}.get(os.path.splitext(fname)[1], 'gzip -f')
+        return "{} -dc {}".format(dcomp, shlex.quote(fname))
+    lines = 2 if re.search(r'[.](fasta|fa)([.][^.]+)?$', inputFiles[0], re.I) else 4
+    ix, n = chunk
+    if len(inputFiles) == 2:
+        # The second file is read in step with the first by awk, and the pair of records is output when selected.
+        # Files of different lengths or a failure reading the second file make the filter fail
+        select = ("{{ if ((c | getline m) <= 0) {{ err = 1; exit }} b1[(NR - 1) % {0}] = $0; b2[(NR - 1) % {0}] = m }} "
+                  "NR % {0} == 0 && (NR / {0} - 1) % {1} == {2} {{ for (k = 0; k < {0}; k++) print b1[k]; for (k = 0; k < {0}; k++) print b2[k] }} "
+                  "END {{ if (!err && (c | getline m) > 0) err = 1; if (close(c)) err = 1; exit err }}").format(lines, n, ix)
+        return "set -o pipefail; {} | awk -v c={} '{}'".format(reader(inputFiles[0]), shlex.quote(reader(inputFiles[1])), select)
+    if paired:
+        lines *= 2
+    return "set -o pipefail; {} | awk 'int((NR - 1) / {}) % {} == {}'".format(reader(inputFiles[0]), lines, n, ix)
+
 def mapping(name=None,index=None,fliInfo=None,inputFiles=None,ftype=None,filetype=None,
              read_non_stranded=False,reverse_conv=False,outfile=None,
              paired=False,tmpDir="/tmp",map_threads=None,sort_threads=None,
              sort_memory=None,under_conversion=None, over_conversion=None,
-            benchmark_mode=False, contig_md5=None, greference=None):
+            benchmark_mode=False, contig_md5=None, greference=None, spill=False, chunk=None):
     """ Start the GEM Bisulfite mapping on the given input.
     
     name -- Name basic (FLI) for the input and output fastq files
@@ -732,6 +871,8 @@ def mapping(name=None,index=None,fliInfo=None,inputFiles=None,ftype=None,filetyp
     over_conversion -- Over conversion sequence
     benchmark_mode -- Remove times etc. from output files to simplify file comparisons
     contig_md5 -- File with md5 sums for all contigs
+    spill -- For datasets that will be merged: write the BAM only for the merge (fast compression, BAM format)
+    chunk -- (ix, n) to map only chunk ix of n of the input reads
     """        
     ## prepare the input
     input_pipe = []  
@@ -742,7 +883,9 @@ def mapping(name=None,index=None,fliInfo=None,inputFiles=None,ftype=None,filetyp
     if not os.path.exists(outputDir):
         os.makedirs(outputDir)
 
-    if len(inputFiles) == 2:
+    if chunk != None:
+        input_pipe.extend(['/bin/bash', '-c', chunkFilter(inputFiles, ftype, paired, chunk, map_threads)])
+    elif len(inputFiles) == 2:
         mapping.extend(["--i1",inputFiles[0],"--i2",inputFiles[1]])
     elif len(inputFiles) == 1:
         if ftype in ['SAM', 'BAM']:
@@ -793,12 +936,19 @@ def mapping(name=None,index=None,fliInfo=None,inputFiles=None,ftype=None,filetyp
     readNameClean = [executables['readNameClean'], contig_md5]
          
     #BAM SORT
-    bamSort = [executables['samtools'],"sort","-T",os.path.join(tmpDir,name),"-m",sort_memory,"-o",outfile]
+    # For a single BAM this is the final output, so the BAM is streamed through run_tools to calculate the md5 digest as it 
+    # is written (the index location is given explicitly as samtools can not derive it from the output name)
+    bamSort = [executables['samtools'],"sort","-T",os.path.join(tmpDir,name),"-m",sort_memory]
     if filetype == 'SINGLE_BAM':
-        bamSort.append("--write-index")
+        bamSort.extend(["-o", "-##idx##" + bamIndexFile(outfile), "--write-index"])
+    else:
+        bamSort.extend(["-o", outfile])
     if benchmark_mode:
         bamSort.append("--no-PG")
-    if outfile.endswith('.cram'):
+    if spill and filetype != 'SINGLE_BAM':
+        # The merge reads the spill file whatever its name, and does the final compression / CRAM encoding
+        bamSort.extend(['-O', 'BAM', '-l', '1', "-@", sort_threads]);
+    elif outfile.endswith('.cram'):
         bamSort.extend(['-O', 'CRAM', "-@", sort_threads]);
         if not benchmark_mode:
             bamSort.extend(['--reference', greference]);
@@ -810,12 +960,19 @@ def mapping(name=None,index=None,fliInfo=None,inputFiles=None,ftype=None,filetyp
     tools = [mapping,readNameClean,bamSort]
     
     if input_pipe: tools.insert(0, input_pipe)
-    process = run_tools(tools, name="bisulfite-mapping", logfile=logfile)
+    if filetype == 'SINGLE_BAM':
+        process = run_tools(tools, name="bisulfite-mapping", logfile=logfile, output=outfile, digest=outfile + '.md5')
+    else:
+        process = run_tools(tools, name="bisulfite-mapping", logfile=logfile)
     if process.wait() != 0:
         raise ValueError("Error while executing the Bisulfite bisulphite-mapping")
 
     return os.path.abspath("%s" % outfile)
 
+def bamIndexFile(bam_file):
+    """Index file written by samtools for a BAM or CRAM file"""
+    return bam_file + ('.crai' if bam_file.endswith('.cram') else '.csi')
+
 def merging(inputs=None,sample=None,threads="1",outname=None,tmpDir="/tmp/",benchmark_mode=False, greference=None):
     """ Merge bam alignment files 
     
@@ -830,10 +987,7 @@ def merging(inputs=None,sample=None,threads="1",outname=None,tmpDir="/tmp/",benc
     output = os.path.dirname(outname)
         
     bam_filename = outname
-    if outname.endswith('.cram'):
-        index_filename = outname[:-4] + 'crai'
-    else:
-        index_filename = outname[:-3] + 'csi'
+    index_filename = bamIndexFile(outname)
     md5_filename = outname + '.md5'
     
     bammerging = []       
@@ -843,7 +997,8 @@ def merging(inputs=None,sample=None,threads="1",outname=None,tmpDir="/tmp/",benc
 
     return_info = []
     if inputs:
-        bammerging.extend([executables['samtools'],"merge","--write-index"])
+        # The chunks of a dataset share its read group, so read groups with the same ID are combined
+        bammerging.extend([executables['samtools'],"merge","-c","--write-index"])
         if benchmark_mode:
             bammerging.append("--no-PG")
         if bam_filename.endswith('.cram'):
@@ -853,28 +1008,61 @@ def merging(inputs=None,sample=None,threads="1",outname=None,tmpDir="/tmp/",benc
         else:
             bammerging.extend(['--threads', threads]);
             
-        bammerging.extend(["-f",bam_filename])
+        # The merged BAM is written to stdout so that the md5 digest is calculated as it is written.  samtools merge 
+        # takes the output as a positional argument, so this is given as /dev/stdout rather than '-' (which would 
+        # be read as an option once the index location is added)
+        bammerging.extend(["-f","/dev/stdout##idx##" + index_filename])
         for bamFile in inputs:
             bammerging.append(bamFile)
         logfile = os.path.join(output,"bam_merge_{}.err".format(sample))
-        process = run_tools([bammerging], name="bisulphite-merging",output=bam_filename,logfile=logfile)
+        process = run_tools([bammerging], name="bisulphite-merging",output=bam_filename,logfile=logfile,digest=md5_filename)
         if process.wait() != 0: raise ValueError("Error while merging.")
         return_info.append(os.path.abspath(bam_filename))
-    
-    md5sum = ['md5sum',bam_filename]
-    processMD5 = run_tools([md5sum],name="BAM MD5",output=md5_filename)
-    if processMD5.wait() != 0:
-        raise ValueError("Error while calculating md5sum of BAM file.")
+    elif not os.path.exists(md5_filename):
+        # Single BAMs get their md5 file when they are made; this is for BAMs made by older versions
+        fileDigest(bam_filename, md5_filename)
 
     return_info.append(os.path.abspath(index_filename))
     
     return return_info 
 
+def contigReadCounts(bam_files):
+    """Returns the number of mapped reads per contig summed over a list of indexed BAM files (from samtools idxstats)"""
+    counts = {}
+    for bam in bam_files:
+        process = run_tools([[executables['samtools'],'idxstats',bam]], name='samtools idxstats', output = subprocess.PIPE)
+        p = process.processes[-1].process
+        for line in p.stdout:
+            fd = line.decode('UTF-8').split()
+            if len(fd) > 2 and fd[0] != '*':
+                counts[fd[0]] = counts.get(fd[0], 0) + int(fd[2])
+        if process.wait() != 0:
+            raise ValueError("Error while reading index statistics from {}".format(bam))
+    return counts
+
+def readContigSizes():
+    """Returns the contig sizes file and a dictionary of contig sizes"""
+    db = database()
+    c = db.cursor()
+    c.execute("SELECT * FROM indexing WHERE type = 'contig_sizes'")
+    ret = c.fetchone()
+    db.close()
+    if not ret or ret[2] != 1:
+        raise CommandException("Could not open contig sizes file.")
+    csizes = ret[0]
+    contig_size = {}
+    with open (csizes, "r") as f:
+        for line in f:
+            fd = line.split()
+            if(len(fd) > 1):
+                contig_size[fd[0]] = int(fd[1])
+    return csizes, contig_size
+
 class BsCaller:
     def __init__(self,reference,species,right_trim=0,left_trim=5,keep_unmatched=False,
                  keep_duplicates=False,ignore_duplicates=False,contig_size=None,csizes=None,dbSNP_index_file="",
                  call_threads="1",merge_threads="1",mapq_threshold=None,bq_threshold=None,
-                 haploid=False,conversion=None,ref_bias=None,sample_conversion=None,benchmark_mode=False):
+                 haploid=False,conversion=None,ref_bias=None,sample_conversion=None,benchmark_mode=False,call_memory=None,call_timeout=None):
         self.reference = reference
         self.species = species
         self.right_trim = right_trim
@@ -894,12 +1082,39 @@ class BsCaller:
         self.contig_size = contig_size
         self.csizes = csizes
         self.benchmark_mode = benchmark_mode
+        self.call_memory = call_memory
+        self.call_timeout = call_timeout
+
+    def footprint(self, chrom_list):
+        """Threads and memory (bytes) used by bs_call for a contig pool.
+
+        Unless call_memory has been set, the memory is estimated from the length of the pool
+        (bs_call keeps the reference and the per base statistics for the regions being called)
+        """
+        try:
+            threads = max(1, int(self.call_threads))
+        except (TypeError, ValueError):
+            threads = 1
+        if self.call_memory != None:
+            return threads, self.call_memory
+        size = 0
+        for member in chrom_list:
+            ctg, start, end = self.region(member)
+            size += end - start
+        return threads, (1 << 30) + 2 * size
+
+    def region(self, member):
+        """Contig and BED coordinates of a pool member (a whole contig or a region of a contig)"""
+        ctg, start, end = (member, None, None) if member in self.contig_size else contigRegion(member)
+        if start == None:
+            return ctg, 0, self.contig_size[ctg]
+        return ctg, start - 1, end
 
     def prepare(self, sample, input_bam, chrom_list, output_bcf, report_file, contig_bed):
 
         with open(contig_bed, "w") as f:
-            for chrom in chrom_list:
-                f.write("{}\t0\t{}\n".format(chrom, str(self.contig_size[chrom])))
+            for member in chrom_list:
+                f.write("{}\t{}\t{}\n".format(*self.region(member)))
                         
         parameters_bscall = ['%s' %(executables["bs_call"]),'-r',self.reference,'-n',sample,'--contig-bed',contig_bed,'--contig-sizes',self.csizes,'--report-file',report_file]
     
@@ -916,8 +1131,9 @@ class BsCaller:
         if self.haploid:
             parameters_bscall.append('-1')
         if self.conversion != None:
-            if self.conversion.lower() == "auto" and sample in self.sample_conversion:
-                parameters_bscall.extend(['--conversion', self.sample_conversion[sample]])
+            if self.conversion.lower() == "auto":
+                if sample in self.sample_conversion:
+                    parameters_bscall.extend(['--conversion', self.sample_conversion[sample]])
             else:
                 parameters_bscall.extend(['--conversion', self.conversion])
         if self.ref_bias != None:
@@ -942,73 +1158,202 @@ class BsCaller:
         bsCall = [parameters_bscall]
         return bsCall
 
+    def call(self, sample, input_bam, bcf_file, pool, chrom_list):
+        """Run bs_call on one contig pool"""
+        output = os.path.dirname(bcf_file)
+        log_file = os.path.join(output,"bs_call_{}_{}.err".format(sample, pool))
+        report_file = os.path.join(output,"{}_{}.json".format(sample, pool))
+        contig_bed = os.path.join(output,"contigs_{}_{}.bed".format(sample, pool))
+        bsCallCommand = self.prepare(sample, input_bam, chrom_list, bcf_file, report_file, contig_bed)
+        start = time.time()
+        try:
+            run_supervised(bsCallCommand, name="bscall", logfile=log_file, timeout=self.call_timeout)
+        except ProcessError as e:
+            raise ValueError("Error while executing the bscall process: {}".format(e))
+        self.record_cost(chrom_list, time.time() - start, report_file)
+
+    def record_cost(self, chrom_list, elapsed, report_file):
+        """Add the run time and number of reads of a bs_call job to the contig cost history used to build the pools"""
+        reads = 0
+        try:
+            with open(report_file, 'r') as f:
+                for v in json.load(f)['filterStats']['ReadLevel'].values():
+                    reads += v['Reads']
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass
+        contigs = {}
+        for member in chrom_list:
+            ctg, start, end = self.region(member)
+            contigs[ctg] = (contigs.get(ctg, (0, 0))[0] + end - start, self.contig_size[ctg])
+        db = database()
+        db.add_contig_cost(contigs, elapsed, reads)
+        db.close()
+
 class MethylationCallIter:
-    def __init__(self, samples, sample_bam, output_bcf, jobs, concat, no_merge, ignore_db):
+    """Hands out the calling (POOL_BCF) and merging (MRG_BCF) tasks to the calling threads.
+
+    The pending tasks are read from the db once, when the iterator is made.  Pools are kept in 
+    a heap ordered by sample and then by decreasing pool size (so the largest pools of a sample are 
+    started first, or with incremental merging in the contig order in which they are merged), and the merge for a sample is put in the merge queue (which takes priority) as 
+    soon as the last of its pools has finished.  After that the db is only touched to claim
+    and complete tasks, and to check on pools being processed by other gemBS instances once
+    there is no local work left.  Access is serialized by the caller.
+    """
+    def __init__(self, samples, sample_bam, output_bcf, jobs, concat, no_merge, ignore_db, incremental = False):
         self.sample_bam = sample_bam
         self.sample_list = samples
         self.output_bcf = output_bcf
-        self.sample_ix = 0
-        self.pool_ix = 0
-        self.output_list = []
+        self.output_list = set()
         self.plist = {}
         self.concat = concat
         self.no_merge = no_merge
         self.ignore_db = ignore_db
-        self.status = {}
+        self.incremental = incremental
+        self.pool_heap = []
+        self.merge_queue = collections.deque()
+        # Per sample: merge file (and its status in the db), pools not yet completed, pools being processed here, completed pools
+        self.merge = {}
+        self.pending = {}
+        self.inflight = {}
+        self.done = {}
+        # For incremental merging: all pools of a sample in merge (contig) order, and how many of these have been handed out for appending
+        self.order = {}
+        self.appended = {}
+        # Claimed tasks -> sample
+        self.claimed = {}
         
         for smp in self.sample_list:
             self.plist[smp] = {}
         for smp, pl in output_bcf.items():
             for v in pl:
-                self.output_list.append(v[0])
+                self.output_list.add(v[0])
                 self.plist[smp][v[1]] = v
-
+        self.load()
+
+    def load(self):
+        sample_ix = {}
+        for ix, smp in enumerate(self.sample_list):
+            sample_ix[smp] = ix
+            self.pending[smp] = set()
+            self.inflight[smp] = 0
+            self.done[smp] = []
+            self.order[smp] = []
+        db = database()
+        c = db.cursor()
+        mrg_ok = {}
+        todo = []
+        for fname, pool, smp, psize, ftype, db_status in c.execute("SELECT * FROM calling").fetchall():
+            if not smp in sample_ix:
+                continue
+            status = 0 if self.ignore_db else db_status
+            if ftype == 'POOL_BCF':
+                self.order[smp].append(fname)
+                if fname in self.output_list and status == 0:
+                    if not self.concat:
+                        todo.append((sample_ix[smp], -psize, fname, pool, smp, db_status))
+                        self.pending[smp].add(fname)
+                    elif self.ignore_db:
+                        self.done[smp].append(fname)
+                    else:
+                        # Pools not yet called are not called when only merging, but they still hold up the merge
+                        self.pending[smp].add(fname)
+                elif status != 1:
+                    self.pending[smp].add(fname)
+                else:
+                    self.done[smp].append(fname)
+            elif ftype == 'MRG_BCF':
+                if status == 0:
+                    self.merge[smp] = (fname, db_status)
+                else:
+                    mrg_ok[smp] = False
+        db.close()
+        for smp in self.sample_list:
+            self.order[smp].sort(key = bcfOrder)
+            self.appended[smp] = 0
+        # With incremental merging the pools are called in merge order, so that they are completed roughly in the order they are appended
+        for v in todo:
+            if self.incremental:
+                v = (v[0], self.order[v[4]].index(v[2])) + v[2:]
+            heapq.heappush(self.pool_heap, v)
+        for smp in self.sample_list:
+            if self.no_merge or not mrg_ok.get(smp, True):
+                self.merge.pop(smp, None)
+            elif not self.pending[smp] and smp in self.merge:
+                self.merge_queue.append(smp)
+            else:
+                self.check_append(smp)
+
+    def check_append(self, smp):
+        """With incremental merging, queue an append for a sample if the next pool in merge order has been completed"""
+        if self.incremental and smp in self.merge:
+            order = self.order[smp]
+            ix = self.appended[smp]
+            if ix < len(order) and order[ix] not in self.pending[smp]:
+                self.merge_queue.append(smp)
+
+    def refresh(self, db):
+        """Check the db for pools of our samples that are being processed by other 
+        gemBS instances, and queue the merges for samples that are now complete"""
+        if self.ignore_db:
+            return
+        for smp, v in self.merge.items():
+            if len(self.pending[smp]) > self.inflight[smp]:
+                for fname, status in db.execute("SELECT filepath, status FROM calling WHERE sample = ? AND type = 'POOL_BCF'", (smp,)).fetchall():
+                    if status == 1 and fname in self.pending[smp]:
+                        self.pending[smp].discard(fname)
+                        self.done[smp].append(fname)
+                if not self.pending[smp]:
+                    self.merge_queue.append(smp)
+                else:
+                    self.check_append(smp)
+        
     def __iter__(self):
         return  self
 
+    def next_merge(self, db):
+        while self.merge_queue:
+            sample = self.merge_queue.popleft()
+            if not sample in self.merge:
+                # Already handed out
+                continue
+            mrg_file, db_status = self.merge.pop(sample)
+            if db.claim('calling', mrg_file, prev_status = db_status):
+                self.claimed[mrg_file] = sample
+                if self.pending[sample]:
+                    # Append the completed pools at the start of the merge order to the partial merge file.  The partial
+                    # file is kept if we are interrupted; bcfAppend() picks up from its last consistent state
+                    order = self.order[sample]
+                    ix = self.appended[sample]
+                    while ix < len(order) and order[ix] not in self.pending[sample]:
+                        ix += 1
+                    self.appended[sample] = ix
+                    database.reg_db_com(mrg_file, "UPDATE calling SET status = 0 WHERE filepath = '{}'".format(mrg_file), [])
+                    return ('APPEND_BCF', sample, mrg_file, order[:ix])
+                ixfile = mrg_file + '.csi'
+                md5file = mrg_file + '.md5'
+                database.reg_db_com(mrg_file, "UPDATE calling SET status = 0 WHERE filepath = '{}'".format(mrg_file), [mrg_file, ixfile, md5file])
+                done = self.done[sample]
+                if self.incremental:
+                    done = [f for f in self.order[sample] if f in done]
+                return ('MRG_BCF', sample, mrg_file, list(done))
+        return None
+    
     def __next__(self):
         db = database()
-        db.isolation_level = None
-        c = db.cursor()
-        try_get_exclusive(c)
-        ret = None
-        for sample in self.sample_list:
-            mrg_file = ""
-            mrg_ok = False if self.no_merge else True
-            list_bcfs = []
-            for fname, pool, ftype, status in c.execute("SELECT filepath, poolid, type, status FROM calling WHERE sample = ? ORDER BY poolsize DESC", (sample,)):
-                if self.ignore_db:
-                    status = self.status.get(fname, 0)
-                if ftype == 'POOL_BCF':
-                    if fname in self.output_list and status == 0:
-                        if not self.concat:
-                            ret = (ftype, sample, self.sample_bam[sample], self.plist[sample][pool])
-                            c.execute("UPDATE calling SET status = 3 WHERE filepath = ?", (fname,))
-                            self.status[fname] = 1
-                            base, ext = os.path.splitext(fname)
-                            jfile = base + '.json'
-                            database.reg_db_com(fname, "UPDATE calling SET status = 0 WHERE filepath = '{}'".format(fname), [fname, jfile])
-                            break
-                    elif status != 1:
-                        mrg_ok = False
-                    else:
-                        list_bcfs.append(fname)
-                elif ftype == 'MRG_BCF':
-                    if status == 0:
-                        mrg_file = fname
-                    else:
-                        mrg_ok = False
-            else:
-                if mrg_ok and mrg_file != "":
-                    c.execute("UPDATE calling SET status = 3 WHERE filepath = ?", (mrg_file,))
-                    self.status[mrg_file] = 1
-                    ixfile = mrg_file + '.csi'
-                    md5file = mrg_file + '.md5'
-                    database.reg_db_com(mrg_file, "UPDATE calling SET status = 0 WHERE filepath = '{}'".format(mrg_file), [mrg_file, ixfile, md5file])
-                    ret = ('MRG_BCF', sample, mrg_file, list_bcfs)
-            if ret != None:
-                break
-        c.execute("COMMIT")
+        ret = self.next_merge(db)
+        while ret == None and self.pool_heap:
+            smp_ix, psize, fname, pool, sample, db_status = heapq.heappop(self.pool_heap)
+            if db.claim('calling', fname, prev_status = db_status):
+                ret = ('POOL_BCF', sample, self.sample_bam[sample], self.plist[sample][pool])
+                self.claimed[fname] = sample
+                self.inflight[sample] += 1
+                base, ext = os.path.splitext(fname)
+                jfile = base + '.json'
+                database.reg_db_com(fname, "UPDATE calling SET status = 0 WHERE filepath = '{}'".format(fname), [fname, jfile])
+            # Otherwise the pool has been claimed by another worker in the meantime and stays pending
+        if ret == None:
+            self.refresh(db)
+            ret = self.next_merge(db)
         db.close()
         if ret == None:
             raise StopIteration
@@ -1017,20 +1362,41 @@ class MethylationCallIter:
 
     def finished(self, bcf_list, fname):
         db = database()
-        db.isolation_level = None
-        c = db.cursor()
-        try_get_exclusive(c)
-        c.execute("UPDATE calling SET status = 1 WHERE filepath = ?", (fname,))
+        extra = []
         if bcf_list != None:
             for f in bcf_list:
                 if os.path.exists(f): os.remove(f)
-                c.execute("UPDATE calling SET status = 2 WHERE filepath = ?", (f,))
-        c.execute("COMMIT")
+                extra.append(("UPDATE calling SET status = 2 WHERE filepath = ?", (f,)))
+        db.release('calling', fname, 1, extra)
+        database.del_db_com(fname)
+        db.close()
+        sample = self.claimed.pop(fname, None)
+        if sample != None and fname in self.pending[sample]:
+            self.pending[sample].discard(fname)
+            self.inflight[sample] -= 1
+            self.done[sample].append(fname)
+            if not self.pending[sample] and sample in self.merge:
+                self.merge_queue.append(sample)
+            else:
+                self.check_append(sample)
+
+    def appended_pools(self, fname):
+        """Return the merge task for a sample to the pending state after an incremental append"""
+        db = database()
+        db.release('calling', fname, 0)
         database.del_db_com(fname)
         db.close()
+        sample = self.claimed.pop(fname, None)
+        if sample != None:
+            self.merge[sample] = (fname, 0)
+            if not self.pending[sample]:
+                self.merge_queue.append(sample)
+            else:
+                self.check_append(sample)
           
 class MethylationCallThread(th.Thread):
-    def __init__(self, threadID, methIter, bsCall, lock, remove, dry_run_com, dry_run, dry_run_json, json_commands, conversion, sample_conversion, benchmark_mode):
+    def __init__(self, threadID, methIter, bsCall, lock, remove, dry_run_com, dry_run, dry_run_json, json_commands, conversion, sample_conversion, benchmark_mode, resources=None,
+                 incremental=False):
         th.Thread.__init__(self)
         self.threadID = threadID
         self.methIter = methIter
@@ -1044,6 +1410,8 @@ class MethylationCallThread(th.Thread):
         self.conversion = conversion
         self.sample_conversion = sample_conversion
         self.benchmark_mode = benchmark_mode
+        self.resources = resources
+        self.incremental = incremental
 
     def run(self):
         while True:
@@ -1085,14 +1453,23 @@ class MethylationCallThread(th.Thread):
                         desc="call {} {}".format(sample,pool)
                         self.json_commands[desc]=task
                 else:
-                    contig_bed = os.path.join(output,"contigs_{}_{}.bed".format(sample, pool))
-                    bsCallCommand = self.bsCall.prepare(sample, input_bam, chrom_list, bcf_file, report_file, contig_bed)
-                    process = run_tools(bsCallCommand, name="bscall", logfile=log_file)
-                    if process.wait() != 0:
-                        raise ValueError("Error while executing the bscall process.")
+                    threads, memory = self.bsCall.footprint(chrom_list)
+                    if self.resources != None:
+                        self.resources.acquire(threads, memory)
+                    try:
+                        self.bsCall.call(sample, input_bam, bcf_file, pool, chrom_list)
+                    finally:
+                        if self.resources != None:
+                            self.resources.release(threads, memory)
                 self.lock.acquire()
                 self.methIter.finished(None, bcf_file)
                 self.lock.release()
+            elif ret[0] == 'APPEND_BCF':
+                (sample, fname, list_bcfs) = ret[1:]
+                bcfAppend(list_bcfs, fname)
+                self.lock.acquire()
+                self.methIter.appended_pools(fname)
+                self.lock.release()
             else:
                 (sample, fname, list_bcfs) = ret[1:]
                 if self.dry_run_com:
@@ -1116,7 +1493,7 @@ class MethylationCallThread(th.Thread):
                         self.json_commands[desc]=task
                 
                 else:
-                    bsConcat(list_bcfs, sample, self.bsCall.merge_threads, fname, self.benchmark_mode)
+                    bsConcat(list_bcfs, sample, self.bsCall.merge_threads, fname, self.benchmark_mode, self.incremental)
                     self.lock.acquire()
                     if self.remove:
                         self.methIter.finished(list_bcfs, fname)
@@ -1128,7 +1505,8 @@ class MethylationCallThread(th.Thread):
 def methylationCalling(reference=None,species=None,sample_bam=None,output_bcf=None,samples=None,right_trim=0,left_trim=5,dry_run_com=None,
                        keep_unmatched=False,keep_duplicates=False,dbSNP_index_file="",call_threads="1",merge_threads="1",jobs=1,remove=False,concat=False,
                        mapq_threshold=None,bq_threshold=None,haploid=False,conversion=None,ref_bias=None,sample_conversion=None,
-                       no_merge=False,json_commands=None,dry_run=False,dry_run_json=None,ignore_db=None,ignore_duplicates=False,benchmark_mode=False):
+                       no_merge=False,json_commands=None,dry_run=False,dry_run_json=None,ignore_db=None,ignore_duplicates=False,benchmark_mode=False,
+                       call_memory=None,call_timeout=None,resources=None,incremental=False):
 
     """ Performs the process to make met5Bhylation calls.
     
@@ -1154,6 +1532,10 @@ def methylationCalling(reference=None,species=None,sample_bam=None,output_bcf=No
     ref_bias -- bias to reference homozygote
     sample_conversion - per sample conversion rates (calculated if conversion == 'auto')
     benchmark_mode - remove version and date information from header
+    call_memory - memory used by a calling job (estimated from the pool size if not set)
+    call_timeout - optional limit (seconds) on the run time of a calling job
+    resources - host CPU / memory budget shared by the calling jobs
+    incremental - append completed pools to the sample BCF as they become available, rather than merging them all at the end
     """
 
     for snp, pl in output_bcf.items():
@@ -1163,34 +1545,24 @@ def methylationCalling(reference=None,species=None,sample_bam=None,output_bcf=No
             if not os.path.exists(odir):
                 os.makedirs(odir)
 
-    db = database()
-    c = db.cursor()
-    c.execute("SELECT * FROM indexing WHERE type = 'contig_sizes'")
-    ret = c.fetchone()
-    if not ret or ret[2] != 1:
-        raise CommandException("Could not open contig sizes file.")
-    csizes = ret[0]
-    contig_size = {}
-    with open (csizes, "r") as f:
-        for line in f:
-            fd = line.split()
-            if(len(fd) > 1):
-                contig_size[fd[0]] = int(fd[1])
+    csizes, contig_size = readContigSizes()
 
     bsCall = BsCaller(reference=reference,species=species,right_trim=right_trim,left_trim=left_trim,
                       keep_unmatched=keep_unmatched,keep_duplicates=keep_duplicates,ignore_duplicates=ignore_duplicates,contig_size=contig_size,csizes=csizes,
                       dbSNP_index_file=dbSNP_index_file,call_threads=call_threads,merge_threads=merge_threads,mapq_threshold=mapq_threshold,bq_threshold=bq_threshold,
-                      haploid=haploid,conversion=conversion,ref_bias=ref_bias,sample_conversion=sample_conversion,benchmark_mode=benchmark_mode)
+                      haploid=haploid,conversion=conversion,ref_bias=ref_bias,sample_conversion=sample_conversion,benchmark_mode=benchmark_mode,
+                      call_memory=call_memory,call_timeout=call_timeout)
 
     if dry_run_com != None:
         jobs = 1
         
-    methIter = MethylationCallIter(samples, sample_bam, output_bcf, jobs, concat, no_merge, ignore_db)
+    methIter = MethylationCallIter(samples, sample_bam, output_bcf, jobs, concat, no_merge, ignore_db, incremental and dry_run_com == None)
     lock = th.Lock()
     if jobs < 1: jobs = 1
     thread_list = []
     for ix in range(jobs):
-        thread = MethylationCallThread(ix, methIter, bsCall, lock, remove, dry_run_com, dry_run, dry_run_json, json_commands, conversion, sample_conversion, benchmark_mode)
+        thread = MethylationCallThread(ix, methIter, bsCall, lock, remove, dry_run_com, dry_run, dry_run_json, json_commands, conversion, sample_conversion, benchmark_mode,
+                                       resources, incremental)
         thread.start()
         thread_list.append(thread)
     for thread in thread_list:
@@ -1268,12 +1640,180 @@ def methylationFiltering(bcfFile=None,outbase=None,name=None,strand_specific=Fal
 
     return os.path.abspath(output_dir)
 
-def bsConcat(list_bcfs=None,sample=None,threads=None,bcfSample=None,benchmark_mode=False):
+def bcfOrder(bcf_file):
+    """Sort key for pool BCF files.  The chunks of a split contig (pools named contig@001, contig@002 ...)
+    are ordered by chunk number so that they are concatenated in genomic order"""
+    m = re.match(r'^(.+)@(\d+)\.bcf$', bcf_file)
+    if m:
+        return (m.group(1), int(m.group(2)))
+    return (bcf_file[:-4] if bcf_file.endswith('.bcf') else bcf_file, 0)
+
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+def bgzfBlock(f):
+    """Read one raw BGZF block from f, returning (block, data offset, data length) or None at the end of the file"""
+    hdr = f.read(12)
+    if not hdr:
+        return None
+    if len(hdr) < 12 or hdr[:4] != b'\x1f\x8b\x08\x04':
+        raise ValueError("Invalid BGZF block in {}".format(f.name))
+    xlen = struct.unpack('<H', hdr[10:12])[0]
+    extra = f.read(xlen)
+    bsize = None
+    ix = 0
+    while ix + 4 <= len(extra):
+        slen = struct.unpack('<H', extra[ix + 2:ix + 4])[0]
+        if extra[ix:ix + 2] == b'BC' and slen == 2:
+            bsize = struct.unpack('<H', extra[ix + 4:ix + 6])[0]
+        ix += 4 + slen
+    if bsize == None:
+        raise ValueError("Invalid BGZF block in {}".format(f.name))
+    block = hdr + extra + f.read(bsize + 1 - 12 - xlen)
+    return block, 12 + xlen, bsize + 1 - 20 - xlen
+
+def bgzfCompress(data):
+    """Compress data to BGZF blocks"""
+    blocks = []
+    for ix in range(0, len(data), 0xff00):
+        chunk = data[ix:ix + 0xff00]
+        c = zlib.compressobj(6, zlib.DEFLATED, -15)
+        cdata = c.compress(chunk) + c.flush()
+        blocks.append(struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25) + cdata)
+        blocks.append(struct.pack('<II', zlib.crc32(chunk) & 0xffffffff, len(chunk)))
+    return b''.join(blocks)
+
+def bcfReadHeader(f):
+    """Read the BGZF blocks holding the header of a BCF file from f.  Returns (header, data read after the header)"""
+    buf = b''
+    hlen = None
+    while hlen == None or len(buf) < hlen:
+        ret = bgzfBlock(f)
+        if ret == None:
+            raise ValueError("Truncated BCF file {}".format(f.name))
+        block, offset, size = ret
+        buf += zlib.decompress(block[offset:offset + size], -15)
+        if hlen == None and len(buf) >= 9:
+            if buf[:3] != b'BCF':
+                raise ValueError("{} is not a BCF file".format(f.name))
+            hlen = 9 + struct.unpack('<I', buf[5:9])[0]
+    return buf[:hlen], buf[hlen:]
+
+def bcfHeaderKey(header):
+    """The lines of a BCF header that the records depend on: the FILTER/INFO/FORMAT and contig 
+    dictionaries and the sample names.  Headers with the same key can be concatenated naively"""
+    key = []
+    for line in header[9:].rstrip(b'\0').split(b'\n'):
+        if line.startswith((b'##FILTER=', b'##INFO=', b'##FORMAT=', b'##contig=', b'#CHROM')):
+            key.append(line)
+    return key
+
+def bcfAppendFile(out, bcf_file, header, md5):
+    """Append the records of a BCF file to the open output file out.  If header is None out is empty and 
+    the header of bcf_file is written first, otherwise the header of bcf_file must be compatible with header 
+    (as checked by 'bcftools concat --naive') and the EOF marker at the end of out is overwritten.  
+    The data written is added to the md5 digest md5.  Returns the header of bcf_file"""
+    def write(data):
+        out.write(data)
+        md5.update(data)
+    with open(bcf_file, 'rb') as f:
+        file_header, buf = bcfReadHeader(f)
+        # The header is normally in blocks of its own, otherwise the start of the records is recompressed 
+        if header == None:
+            write(bgzfCompress(file_header))
+        elif bcfHeaderKey(file_header) != bcfHeaderKey(header):
+            raise ValueError("Header of {} is not compatible with the header of the files being merged".format(bcf_file))
+        else:
+            out.seek(-len(BGZF_EOF), os.SEEK_END)
+            out.truncate()
+        if buf:
+            write(bgzfCompress(buf))
+        # The remaining blocks are copied as they are, apart from the EOF marker
+        start = f.tell()
+        end = os.fstat(f.fileno()).st_size
+        if end - start >= len(BGZF_EOF):
+            f.seek(end - len(BGZF_EOF))
+            if f.read() == BGZF_EOF:
+                end -= len(BGZF_EOF)
+            f.seek(start)
+        left = end - start
+        while left > 0:
+            data = f.read(min(left, 1 << 20))
+            if not data:
+                raise ValueError("Truncated BCF file {}".format(bcf_file))
+            write(data)
+            left -= len(data)
+    return file_header
+
+# md5 digests of the partial merge files, kept between appends: partial file -> (size without the EOF marker, digest)
+bcf_append_digests = {}
+
+def bcfAppend(list_bcfs, bcfSample, digest=None):
+    """Append pool BCF files to the partial merge file for a sample (bcfSample + '.part').
+
+    list_bcfs -- the pool BCF files to be present in the partial file, in merge order.  Files already in the
+                 partial file are skipped, and if the partial file does not match the start of list_bcfs it is restarted.  
+    bcfSample -- the final merged BCF file
+    digest -- if set, the md5 digest of the partial file is written to this file (in md5sum format, for bcfSample)
+
+    As for 'bcftools concat --naive' the header of the first file is used (the headers of the other files must be
+    compatible with it), and the BGZF blocks of the pool files are copied without recompression.  The list of files and the size of the partial file are kept in
+    bcfSample + '.part.json' so that after an interruption the partial file can be truncated back to its last 
+    consistent state.  The md5 digest is updated as the data is written, so the partial file is only read 
+    again if the appends are continued by another process.  Returns the name of the partial file.
+    """
+    part = bcfSample + '.part'
+    state_file = part + '.json'
+    state = {'files': [], 'size': 0}
+    try:
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        pass
+    done = state['files']
+    if done != list_bcfs[:len(done)] or not os.path.exists(part) or os.path.getsize(part) < state['size']:
+        done = []
+        state = {'files': done, 'size': 0}
+    with open(part, 'r+b' if done else 'wb') as out:
+        # Drop anything written after the last consistent state
+        out.truncate(state['size'])
+        header = None
+        md5 = hashlib.md5()
+        if done:
+            header = bcfReadHeader(out)[0]
+            size = state['size'] - len(BGZF_EOF)
+            prev = bcf_append_digests.get(part)
+            if prev != None and prev[0] == size:
+                md5 = prev[1].copy()
+            else:
+                out.seek(0)
+                while size > 0:
+                    data = out.read(min(size, 1 << 20))
+                    md5.update(data)
+                    size -= len(data)
+        out.seek(0, os.SEEK_END)
+        for bcf_file in list_bcfs[len(done):]:
+            header = bcfAppendFile(out, bcf_file, header, md5)
+            out.write(BGZF_EOF)
+            out.flush()
+            done.append(bcf_file)
+            state['size'] = out.tell()
+            with open(state_file + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(state_file + '.tmp', state_file)
+            bcf_append_digests[part] = (state['size'] - len(BGZF_EOF), md5.copy())
+    if digest != None:
+        md5.update(BGZF_EOF)
+        with open(digest, 'w') as f:
+            f.write("{}  {}\n".format(md5.hexdigest(), bcfSample))
+    return part
+
+def bsConcat(list_bcfs=None,sample=None,threads=None,bcfSample=None,benchmark_mode=False,incremental=False):
     """ Concatenates all bcf methylation calls files in one output file.
     
         list_bcfs -- list of bcf files to be concatenated
         sample -- unique sample identification
         output_dir -- output directory path
+        incremental -- complete the partial merge file from bcfAppend() and use it as the output
     """
 
     output_dir = os.path.dirname(bcfSample)
@@ -1285,18 +1825,26 @@ def bsConcat(list_bcfs=None,sample=None,threads=None,bcfSample=None,benchmark_mo
     bcfSampleMd5 = os.path.join(output_dir,"{}.bcf.md5".format(sample))
     logfile = os.path.join(output_dir,"bcf_concat_{}.err".format(sample))
    
-    #Concatenation
-    concat = [executables['bcftools'],'concat','-O','b','-n','-o',bcfSample]
-    if threads != None:
-        concat.extend(['--threads', threads])
-    if benchmark_mode:
-        concat.append('--no-version')
-    list_bcfs.sort()
-    concat.extend(list_bcfs)
+    if incremental:
+        part = bcfAppend(list_bcfs, bcfSample, bcfSampleMd5)
+        os.replace(part, bcfSample)
+        os.remove(part + '.json')
+        bcf_append_digests.pop(part, None)
+    else:
+        #Concatenation (to stdout, so that the md5 digest is calculated as the output is written)
+        concat = [executables['bcftools'],'concat','-O','b','-n']
+        if threads != None:
+            concat.extend(['--threads', threads])
+        if benchmark_mode:
+            concat.append('--no-version')
+        list_bcfs.sort(key = bcfOrder)
+        concat.extend(list_bcfs)
      
-    process = run_tools([concat],name="Concatenation Calls",logfile=logfile)
-    if process.wait() != 0:
-        raise ValueError("Error while concatenating bcf calls.")
+        process = run_tools([concat],name="Concatenation Calls",logfile=logfile,output=bcfSample,digest=bcfSampleMd5)
+        if process.wait() != 0:
+            raise ValueError("Error while concatenating bcf calls.")
+        for f in [bcfSample + '.part', bcfSample + '.part.json']:
+            if os.path.exists(f): os.remove(f)
         
     #Indexing
     indexing = [executables['bcftools'],'index']
@@ -1304,17 +1852,10 @@ def bsConcat(list_bcfs=None,sample=None,threads=None,bcfSample=None,benchmark_mo
         indexing.extend(['--threads', threads])
     indexing.append(bcfSample)
 
-    #md5sum
-    md5sum = ['md5sum',bcfSample]
-
     processIndex = run_tools([indexing],name="Index BCF")
-    processMD5 = run_tools([md5sum],name="Index MD5",output=bcfSampleMd5)
-    
+
     if processIndex.wait() != 0:
         raise ValueError("Error while Indexing BCF file.")        
-                
-    if processMD5.wait() != 0:
-        raise ValueError("Error while calculating md5sum of merged BCF file.")
         
     return os.path.abspath(bcfSample)
     
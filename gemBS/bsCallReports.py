@@ -5,12 +5,12 @@ Created on Fri Dec  1 12:02:40 2017
 @author: marcos
 """
 
-import multiprocess as mp
-import threading as th
 import os
 import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from .reportStats import RunBasicStats
+from .utils import readCacheFile, writeCacheFile, htmlPageComplete
+from .reportStats import RunBasicStats, stats_cache_version
 from .report import BasicHtml
 from .bsCallStats import *
 from .bsCallSphinxReports import *
@@ -485,205 +485,205 @@ class HtmlIndexBsCall(HtmlBsCallReport):
         self.stop()
         self.saveReport()
 
-    def buildSampleBscallReport(self,sample, lock = None):
-        chrom_json_files=self.inputs[sample]
-        #Parsing json file
-        readLevelStats = ReadsAndBases()
-        baseLevelStats = BaseLevel()
-        #Coverages
-        allCoverage = Coverage(concept="All",yLabel="#Sites",pngFile=os.path.join(self.output_dir,'IMG',"{}_coverage_all.png".format(sample)))
-        variantCoverage = Coverage(concept="Variants",yLabel="#SNPs",pngFile=os.path.join(self.output_dir,'IMG',"{}_coverage_variants.png".format(sample)))
-        dbSnpCoverage = Coverage(concept="dbSnp",yLabel="#SNPs",pngFile=os.path.join(self.output_dir,'IMG',"{}_coverage_dbsnp.png".format(sample)))
-        refCpGcoverage = Coverage(concept="RefCpG",yLabel="#CpGs",pngFile=os.path.join(self.output_dir,'IMG',"{}_coverage_refCpG.png".format(sample)))
-        refCpGInfCoverage = Coverage(concept="RefCpGInf",yLabel="#CpGs",pngFile=os.path.join(self.output_dir,'IMG',"{}_coverage_refCpGInf.png".format(sample)))
-        nonRefCpGcoverage = Coverage(concept="NonRefCpG",yLabel="#CpGs",pngFile=os.path.join(self.output_dir,'IMG',"{}_coverage_nonRefCpG.png".format(sample)))
-        nonRefCpGinfCoverage = Coverage(concept="NonRefCpGInf",yLabel="#CpGs",pngFile=os.path.join(self.output_dir,'IMG',"{}_coverage_nonRefCpGinf.png".format(sample)))
-        #GC Coverage
-        gcCoverage = GCcoverage("%s/IMG/%s_gc_coverage.png" %(self.output_dir,sample))
-        #TotalStats
-        totalStats = TotalStats()
-        #Quality
-        qualityAll = Quality(concept="All",yLabel="#Sites",pngFile=os.path.join(self.output_dir,'IMG',"{}_quality_all.png".format(sample)))
-        qualityVariant = Quality(concept="Variants",yLabel="#SNPs",pngFile=os.path.join(self.output_dir,'IMG',"{}_quality_variant.png".format(sample)))
-        qualityRefCpG = Quality(concept="RefCpG",yLabel="#CpGs",pngFile=os.path.join(self.output_dir,'IMG',"{}_quality_refcpg.png".format(sample)))
-        qualityNonRefCpG = Quality(concept="NonRefCpG",yLabel="#CpGs",pngFile=os.path.join(self.output_dir,'IMG',"{}_quality_nonRefCpg.png".format(sample)))
-        #QC Distributions
-        fsVariant = QCDistribution(concept="FisherStrandVariant",typeDistribution="FisherStrand",typeBaseLocation="",pngFile=os.path.join(self.output_dir,'IMG',"{}_fs_variant.png".format(sample)))
-        fsVariant.setAxisXLabel(newLabel="Fisher Strand Phred scale probability")
-        qdVariant = QCDistribution(concept="QualityByDepthVariant",typeDistribution="QualityByDepth",typeBaseLocation="Variant",pngFile=os.path.join(self.output_dir,'IMG',"{}_qd_variant.png".format(sample)))
-        qdNonVariant = QCDistribution(concept="QualityByDepthNonVariant",typeDistribution="QualityByDepth",typeBaseLocation="NonVariant",pngFile=os.path.join(self.output_dir,'IMG',"{}_qd_nonvariant.png".format(sample)))
-        rmsmqVariant = QCDistribution(concept="RMSMappingQualityVariant",typeDistribution="RMSMappingQuality",typeBaseLocation="Variant",pngFile=os.path.join(self.output_dir,'IMG',"{}_rmsmq_variant.png".format(sample)))
-        rmsmqNonVariant = QCDistribution(concept="RMSMappingQualityNonVariant",typeDistribution="RMSMappingQuality",typeBaseLocation="NonVariant",pngFile=os.path.join(self.output_dir,'IMG',"{}_rmsmq_nonvariant.png".format(sample)))
-        #VCF Filter Stats
-        vcfFilterStats = VCFFilterStats()
-        #Mutations
-        mutationsStats = Mutations("Mutations")
-        #Methylation
-        methylationAllRefCpG = Methylation("AllRefCpG")
-        methylationPassRefCpG = Methylation("PassedRefCpG")
-        methylationNonRefCpG = Methylation("AllNonRefCpG")
-        methylationPassNonRefCpG = Methylation("PassedNonRefCpG")
-        #NonCpGReadProfile
-        nonCpGReadProfile = NonCpGReadProfile(os.path.join(self.output_dir,'IMG',"{}_nonCpgReadProfile.png".format(sample)))
-        #SummaryMethylation
-        summaryMethylation = SummaryMethylation() 
-        
-        #Load al json files
-        for json_file in chrom_json_files:
-            with open(json_file, 'r') as file_json:
-                try:
-                    data = json.load(file_json)
-                
-                    readLevelStats.add(data["filterStats"]["ReadLevel"])
-                    baseLevelStats.add(data["filterStats"]["BaseLevel"])
-                    #Coverages
-                    allCoverage.add(data["totalStats"]["coverage"]["All"])
-                    variantCoverage.add(data["totalStats"]["coverage"]["Variant"])
-                    if "dbSNP" in data["totalStats"]["coverage"]:
-                        dbSnpCoverage.add(data["totalStats"]["coverage"]["dbSNP"])
-                    refCpGcoverage.add(data["totalStats"]["coverage"]["RefCpG"])
-                    refCpGInfCoverage.add(data["totalStats"]["coverage"]["RefCpGInf"])
-                    nonRefCpGcoverage.add(data["totalStats"]["coverage"]["NonRefCpG"])
-                    nonRefCpGinfCoverage.add(data["totalStats"]["coverage"]["NonRefCpGInf"])
-                    #GC Coverage
-                    gcCoverage.add(data["totalStats"]["coverage"]["GC"])
-                    #TotalStats
-                    totalStats.add(data["totalStats"])
-                    #Quality
-                    qualityAll.add(data["totalStats"]["quality"]["All"])
-                    qualityVariant.add(data["totalStats"]["quality"]["Variant"])
-                    qualityRefCpG.add(data["totalStats"]["quality"]["RefCpG"])
-                    qualityNonRefCpG.add(data["totalStats"]["quality"]["NonRefCpG"])
-                    #QC Distributions
-                    fsVariant.add(data["totalStats"]["QCDistributions"]["FisherStrand"])
-                    qdVariant.add(data["totalStats"]["QCDistributions"]["QualityByDepth"])
-                    qdNonVariant.add(data["totalStats"]["QCDistributions"]["QualityByDepth"])
-                    rmsmqVariant.add(data["totalStats"]["QCDistributions"]["RMSMappingQuality"])
-                    rmsmqNonVariant.add(data["totalStats"]["QCDistributions"]["RMSMappingQuality"])
-                    #VCF Filter Stats
-                    vcfFilterStats.add(data["totalStats"]["VCFFilterStats"])                
-                    #Mutations
-                    mutationsStats.add(data["totalStats"]["mutations"])              
-                    #Methylation
-                    methylationAllRefCpG.add(data["totalStats"]["methylation"]["AllRefCpg"])
-                    methylationPassRefCpG.add(data["totalStats"]["methylation"]["PassedRefCpg"])
-                    methylationNonRefCpG.add(data["totalStats"]["methylation"]["AllNonRefCpg"])
-                    methylationPassNonRefCpG.add(data["totalStats"]["methylation"]["PassedNonRefCpg"])
-                    #NonCpGReadProfile
-                    nonCpGReadProfile.add(data["totalStats"]["methylation"]["NonCpGreadProfile"])
-                    
-                except ValueError as e:
-                    print('problem reading JSON file {})'.format(json_file))
-                    print(e)
-                    pass # invalid json
-
-        #Prepare plot for Methylation levels
-        plotMethylation = PlotMethylationLevels(concept="Methylation Levels",pngFile=os.path.join(self.output_dir,'IMG',"{}_methylation_levels.png".format(sample)),
-                                                meth_list=[methylationAllRefCpG,methylationPassRefCpG,methylationNonRefCpG,methylationPassNonRefCpG])
-
-        #Get Table Summary
-        summaryMethylation.setData(concept = "AllRefCpg",values=methylationAllRefCpG.methylation_cpgs)
-        summaryMethylation.setData(concept = "PassedRefCpg",values=methylationPassRefCpG.methylation_cpgs)
-        summaryMethylation.setData(concept = "AllNonRefCpg",values=methylationNonRefCpG.methylation_cpgs)
-        summaryMethylation.setData(concept = "PassedNonRefCpg",values=methylationPassNonRefCpG.methylation_cpgs)
-        
-        #Sample Summary 
-        #Prepare GC Values for plotting and getting GC Correlation
-        gcCoverage.selectDataToPlot()                                              
-        samples_summary = SummarySample(sampleName=sample,readLevelStats=readLevelStats,baseLevelStats=baseLevelStats,gcCoverage=gcCoverage,totalStats=totalStats,variantCoverage=variantCoverage,
-                                        mutationStats=mutationsStats,methylationPassRefCpg=methylationPassRefCpG,refCpgCoverage=refCpGcoverage)  
-                                       
-        sample_stats_summaries = samples_summary.getTable()
-        
-        #DataSet Per Samples
-        sample_stats = {"mappingCoverage": [readLevelStats,baseLevelStats,allCoverage,gcCoverage,qualityAll,nonCpGReadProfile],
-                            "calls": [totalStats,vcfFilterStats,variantCoverage,dbSnpCoverage,qualityVariant,
-                            [fsVariant,qdVariant,qdNonVariant,rmsmqVariant,rmsmqNonVariant],
-                            mutationsStats],
-                            "methylation": [totalStats,refCpGcoverage,refCpGInfCoverage,nonRefCpGcoverage,nonRefCpGinfCoverage,
-                            qualityRefCpG,qualityNonRefCpG,plotMethylation,summaryMethylation]
-                            }
-        #1.1 Create Mapping and Coverage Statistics
-        mappingCoverageHtml = os.path.join(self.output_dir,"{}_mapping_coverage.html".format(sample))
-        parent_name = "%s/mapping_coverage" %(self.name_project)
-        sample_mapping_coverage = HtmlMappingCoverage(html_file_name=mappingCoverageHtml,current_name=sample,parent_name=parent_name,parent_document=self.index_html_document)
-        #1.1.2 Setup mapping coverage report
-        sample_mapping_coverage.configureStats(stats_vector=sample_stats["mappingCoverage"])
-        #1.1.3 Create Document
-        process_list = []
-        if lock == None:
-            sample_mapping_coverage.createPage()
-        else:
-            process = mp.Process(target=sample_mapping_coverage.createPage)
-            process.start()
-            process_list.append(process)
-
-        #1.2 Create Bs-Genotype Calls Report
-        variantsHtml = os.path.join(self.output_dir,"{}_variants.html".format(sample))
-        parent_variants = os.path.join(self.name_project,'variants')
-        sample_variants = HtmlBsGenotypeCalls(html_file_name=variantsHtml,current_name=sample,parent_name=parent_variants,parent_document=self.index_html_document)
-        #1.2.1 Setup Variants Report
-        sample_variants.configureStats(stats_vector=sample_stats["calls"])
-        #1.2.2 Create Document
-        if lock == None:
-            sample_variants.createPage()
-        else:
-            process = mp.Process(target=sample_variants.createPage)
-            process.start()
-            process_list.append(process)
-
-        #1.3 Create Methylation Statitics
-        methylationHtml = os.path.join(self.output_dir,"{}_methylation.html".format(sample))
-        parent_methylation = os.path.join(self.name_project,'methylation')
-        sample_methylation = HtmlMethylation(html_file_name=methylationHtml,current_name=sample,parent_name=parent_methylation,parent_document=self.index_html_document)
-        #1.3.1 Setup Methylation Report
-        sample_methylation.configureStats(stats_vector=sample_stats["methylation"])
-        #1.3.2 Create Document
-        if lock == None:
-            sample_methylation.createPage()
-        else:
-            process = mp.Process(target=sample_methylation.createPage)
-            process.start()
-            process_list.append(process)
-
-        #1.4 Vector of links to create index Table
-        sample_links = [sample,os.path.basename(mappingCoverageHtml),os.path.basename(variantsHtml),os.path.basename(methylationHtml)]
-
-        if lock != None:
-            lock.acquire()
-            self.dict_samples[sample] = sample_stats
-            self.dict_samples_summaries[sample] = sample_stats_summaries
-            lock.release()
-            for process in process_list:
-                process.join()
-        else :
-            self.dict_samples[sample] = sample_stats
-            self.dict_samples_summaries[sample] = sample_stats_summaries            
+    def buildSampleBscallReport(self,sample):
+        """ Build the reports for a sample, returning the links for the index table """
+        (sample_links, sample_stats, sample_stats_summaries, pages), cached = loadSampleStats(sample,self.inputs[sample],self.output_dir,
+                                                                                               self.name_project,self.index_html_document)
+        if needPages(pages, cached):
+            for page in pages:
+                page.createPage()
+        self.dict_samples[sample] = sample_stats
+        self.dict_samples_summaries[sample] = sample_stats_summaries
         return sample_links
 
-class BuildBsCallReportThread(th.Thread):
-    def __init__(self, threadID, sample_list, sample_link_list, sample_lock, store_lock, html):
-        th.Thread.__init__(self)
-        self.threadID = threadID
-        self.sample_list = sample_list
-        self.sample_link_list = sample_link_list
-        self.sample_lock = sample_lock
-        self.store_lock = store_lock
-        self.html = html
-        
-    def run(self):
-        while self.sample_list:
-            self.sample_lock.acquire()
-            if self.sample_list:
-                sample = self.sample_list.pop(0)
-                self.sample_lock.release()
-                ret = self.html.buildSampleBscallReport(sample, lock = self.store_lock)
-                self.store_lock.acquire()
-                self.sample_link_list.append(ret)
-                self.store_lock.release()
-            else:
-                self.sample_lock.release()
-                                
+def aggregateSampleStats(sample,json_files,output_dir,name_project,index_html_document):
+    """ Read the bs_call JSON files of a sample and collect the statistics for its reports.
+    
+        Runs as a separate task in the report process pool, so only takes and returns picklable objects.
+    
+        sample -- Sample name
+        json_files -- List of bs_call JSON files for the sample
+        output_dir -- Output directory to store HTML reports
+        name_project -- Project name
+        index_html_document -- Index HTML document (parent of the sample pages)
+        
+        returns -- sample links for the index table, stats objects, summary fields and list of sample pages to be created
+    """
+    #Parsing json file
+    readLevelStats = ReadsAndBases()
+    baseLevelStats = BaseLevel()
+    #Coverages
+    allCoverage = Coverage(concept="All",yLabel="#Sites",pngFile=os.path.join(output_dir,'IMG',"{}_coverage_all.png".format(sample)))
+    variantCoverage = Coverage(concept="Variants",yLabel="#SNPs",pngFile=os.path.join(output_dir,'IMG',"{}_coverage_variants.png".format(sample)))
+    dbSnpCoverage = Coverage(concept="dbSnp",yLabel="#SNPs",pngFile=os.path.join(output_dir,'IMG',"{}_coverage_dbsnp.png".format(sample)))
+    refCpGcoverage = Coverage(concept="RefCpG",yLabel="#CpGs",pngFile=os.path.join(output_dir,'IMG',"{}_coverage_refCpG.png".format(sample)))
+    refCpGInfCoverage = Coverage(concept="RefCpGInf",yLabel="#CpGs",pngFile=os.path.join(output_dir,'IMG',"{}_coverage_refCpGInf.png".format(sample)))
+    nonRefCpGcoverage = Coverage(concept="NonRefCpG",yLabel="#CpGs",pngFile=os.path.join(output_dir,'IMG',"{}_coverage_nonRefCpG.png".format(sample)))
+    nonRefCpGinfCoverage = Coverage(concept="NonRefCpGInf",yLabel="#CpGs",pngFile=os.path.join(output_dir,'IMG',"{}_coverage_nonRefCpGinf.png".format(sample)))
+    #GC Coverage
+    gcCoverage = GCcoverage("%s/IMG/%s_gc_coverage.png" %(output_dir,sample))
+    #TotalStats
+    totalStats = TotalStats()
+    #Quality
+    qualityAll = Quality(concept="All",yLabel="#Sites",pngFile=os.path.join(output_dir,'IMG',"{}_quality_all.png".format(sample)))
+    qualityVariant = Quality(concept="Variants",yLabel="#SNPs",pngFile=os.path.join(output_dir,'IMG',"{}_quality_variant.png".format(sample)))
+    qualityRefCpG = Quality(concept="RefCpG",yLabel="#CpGs",pngFile=os.path.join(output_dir,'IMG',"{}_quality_refcpg.png".format(sample)))
+    qualityNonRefCpG = Quality(concept="NonRefCpG",yLabel="#CpGs",pngFile=os.path.join(output_dir,'IMG',"{}_quality_nonRefCpg.png".format(sample)))
+    #QC Distributions
+    fsVariant = QCDistribution(concept="FisherStrandVariant",typeDistribution="FisherStrand",typeBaseLocation="",pngFile=os.path.join(output_dir,'IMG',"{}_fs_variant.png".format(sample)))
+    fsVariant.setAxisXLabel(newLabel="Fisher Strand Phred scale probability")
+    qdVariant = QCDistribution(concept="QualityByDepthVariant",typeDistribution="QualityByDepth",typeBaseLocation="Variant",pngFile=os.path.join(output_dir,'IMG',"{}_qd_variant.png".format(sample)))
+    qdNonVariant = QCDistribution(concept="QualityByDepthNonVariant",typeDistribution="QualityByDepth",typeBaseLocation="NonVariant",pngFile=os.path.join(output_dir,'IMG',"{}_qd_nonvariant.png".format(sample)))
+    rmsmqVariant = QCDistribution(concept="RMSMappingQualityVariant",typeDistribution="RMSMappingQuality",typeBaseLocation="Variant",pngFile=os.path.join(output_dir,'IMG',"{}_rmsmq_variant.png".format(sample)))
+    rmsmqNonVariant = QCDistribution(concept="RMSMappingQualityNonVariant",typeDistribution="RMSMappingQuality",typeBaseLocation="NonVariant",pngFile=os.path.join(output_dir,'IMG',"{}_rmsmq_nonvariant.png".format(sample)))
+    #VCF Filter Stats
+    vcfFilterStats = VCFFilterStats()
+    #Mutations
+    mutationsStats = Mutations("Mutations")
+    #Methylation
+    methylationAllRefCpG = Methylation("AllRefCpG")
+    methylationPassRefCpG = Methylation("PassedRefCpG")
+    methylationNonRefCpG = Methylation("AllNonRefCpG")
+    methylationPassNonRefCpG = Methylation("PassedNonRefCpG")
+    #NonCpGReadProfile
+    nonCpGReadProfile = NonCpGReadProfile(os.path.join(output_dir,'IMG',"{}_nonCpgReadProfile.png".format(sample)))
+    #SummaryMethylation
+    summaryMethylation = SummaryMethylation() 
+    
+    #Load al json files
+    for json_file in json_files:
+        with open(json_file, 'r') as file_json:
+            try:
+                data = json.load(file_json)
+            
+                readLevelStats.add(data["filterStats"]["ReadLevel"])
+                baseLevelStats.add(data["filterStats"]["BaseLevel"])
+                #Coverages
+                allCoverage.add(data["totalStats"]["coverage"]["All"])
+                variantCoverage.add(data["totalStats"]["coverage"]["Variant"])
+                if "dbSNP" in data["totalStats"]["coverage"]:
+                    dbSnpCoverage.add(data["totalStats"]["coverage"]["dbSNP"])
+                refCpGcoverage.add(data["totalStats"]["coverage"]["RefCpG"])
+                refCpGInfCoverage.add(data["totalStats"]["coverage"]["RefCpGInf"])
+                nonRefCpGcoverage.add(data["totalStats"]["coverage"]["NonRefCpG"])
+                nonRefCpGinfCoverage.add(data["totalStats"]["coverage"]["NonRefCpGInf"])
+                #GC Coverage
+                gcCoverage.add(data["totalStats"]["coverage"]["GC"])
+                #TotalStats
+                totalStats.add(data["totalStats"])
+                #Quality
+                qualityAll.add(data["totalStats"]["quality"]["All"])
+                qualityVariant.add(data["totalStats"]["quality"]["Variant"])
+                qualityRefCpG.add(data["totalStats"]["quality"]["RefCpG"])
+                qualityNonRefCpG.add(data["totalStats"]["quality"]["NonRefCpG"])
+                #QC Distributions
+                fsVariant.add(data["totalStats"]["QCDistributions"]["FisherStrand"])
+                qdVariant.add(data["totalStats"]["QCDistributions"]["QualityByDepth"])
+                qdNonVariant.add(data["totalStats"]["QCDistributions"]["QualityByDepth"])
+                rmsmqVariant.add(data["totalStats"]["QCDistributions"]["RMSMappingQuality"])
+                rmsmqNonVariant.add(data["totalStats"]["QCDistributions"]["RMSMappingQuality"])
+                #VCF Filter Stats
+                vcfFilterStats.add(data["totalStats"]["VCFFilterStats"])                
+                #Mutations
+                mutationsStats.add(data["totalStats"]["mutations"])              
+                #Methylation
+                methylationAllRefCpG.add(data["totalStats"]["methylation"]["AllRefCpg"])
+                methylationPassRefCpG.add(data["totalStats"]["methylation"]["PassedRefCpg"])
+                methylationNonRefCpG.add(data["totalStats"]["methylation"]["AllNonRefCpg"])
+                methylationPassNonRefCpG.add(data["totalStats"]["methylation"]["PassedNonRefCpg"])
+                #NonCpGReadProfile
+                nonCpGReadProfile.add(data["totalStats"]["methylation"]["NonCpGreadProfile"])
+                
+            except ValueError as e:
+                print('problem reading JSON file {})'.format(json_file))
+                print(e)
+                pass # invalid json
+
+    #Prepare plot for Methylation levels
+    plotMethylation = PlotMethylationLevels(concept="Methylation Levels",pngFile=os.path.join(output_dir,'IMG',"{}_methylation_levels.png".format(sample)),
+                                            meth_list=[methylationAllRefCpG,methylationPassRefCpG,methylationNonRefCpG,methylationPassNonRefCpG])
+
+    #Get Table Summary
+    summaryMethylation.setData(concept = "AllRefCpg",values=methylationAllRefCpG.methylation_cpgs)
+    summaryMethylation.setData(concept = "PassedRefCpg",values=methylationPassRefCpG.methylation_cpgs)
+    summaryMethylation.setData(concept = "AllNonRefCpg",values=methylationNonRefCpG.methylation_cpgs)
+    summaryMethylation.setData(concept = "PassedNonRefCpg",values=methylationPassNonRefCpG.methylation_cpgs)
+    
+    #Sample Summary 
+    #Prepare GC Values for plotting and getting GC Correlation
+    gcCoverage.selectDataToPlot()                                              
+    samples_summary = SummarySample(sampleName=sample,readLevelStats=readLevelStats,baseLevelStats=baseLevelStats,gcCoverage=gcCoverage,totalStats=totalStats,variantCoverage=variantCoverage,
+                                    mutationStats=mutationsStats,methylationPassRefCpg=methylationPassRefCpG,refCpgCoverage=refCpGcoverage)  
+                                   
+    sample_stats_summaries = samples_summary.getTable()
+    
+    #DataSet Per Samples
+    sample_stats = {"mappingCoverage": [readLevelStats,baseLevelStats,allCoverage,gcCoverage,qualityAll,nonCpGReadProfile],
+                        "calls": [totalStats,vcfFilterStats,variantCoverage,dbSnpCoverage,qualityVariant,
+                        [fsVariant,qdVariant,qdNonVariant,rmsmqVariant,rmsmqNonVariant],
+                        mutationsStats],
+                        "methylation": [totalStats,refCpGcoverage,refCpGInfCoverage,nonRefCpGcoverage,nonRefCpGinfCoverage,
+                        qualityRefCpG,qualityNonRefCpG,plotMethylation,summaryMethylation]
+                        }
+    #1.1 Create Mapping and Coverage Statistics
+    mappingCoverageHtml = os.path.join(output_dir,"{}_mapping_coverage.html".format(sample))
+    parent_name = "%s/mapping_coverage" %(name_project)
+    sample_mapping_coverage = HtmlMappingCoverage(html_file_name=mappingCoverageHtml,current_name=sample,parent_name=parent_name,parent_document=index_html_document)
+    #1.1.2 Setup mapping coverage report
+    sample_mapping_coverage.configureStats(stats_vector=sample_stats["mappingCoverage"])
+    #1.2 Create Bs-Genotype Calls Report
+    variantsHtml = os.path.join(output_dir,"{}_variants.html".format(sample))
+    parent_variants = os.path.join(name_project,'variants')
+    sample_variants = HtmlBsGenotypeCalls(html_file_name=variantsHtml,current_name=sample,parent_name=parent_variants,parent_document=index_html_document)
+    #1.2.1 Setup Variants Report
+    sample_variants.configureStats(stats_vector=sample_stats["calls"])
+    #1.3 Create Methylation Statitics
+    methylationHtml = os.path.join(output_dir,"{}_methylation.html".format(sample))
+    parent_methylation = os.path.join(name_project,'methylation')
+    sample_methylation = HtmlMethylation(html_file_name=methylationHtml,current_name=sample,parent_name=parent_methylation,parent_document=index_html_document)
+    #1.3.1 Setup Methylation Report
+    sample_methylation.configureStats(stats_vector=sample_stats["methylation"])
+    #1.4 Vector of links to create index Table
+    sample_links = [sample,os.path.basename(mappingCoverageHtml),os.path.basename(variantsHtml),os.path.basename(methylationHtml)]
+
+    return sample_links, sample_stats, sample_stats_summaries, [sample_mapping_coverage, sample_variants, sample_methylation]
+
+def loadSampleStats(sample,json_files,output_dir,name_project,index_html_document):
+    """ Get the statistics for the reports of a sample.
+    
+        The result of aggregateSampleStats() is kept in output_dir/CACHE, and reused while the paths, modification times
+        and sizes of the bs_call JSON files are unchanged, so that the JSON files of a sample are only read again when they change.
+        The cache is kept per sample rather than per pool: the stats classes accumulate the values from the JSON files but 
+        cannot combine two accumulated objects, so a change to any pool means reading all of the sample's JSON files again.
+        
+        returns -- result of aggregateSampleStats() and True if it was taken from the cache
+    """
+    cache_file = os.path.join(output_dir,'CACHE',"{}.pickle".format(sample))
+    key = [stats_cache_version, name_project]
+    for json_file in json_files:
+        st = os.stat(json_file)
+        key.append((json_file,st.st_mtime_ns,st.st_size))
+    stats = readCacheFile(cache_file, key)
+    if stats != None:
+        return stats, True
+    stats = aggregateSampleStats(sample,json_files,output_dir,name_project,index_html_document)
+    writeCacheFile(cache_file, key, stats)
+    return stats, False
+
+def needPages(pages, cached):
+    """ The pages of a sample have to be created unless its statistics came from the cache and the pages, and the 
+        plots they show, already exist """
+    if not cached:
+        return True
+    for page in pages:
+        if not htmlPageComplete(page.html_file_name):
+            return True
+    return False
+
+def createReportPage(page):
+    """ Create a sample report page (run as a task in the report process pool) """
+    page.createPage()
+
 def buildBscallReports(inputs=None,output_dir=None,name=None,threads=1):
     """ Build variant report.
     
@@ -698,6 +698,9 @@ def buildBscallReports(inputs=None,output_dir=None,name=None,threads=1):
     if not os.path.exists("%s/SPHINX/" %(output_dir)):
         os.makedirs("%s/SPHINX/" %(output_dir))
 
+    if not os.path.exists("%s/CACHE/" %(output_dir)):
+        os.makedirs("%s/CACHE/" %(output_dir))
+
     #Proces list chromosome files
     dict_samples = {}
     dict_samples_summaries = {}
@@ -707,18 +710,25 @@ def buildBscallReports(inputs=None,output_dir=None,name=None,threads=1):
     sample_link_list = []
 
     if threads > 1:
-        sample_list = []
+        #Samples are aggregated and pages are created as separate tasks, at most threads at a time.  The pages
+        #of a sample are submitted as soon as its statistics are available (unless they are up to date)
+        sample_links = {}
+        with ProcessPoolExecutor(max_workers=threads) as executor:
+            aggregations = {}
+            for sample, json_files in inputs.items():
+                future = executor.submit(loadSampleStats,sample,json_files,output_dir,name,htmlIndexBsCall.index_html_document)
+                aggregations[future] = sample
+            pages = []
+            for future in as_completed(aggregations):
+                sample = aggregations[future]
+                (sample_links[sample], dict_samples[sample], dict_samples_summaries[sample], page_list), cached = future.result()
+                if needPages(page_list, cached):
+                    for page in page_list:
+                        pages.append(executor.submit(createReportPage,page))
+            for future in pages:
+                future.result()
         for sample in inputs:
-            sample_list.append(sample)
-        sample_lock = th.Lock()
-        store_lock = th.Lock()
-        thread_list = []
-        for ix in range(threads):
-            build_thread = BuildBsCallReportThread(ix, sample_list, sample_link_list, sample_lock, store_lock, htmlIndexBsCall)
-            build_thread.start()
-            thread_list.append(build_thread)
-        for thread in thread_list:
-            thread.join()
+            sample_link_list.append(sample_links[sample])
     else:
         for sample in inputs:
             ret = htmlIndexBsCall.buildSampleBscallReport(sample)
@@ -405,8 +405,20 @@ class BaseLevel(StatsMother):
         vector_table.append(["LowQuality","%i" %(self.data["LowQuality"]),"%.2f %%" %(self.getPercentage(self.data["LowQuality"],total_bases))])
         return vector_table
         
+def growRows(array, rows):
+    """Return array with at least rows rows (the new rows are zero).  The size is at least 
+    doubled when the array grows so that the cost of growing is amortized over the additions"""
+    if rows <= array.shape[0]:
+        return array
+    new_array = np.zeros((max(rows, 2 * array.shape[0]),) + array.shape[1:], dtype=array.dtype)
+    new_array[:array.shape[0]] = array
+    return new_array
+
 class DistributionPlot(PlotMother,StatsMother):
-    """Manages Distribution Plots"""
+    """Manages Distribution Plots
+    
+       The distribution is kept as a dense histogram (a NumPy array indexed by value) 
+    """
     
     def __init__(self,concept,pngFile):
         """
@@ -417,41 +429,53 @@ class DistributionPlot(PlotMother,StatsMother):
         """
         PlotMother.__init__(self,pngFile=pngFile,concept=concept)
         self.percentage_limit_tail = 95
-        self.value_locations = {}
-                
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.bins = 0
+        
+    def addCounts(self,values,counts):
+        """
+            Add counts to the histogram
+            
+            values - Vector of values (histogram bins), without repeats
+            counts - Vector of counts for each value
+        """
+        values = np.asarray(values, dtype=np.int64)
+        if len(values) > 0:
+            top = int(values.max()) + 1
+            self.counts = growRows(self.counts, top)
+            self.bins = max(self.bins, top)
+            self.counts[values] += np.asarray(counts, dtype=np.int64)
+        self.setHaveCounts(True)
+        
+    def getHistogram(self):
+        """Vector of counts for values from 0 to the maximum value seen"""
+        return self.counts[:self.bins]
+        
     def getVectorToPlot(self,cleanTail=False):
-        """From Dictionary Get Vector of Y values to be bar plotted 
+        """From the histogram get Vector of Y values to be bar plotted 
         
            cleanTail - if true cleans all registers that does not represents the 95% of the data        
         """
-        vector_plot = []
-        
-        maximumX = 0
-         
+        histogram = self.getHistogram()
+        maximumX = self.bins - 1
         if cleanTail:
-             #1. Get Total Number of Sites
-             totalSites = 0
-             for value in self.value_locations:
-                 totalSites += self.value_locations[value]
-             #2.Get Maximum X 95%
-             currentSites = 0
-             for value in self.value_locations:
-                 currentSites += self.value_locations[value]
-                 maximumX = value
-                                                  
-                 if self.getPercentage(currentSites,totalSites) > self.percentage_limit_tail:
-                     if maximumX == 0:
-                         maximumX = 1
-                     break
-        else:
-            list_keys = sorted(self.value_locations.keys())
-            maximumX = list_keys[-1]
-                   
-        for x in range(0,(maximumX+1)):
-            if x in self.value_locations:
-                vector_plot.append(self.value_locations[x])
-            else:
-                vector_plot.append(0)
+            #Get Maximum X where the cumulative number of sites goes over the limit
+            cumulative = np.cumsum(histogram)
+            if len(cumulative) > 0 and cumulative[-1] > 0:
+                above = np.flatnonzero(cumulative / float(cumulative[-1]) * 100 > self.percentage_limit_tail)
+                if len(above) > 0:
+                    maximumX = max(int(above[0]), 1)
+        return self.getUnifiedVectorToPlot(maximumX + 1)
+        
+    def getUnifiedVectorToPlot(self,locationsToRecover):
+        """From the histogram get Vector of Y values to be bar plotted
+           Method designed to have the same bar for both plots of GoodnessOfFit Variants and NonVariants
+        
+           locationsToRecover - Total number of locations to recover from the histogram
+        """
+        vector_plot = np.zeros(locationsToRecover, dtype=np.int64)
+        histogram = self.getHistogram()[:locationsToRecover]
+        vector_plot[:len(histogram)] = histogram
         return vector_plot
         
 class Coverage(DistributionPlot):
@@ -476,14 +500,7 @@ class Coverage(DistributionPlot):
             
             values - Dictionary of coverage and bases
         """
-        for key in values:
-            coverage = int(key)
-            if coverage in self.value_locations:
-                self.value_locations[coverage] += values[key]
-            else:
-                self.value_locations[coverage] = values[key]
-        
-        self.setHaveCounts(True)        
+        self.addCounts(np.fromiter(map(int, values), np.int64, len(values)), list(values.values()))
                 
     def plot(self):
         """Builds a Coverage Plot and print it to a file"""
@@ -508,14 +525,11 @@ class Coverage(DistributionPlot):
         
     def getMean(self):
         """
-            Get Mean Value from value_locations
+            Get Mean Value from the histogram
         """
-        total_number_of_coverage_events = 0
-        total_number_of_bases = 0
-        for coverage in self.value_locations:
-            total_number_of_coverage_events += coverage * self.value_locations[coverage]
-            total_number_of_bases += self.value_locations[coverage]
-            
+        histogram = self.getHistogram()
+        total_number_of_coverage_events = int(np.dot(np.arange(len(histogram)), histogram))
+        total_number_of_bases = int(histogram.sum())
         return float(total_number_of_coverage_events)/float(total_number_of_bases)
         
     def getTotalMinimumCoverage(self, minimum_coverage = 0):
@@ -524,11 +538,7 @@ class Coverage(DistributionPlot):
             
             minimum_coverage -- Minimum coverage to count total number of bases
         """
-        total_counted_bases = 0
-        for coverage in self.value_locations:
-            if coverage >= minimum_coverage:
-                total_counted_bases += self.value_locations[coverage]
-        return total_counted_bases
+        return int(self.getHistogram()[max(0, minimum_coverage):].sum())
         
 class Quality(DistributionPlot):
     """ Class quality """
@@ -546,34 +556,25 @@ class Quality(DistributionPlot):
         
     def add(self,values):
         """
-            Add dictionary of new coverage values
+            Add vector of new quality values
             
-            values - Dictionary of coverage and bases
+            values - Vector of sites for each quality
         """
-        quality = 0
-        for sites in values:
-            if quality in self.value_locations:
-                self.value_locations[quality] += sites
-            else:
-                self.value_locations[quality] = sites
-            quality = quality + 1
-        
-        self.setHaveCounts(True)  
+        self.addCounts(np.arange(len(values)), values)
         
     def plot(self):
         """Builds a Coverage Plot and print it to a file"""
         #Number of Bins
         bins = 25
         
-        #Create vector of Y values
-        yValues = [0 for x in range(bins)]
         #Quality Sites
         quality_sites = self.getVectorToPlot(False)
         total_quality = len(quality_sites)        
         
-        for quality in range(0,total_quality):
-            index_for_quality = int ((float(bins)/total_quality)*(quality)) 
-            yValues[index_for_quality] = yValues[index_for_quality] + quality_sites[quality]
+        #Create vector of Y values, adding the sites for each quality to its bin
+        yValues = np.zeros(bins, dtype=np.int64)
+        index_for_quality = ((float(bins)/total_quality)*np.arange(total_quality)).astype(int)
+        np.add.at(yValues, index_for_quality, quality_sites)
             
         #Create Vector of X ticks
         xValues = [(total_quality/bins) * x for x in range(bins)]
@@ -998,7 +999,8 @@ class GCcoverage(StatsMother,PlotMother):
     def __init__(self,pngFile):
         """ Initialize GCCoverage Values """
         PlotMother.__init__(self,pngFile=pngFile,concept="")
-        self.coverage_gc_bases = {}
+        self.coverage_gc_bases = np.zeros((0, 101), dtype=np.int64)
+        self.coverages = 0
         self.x_vector = []
         self.y_vector = []
         self.z_vector = []
@@ -1007,37 +1009,36 @@ class GCcoverage(StatsMother,PlotMother):
         """
             Add Values
             
-            values - GC/Coverage Value
-        """
-        for coverage in values:
-            int_coverage = int(coverage)
-            if int_coverage in self.coverage_gc_bases:
-                for i in range(len(values[coverage])):
-                    self.coverage_gc_bases[int_coverage][i] += values[coverage][i]
-            else:
-                self.coverage_gc_bases[int_coverage] = values[coverage]
+            values - GC/Coverage Value (dictionary of coverage and vector of bases for each GC%)
+        """
+        if len(values) > 0:
+            rows = np.fromiter(map(int, values), np.int64, len(values))
+            top = int(rows.max()) + 1
+            self.coverage_gc_bases = growRows(self.coverage_gc_bases, top)
+            self.coverages = max(self.coverages, top)
+            self.coverage_gc_bases[rows] += np.array(list(values.values()), dtype=np.int64)
         self.setHaveCounts(True)
                 
     def cleanNotSignificantTail(self):
         """
            Clean from GC/Coverage values the tail of coverages with low number of bases, less than 5%
         """
-        #1. Get Total Number of bases
-        totalBases = 0
-        for coverage in self.coverage_gc_bases:
-            totalBases += self.getTotalSumatory(self.coverage_gc_bases[coverage])
+        #1. Get Number of bases up to (but not including) each coverage
+        bases = self.getMatrix().sum(axis = 1)
+        previousBases = np.cumsum(bases) - bases
+        totalBases = int(bases.sum())
 
-        #2. Get Until 95 and Cut
-        new_coverage_gc_bases = {}
-        totalProcessedCoverages =  0                
-        for coverage in sorted(self.coverage_gc_bases):
-            if self.getPercentage(totalProcessedCoverages,totalBases) < 95:
-                new_coverage_gc_bases [coverage] = self.coverage_gc_bases[coverage]
-                totalProcessedCoverages += self.getTotalSumatory(new_coverage_gc_bases[coverage])
-            else:
-                break                       
-                        
-        self.coverage_gc_bases = new_coverage_gc_bases
+        #2. Cut at the first coverage reached after 95% of the bases
+        if totalBases > 0:
+            cut = np.flatnonzero(previousBases / float(totalBases) * 100 >= 95)
+            if len(cut) > 0:
+                self.coverages = int(cut[0])
+        
+    def getMatrix(self):
+        """
+            Matrix of bases for each coverage (rows, from 0 to the maximum coverage) and GC% (columns, from 0 to 100)
+        """
+        return self.coverage_gc_bases[:self.coverages]
         
     def selectDataToPlot(self):
         """
@@ -1048,21 +1049,12 @@ class GCcoverage(StatsMother,PlotMother):
         #Inspired in: https://stackoverflow.com/questions/22712219/heat-map-using-matplotlib
         #1.Vector To Represent X axis. GC Coverage From 0% to 100%
         x_gc_percentage = range(101)
-        #2.Vector to Represent Y axis. Coverage From 0 to len keys on coverage_gc_bases
-        list_keys = sorted(self.coverage_gc_bases.keys())
-        maximumCoverage = list_keys[-1]
-        y_coverage = range(maximumCoverage + 1)
+        #2.Vector to Represent Y axis. Coverage From 0 to the maximum coverage
+        y_coverage = range(self.coverages)
         #3.Form matrix for the Heatmap
-        z = []
-        for coverage in y_coverage:
-            if coverage in self.coverage_gc_bases:
-                z.append(self.coverage_gc_bases[coverage])
-            else:
-                z.append([0 for x in range(101)])
-                
         self.x_vector = x_gc_percentage
         self.y_vector = y_coverage
-        self.z_vector = z
+        self.z_vector = self.getMatrix()
                 
     def plot(self):
         """
@@ -1089,24 +1081,18 @@ class GCcoverage(StatsMother,PlotMother):
             
             returns pearson correlation or -2 if it was not possible
         """
-        #Estimate Sx, Sx2, Sy, Sy2,n
-        yLen = len(self.y_vector)
-        xLen = len(self.x_vector)
-        sx = 0
-        sx2 = 0
-        sy = 0
-        sy2 = 0
-        sxy = 0
-        n = 0
-        for y in range(0,yLen):
-            for x in range(0,xLen):
-                z = self.z_vector[y][x]               
-                sx += x*z
-                sx2 += (x*x)*z
-                sy += y*z
-                sy2 += (y*y)*z
-                sxy += z*x*y
-                n += z
+        #Estimate Sx, Sx2, Sy, Sy2,n from the marginal distributions of the matrix, and Sxy as y'Zx
+        z = np.asarray(self.z_vector, dtype=np.int64).reshape(len(self.y_vector), len(self.x_vector))
+        x = np.arange(len(self.x_vector), dtype=np.int64)
+        y = np.arange(len(self.y_vector), dtype=np.int64)
+        zx = z.sum(axis = 0)
+        zy = z.sum(axis = 1)
+        sx = int(np.dot(zx, x))
+        sx2 = int(np.dot(zx, x * x))
+        sy = int(np.dot(zy, y))
+        sy2 = int(np.dot(zy, y * y))
+        sxy = int(np.dot(y, np.dot(z, x)))
+        n = int(zx.sum())
         #Estimate correlation
         corr = -2
         if n != 0:
@@ -1176,20 +1162,11 @@ class QCDistribution(DistributionPlot,StatsMother):
             
             values - QCDistributions Value
         """
-        for value in values:
-            int_value = int(value)
-            if int_value in self.value_locations:
-                if self.type_base_location == "":
-                    self.value_locations[int_value] += values[value] 
-                else:
-                    self.value_locations[int_value] += values[value][self.type_base_location]
-            else:
-                if self.type_base_location == "":
-                    self.value_locations[int_value] = values[value]
-                else:
-                    self.value_locations[int_value] = values[value][self.type_base_location]
-                       
-        self.setHaveCounts(True)
+        if self.type_base_location == "":
+            counts = list(values.values())
+        else:
+            counts = [v[self.type_base_location] for v in values.values()]
+        self.addCounts(np.fromiter(map(int, values), np.int64, len(values)), counts)
         
     def getBarColor(self):
         """Get color according to the type of distribution"""
@@ -1226,20 +1203,6 @@ class QCDistribution(DistributionPlot,StatsMother):
 #            locationsToRecover - New Locations Value
 #        """            
 #        self.gof_locations = locationsToRecover
-                 
-    def getUnifiedVectorToPlot(self,locationsToRecover):
-        """From Dictionary Get Vector of Y values to be bar plotted
-           Method designed to have the same bar for both plots of GoodnessOfFit Variants and NonVariants
-        
-           locationsToRecover - Total number of locations to recover from the value_locations
-        """
-        vector_plot = []
-        for x in range(0,locationsToRecover):
-            if x in self.value_locations:
-                vector_plot.append(self.value_locations[x])
-            else:
-                vector_plot.append(0)
-        return vector_plot       
                        
     def plot(self):
         """Builds a QCDistribution Plot and print it to a file"""
@@ -1,12 +1,11 @@
 #!/usr/bin/env python
 """gemBS commands"""
 import argparse
-import pkg_resources
 import os
 import sys
 
 from argparse import RawTextHelpFormatter
-from .utils import CommandException
+from .utils import CommandException, packageResource
 from .production import *
 from .database import database
 
@@ -97,13 +96,13 @@ def gemBS_main():
         parser.add_argument('-j', '--json-file', dest="json", help="Location of gemBS JSON file")
         parser.add_argument('-d', '--dir', dest="wd", metavar="DIR",help="Set working directory")
         
-        if pkg_resources.resource_exists("gemBS", "bin"):
-            f = pkg_resources.resource_filename("gemBS", "bin")
-        path = os.environ.get("PATH")
-        if path == None:
-            path = f
-        else:
-            path = f + ":" + path
+        f = packageResource("bin")
+        if f != None:
+            path = os.environ.get("PATH")
+            if path == None:
+                path = f
+            else:
+                path = f + ":" + path
             os.environ["PATH"] = path
             
         commands = {
@@ -114,9 +113,11 @@ def gemBS_main():
             "call" : MethylationCall,
             "merge-bcfs" : BsCallConcatenate,
             "extract": MethylationFiltering,
+            "run": RunPipeline,
             "map-report" : MappingReports,
             "call-report" : VariantsReports,
-            "db-sync": dbSync
+            "db-sync": dbSync,
+            "binaries": Binaries
         }
         instances = {}
 
@@ -150,7 +151,7 @@ def gemBS_main():
         if args.command == None:
             parser.print_help(sys.stderr)
         else:
-            if not (args.command == 'prepare' or args.json):
+            if not (args.command in ('prepare', 'binaries') or args.json):
                 raise CommandException("gemBS JSON file not found.")
             try:
                 instances[args.command].run(args)
@@ -4,8 +4,13 @@ import re
 import fnmatch
 import logging
 import json
+import math
+import time
+import uuid
+import socket
+import heapq
 import threading as th
-from .utils import CommandException
+from .utils import CommandException, contigRegion
 
 ## Global register for db commands that must be performed if
 ## processes are aborted
@@ -16,6 +21,13 @@ class database(sqlite3.Connection):
     _mem_db = False
     _db_com_register = {}
     _lock = th.Lock()
+    _tx_lock = th.RLock()
+    _busy_timeout = 60
+    _lease_time = 600
+    _journal_mode = 'auto'
+    _owner = None
+    _heartbeat = None
+    _heartbeat_stop = None
     
     @classmethod
     def setup(cls, json_data):
@@ -23,6 +35,8 @@ class database(sqlite3.Connection):
         config = cls.json_data.config
         cls.db_name = config['DEFAULT'].get('gembs_dbfile', 'file:gemBS?mode=memory&cache=shared')
         cls._mem_db = (cls.db_name.startswith('file:'))
+        cls._lease_time = int(config['DEFAULT'].get('lease_time', cls._lease_time))
+        cls._journal_mode = str(config['DEFAULT'].get('db_journal_mode', 'auto')).lower()
         
     @classmethod
     def mem_db(cls):
@@ -44,18 +58,26 @@ class database(sqlite3.Connection):
 
     @classmethod
     def cleanup_db_com(cls):
+        if cls._heartbeat != None:
+            cls._heartbeat_stop.set()
         if cls.db_name:
             if not cls._mem_db:
                 db = database()
+                c = db.cursor()
                 for key, v in cls._db_com_register.items():
-                    db.isolation_level = None
-                    c = db.cursor()
-                    c.execute("BEGIN EXCLUSIVE")
+                    c.execute("BEGIN IMMEDIATE")
                     c.execute(v[0])
-                    c.execute("COMMIT")
+                    db.commit()
                     if v[1]:
                         for f in v[1]:
                             if os.path.exists(f): os.remove(f)
+                # Hand back anything we still hold so other workers do not have to wait for the lease to expire
+                if cls._heartbeat != None:
+                    c.execute("BEGIN IMMEDIATE")
+                    for tab, fname, prev_status in c.execute("SELECT tab, filepath, prev_status FROM claims WHERE owner = ?", (cls.owner(),)).fetchall():
+                        c.execute("UPDATE {} SET status = ? WHERE filepath = ?".format(tab), (prev_status, fname))
+                    c.execute("DELETE FROM claims WHERE owner = ?", (cls.owner(),))
+                    db.commit()
                 db.close()
             else:
                 for key, v in cls._db_com_register.items():
@@ -63,7 +85,37 @@ class database(sqlite3.Connection):
                         for f in v[1]:
                             if os.path.exists(f): os.remove(f)
             cls._db_com_register = {}
-               
+
+    @classmethod
+    def owner(cls):
+        """Identifier used to mark the claims made by this process (host:pid:random tag)"""
+        if cls._owner == None:
+            cls._owner = "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        return cls._owner
+
+    @classmethod
+    def _start_heartbeat(cls):
+        # Leases only have a meaning for the disk based db; the in memory db dies with the process
+        if cls._mem_db:
+            return
+        cls._lock.acquire()
+        if cls._heartbeat == None:
+            cls._heartbeat_stop = th.Event()
+            cls._heartbeat = th.Thread(target = cls._heartbeat_loop, name = 'gemBS-lease-heartbeat', daemon = True)
+            cls._heartbeat.start()
+        cls._lock.release()
+
+    @classmethod
+    def _heartbeat_loop(cls):
+        interval = max(1.0, cls._lease_time / 4.0)
+        while not cls._heartbeat_stop.wait(interval):
+            try:
+                db = database()
+                db.renew_leases()
+                db.expire_leases()
+                db.close()
+            except sqlite3.Error as e:
+                logging.warning("Could not renew gemBS job leases: {}".format(e))
 
     def __init__(self, json_data = None, sync = False):
         newdb = False
@@ -72,22 +124,249 @@ class database(sqlite3.Connection):
             newdb = True
         if database._mem_db:
             sqlite3.Connection.__init__(self, database.db_name, uri = True, timeout = 5)
+            # Readers should not take shared cache table locks, otherwise they block the writers
+            self.execute("PRAGMA read_uncommitted = 1")
             if newdb:
                 self.create_tables()
                 self.check()
         else:
-            sqlite3.Connection.__init__(self, database.db_name)
+            sqlite3.Connection.__init__(self, database.db_name, timeout = database._busy_timeout)
+            self.set_pragmas()
             if sync:
                 self.create_tables()
                 self.check(sync)
+            elif newdb:
+                self.create_tables()
+                self.expire_leases()
+
+    def begin(self):
+        """Start a write transaction on the connection.  For the disk based db
+        waiting for the lock is left to sqlite (using the busy timeout).  The in
+        memory db uses a shared cache where lock conflicts are reported immediately, so
+        there the writers from the different threads are serialized in python.
+        The transaction must be finished with end()"""
+        if database._mem_db:
+            database._tx_lock.acquire()
+        try:
+            if self.in_transaction:
+                self.commit()
+            self.execute("BEGIN IMMEDIATE")
+        except:
+            if database._mem_db:
+                database._tx_lock.release()
+            raise
+
+    def end(self, ok = True):
+        """Commit (or if ok is False, roll back) a transaction started with begin()"""
+        try:
+            if ok:
+                self.commit()
+            else:
+                self.rollback()
+        finally:
+            if database._mem_db:
+                database._tx_lock.release()
             
+    def claim(self, table, filepath, status = 3, prev_status = 0):
+        """Try to claim a job (row in the mapping, calling or extract tables)
+        for this process.  The claim is made using a single conditional UPDATE
+        that changes the status from prev_status to status, so that if several
+        workers compete for the same job only one can succeed.  On success a lease
+        is registered in the claims table and True is returned.  The lease is
+        kept alive by a heartbeat thread; if the worker dies the lease expires and
+        the status reverts to prev_status.
+
+        table       -- table holding the job
+        filepath    -- key of the job
+        status      -- status to set
+        prev_status -- status the job must currently have
+        """
+        self.begin()
+        ok = False
+        try:
+            c = self.cursor()
+            c.execute("UPDATE {} SET status = ? WHERE filepath = ? AND status = ?".format(table), (status, filepath, prev_status))
+            if c.rowcount == 1:
+                c.execute("REPLACE INTO claims VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (table, filepath, database.owner(), socket.gethostname(), os.getpid(), time.time() + database._lease_time, prev_status))
+                ok = True
+        except:
+            self.end(False)
+            raise
+        self.end()
+        if ok:
+            database._start_heartbeat()
+        return ok
+
+    def release(self, table, filepath, status, extra = None):
+        """Set the final status for a job claimed with claim() and drop the lease.
+        Any additional (sql, parameters) pairs in extra are executed in the same transaction"""
+        self.begin()
+        try:
+            c = self.cursor()
+            if extra:
+                for com, par in extra:
+                    c.execute(com, par)
+            c.execute("UPDATE {} SET status = ? WHERE filepath = ?".format(table), (status, filepath))
+            c.execute("DELETE FROM claims WHERE tab = ? AND filepath = ?", (table, filepath))
+        except:
+            self.end(False)
+            raise
+        self.end()
+
+    def add_contig_cost(self, contigs, elapsed, reads):
+        """Record the wall time and number of reads of a completed bs_call job.  contigs maps
+        each contig of the pool to a tuple (bases called, contig length).  The job totals are shared 
+        out between the contigs in proportion to the bases called, and a job that called only part
+        of a contig counts as the same fraction of a sample"""
+        total = sum([v[0] for v in contigs.values()])
+        if total <= 0:
+            return
+        self.begin()
+        try:
+            for ctg, (called, size) in contigs.items():
+                f = called / total
+                self.execute("INSERT OR IGNORE INTO contig_cost VALUES (?, ?, 0, 0, 0)", (ctg, size))
+                self.execute("UPDATE contig_cost SET samples = samples + ?, reads = reads + ?, time = time + ? WHERE contig = ?", 
+                             (called / size, reads * f, elapsed * f, ctg))
+        except:
+            self.end(False)
+            raise
+        self.end()
+
+    def get_input_files(self, directory, fileid):
+        """List of candidate input files for dataset fileid found by a previous scan of directory,
+        or None if not known"""
+        ret = self.execute("SELECT files FROM input_files WHERE directory = ? AND fileid = ?", (directory, fileid)).fetchone()
+        return json.loads(ret[0]) if ret else None
+
+    def put_input_files(self, directory, found):
+        """Store the result of a scan of directory (a dictionary with the list of candidate files for each dataset id)"""
+        self.begin()
+        try:
+            self.executemany("REPLACE INTO input_files VALUES (?, ?, ?)",
+                             [(directory, fid, json.dumps(files)) for fid, files in found.items()])
+        except:
+            self.end(False)
+            raise
+        self.end()
+
+    def contig_costs(self, contig_size, reads = None):
+        """Predicted calling cost of each contig.  If a dictionary of per contig read counts is
+        given then this is used as the cost.  Otherwise the cost is the mean bs_call time per 
+        sample from previous runs.  Contigs without a history are estimated from their length 
+        using the mean time per base of the contigs that have one.  If there is no history at 
+        all the contig length is used as the cost"""
+        if reads:
+            cost = {}
+            for ctg in contig_size:
+                cost[ctg] = reads.get(ctg, 0)
+            if sum(cost.values()) > 0:
+                return cost
+        hist = {}
+        for ctg, size, samples, reads, tm in self.execute("SELECT * FROM contig_cost").fetchall():
+            if samples > 0 and ctg in contig_size:
+                hist[ctg] = tm / samples
+        hist_size = sum([contig_size[ctg] for ctg in hist])
+        hist_time = sum(hist.values())
+        if hist_size == 0 or hist_time <= 0:
+            return dict(contig_size)
+        rate = hist_time / hist_size
+        cost = {}
+        for ctg, size in contig_size.items():
+            cost[ctg] = hist.get(ctg, rate * size)
+        return cost
+    
+    def renew_leases(self):
+        """Push forward the deadline of all leases held by this process"""
+        self.begin()
+        try:
+            self.execute("UPDATE claims SET deadline = ? WHERE owner = ?", (time.time() + database._lease_time, database.owner()))
+        except:
+            self.end(False)
+            raise
+        self.end()
+
+    def expire_leases(self):
+        """Return jobs whose lease has expired, or whose owner is known to have died,
+        to the state they had before being claimed so that other workers can pick them up"""
+        now = time.time()
+        host = socket.gethostname()
+        owner = database.owner()
+        self.begin()
+        try:
+            c = self.cursor()
+            expired = []
+            for tab, fname, own, hst, pid, deadline, prev_status in c.execute("SELECT * FROM claims").fetchall():
+                if own == owner:
+                    continue
+                if deadline < now or (hst == host and not _pid_alive(pid)):
+                    expired.append((tab, fname, own, prev_status))
+            for tab, fname, own, prev_status in expired:
+                logging.info("Lease on {} held by {} has expired".format(fname, own))
+                c.execute("UPDATE {} SET status = ? WHERE filepath = ?".format(tab), (prev_status, fname))
+                c.execute("DELETE FROM claims WHERE tab = ? AND filepath = ?", (tab, fname))
+        except:
+            self.end(False)
+            raise
+        self.end()
+        
+    # Schema migrations.  Each entry is a list of statements that brings the schema from
+    # version i to version i + 1; the current version is kept in PRAGMA user_version.
+    # Databases made before the versioning was introduced are at version 0 and already
+    # have (some of) the tables, hence the IF NOT EXISTS clauses.
+    _migrations = (
+        ("CREATE TABLE IF NOT EXISTS indexing (file text, type text PRIMARY KEY, status int)",
+         "CREATE TABLE IF NOT EXISTS mapping (filepath text PRIMARY KEY, fileid text, sample text, type text, status int)",
+         "CREATE TABLE IF NOT EXISTS calling (filepath test PRIMARY KEY, poolid text, sample text, poolsize int, type text, status int)",
+         "CREATE TABLE IF NOT EXISTS extract (filepath test PRIMARY KEY, sample text, status int)",
+         "CREATE TABLE IF NOT EXISTS claims (tab text, filepath text, owner text, host text, pid int, deadline real, prev_status int, PRIMARY KEY (tab, filepath))"),
+        ("CREATE INDEX IF NOT EXISTS calling_sample_ix ON calling (sample, type, status)",
+         "CREATE INDEX IF NOT EXISTS mapping_fileid_ix ON mapping (fileid)",
+         "CREATE INDEX IF NOT EXISTS mapping_sample_ix ON mapping (sample)",
+         "CREATE INDEX IF NOT EXISTS extract_sample_ix ON extract (sample)",
+         "CREATE INDEX IF NOT EXISTS claims_owner_ix ON claims (owner)"),
+        ("CREATE TABLE IF NOT EXISTS contig_cost (contig text PRIMARY KEY, size int, samples int, reads real, time real)",),
+        ("CREATE TABLE IF NOT EXISTS input_files (directory text, fileid text, files text, PRIMARY KEY (directory, fileid))",),
+    )
+
     def create_tables(self):
-        c = self.cursor()
-        c.execute("CREATE TABLE IF NOT EXISTS indexing (file text, type text PRIMARY KEY, status int)")
-        c.execute("CREATE TABLE IF NOT EXISTS mapping (filepath text PRIMARY KEY, fileid text, sample text, type text, status int)")
-        c.execute("CREATE TABLE IF NOT EXISTS calling (filepath test PRIMARY KEY, poolid text, sample text, poolsize int, type text, status int)")
-        c.execute("CREATE TABLE IF NOT EXISTS extract (filepath test PRIMARY KEY, sample text, status int)")
-        self.commit()
+        """Create the tables (if not already existing) and bring the schema up to date"""
+        version = self.execute("PRAGMA user_version").fetchone()[0]
+        if version >= len(database._migrations):
+            return
+        self.begin()
+        try:
+            # Re-read inside the transaction in case another process has just migrated the db
+            version = self.execute("PRAGMA user_version").fetchone()[0]
+            for ix in range(version, len(database._migrations)):
+                logging.debug("Updating db schema to version {}".format(ix + 1))
+                for com in database._migrations[ix]:
+                    self.execute(com)
+                self.execute("PRAGMA user_version = {}".format(ix + 1))
+        except:
+            self.end(False)
+            raise
+        self.end()
+
+    def set_pragmas(self):
+        """Set per connection pragmas for the disk based db, and switch the journal to WAL mode 
+        so that readers (reports, dry runs) do not block the writers.  WAL requires shared memory
+        between all processes accessing the db, so is not used if the db is on a network file
+        system (unless forced with the db_journal_mode configuration option)"""
+        self.execute("PRAGMA busy_timeout = {}".format(int(database._busy_timeout * 1000)))
+        mode = self.execute("PRAGMA journal_mode").fetchone()[0].lower()
+        req_mode = database._journal_mode
+        if req_mode == 'auto':
+            req_mode = 'delete' if _network_fs(database.db_name) else 'wal'
+        if mode != req_mode:
+            try:
+                mode = self.execute("PRAGMA journal_mode = {}".format(req_mode)).fetchone()[0].lower()
+            except sqlite3.OperationalError as e:
+                # Changing the journal mode needs the db to ourselves - we will try again next time
+                logging.debug("Could not switch db to {} journal mode: {}".format(req_mode, e))
+        # In WAL mode NORMAL is safe (a power failure can lose the last transactions but not corrupt the db)
+        self.execute("PRAGMA synchronous = {}".format('NORMAL' if mode == 'wal' else 'FULL'))
 
     def copy_to_mem(self):
         # Don't bother if we are already in memory
@@ -96,21 +375,62 @@ class database(sqlite3.Connection):
             self.close()
             # re-open connection to disk db
             oldname = database.db_name
-            db = sqlite3.connect(oldname)
+            db = sqlite3.connect(oldname, timeout = database._busy_timeout)
             # sswitch to in memory db
             database.db_name = 'file:gemBS?mode=memory&cache=shared'
             database._mem_db = True
             self.__init__()
-            self.create_tables()
-            c_old = db.cursor()
-            c = self.cursor()
-            for tab in ('indexing', 'mapping', 'calling', 'extract'):
-                for ret in c_old.execute("SELECT * FROM {}".format(tab)):
-                    c.execute("INSERT INTO {} VALUES {}".format(tab, ret))
-            self.commit()
+            db.backup(self)
             db.close()
+            self.create_tables()
                     
+    def sync_table(self, table, rows, old = None):
+        """Update a table (mapping, calling or extract) so that it has the given rows (a dict with the
+        row for each filepath), only deleting or writing the rows that have changed.  Returns True if 
+        the table was changed.
+
+        old is the table as read by the caller when making rows (None if the rows do not depend on it).  
+        The table is read again and compared inside a write transaction, and rows that have changed since 
+        old was read (i.e., jobs claimed or completed by another gemBS instance) are left as they are"""
+        def diff():
+            cur = {}
+            for ret in self.execute("SELECT * FROM {}".format(table)):
+                cur[ret[0]] = ret
+            keys = list(rows) + [key for key in cur if not key in rows]
+            if old != None:
+                keys = [key for key in keys if cur.get(key) == old.get(key)]
+            delete = [(key,) for key in keys if not key in rows]
+            update = [tuple(rows[key]) for key in keys if key in rows and cur.get(key) != tuple(rows[key])]
+            return delete, update
+        
+        # Nothing to change is the usual case, and does not need the write lock
+        own = not self.in_transaction
+        if own:
+            delete, update = diff()
+            if not (delete or update):
+                return False
+            self.begin()
+        try:
+            delete, update = diff()
+            if delete:
+                self.executemany("DELETE FROM {} WHERE filepath = ?".format(table), delete)
+            if update:
+                self.executemany("REPLACE INTO {} VALUES ({})".format(table, ', '.join(['?'] * len(update[0]))), update)
+        except:
+            if own:
+                self.end(False)
+            raise
+        if own:
+            self.end()
+        return bool(delete or update)
+
     def check(self, sync = False):
+        if sync:
+            # Status is taken from the filesystem so any outstanding leases are meaningless
+            self.execute("DELETE FROM claims")
+            # and the input directories will be rescanned when needed
+            self.execute("DELETE FROM input_files")
+            self.commit()
         self.check_index()
         self.check_mapping(sync)
         self.check_contigs(sync)
@@ -226,30 +546,31 @@ class database(sqlite3.Connection):
             mapfile_suffix = 'cram'
         else:
             mapfile_suffix = 'bam'
+        # Datasets split into map_chunks chunks get one entry per chunk (streamed and command inputs can not be split)
+        map_chunks = int(config['mapping'].get('map_chunks', '1'))
+        no_split = ('STREAM', 'SINGLE_STREAM', 'PAIRED_STREAM', 'COMMAND', 'SINGLE_COMMAND', 'PAIRED_COMMAND')
             
         c = self.cursor()
-        slist = {}
-        for k, v in sdata.items():
-            bc = v.sample_barcode
-            if not bc in slist: 
-                slist[bc] = [k]
-            else:
-                slist[bc].append(k)
+        slist = js.samples
 
         old_tab = {}
-        key_used = {}
         if not sync:
             for ret in c.execute("SELECT * FROM mapping"):
                 old_tab[ret[0]] = ret
-                key_used[ret[0]] = False
     
         mapping_tab = {}
-        changed = False
         for bc, fli in slist.items():
             sample = sdata[fli[0]].sample_name
+            if map_chunks > 1:
+                datasets = []
+                for k in fli:
+                    if str(sdata[k].type).upper() in no_split:
+                        datasets.append(k)
+                    else:
+                        datasets.extend(["{}@{:03d}".format(k, x + 1) for x in range(map_chunks)])
+                fli = datasets
             bam = bam_dir.replace('@BARCODE', bc).replace('@SAMPLE', sample)
             sample_bam = os.path.join(bam, "{}.{}".format(bc, mapfile_suffix))
-            key_used[sample_bam] = True
             old = old_tab.get(sample_bam, (0,0,0,0,0))
             if database._mem_db or sync:
                 if os.path.isfile(sample_bam):
@@ -265,28 +586,16 @@ class database(sqlite3.Connection):
                         elif old[4] == 1:
                             old1 = (0,0,0,0,2)
                     mapping_tab[ind_bam] = (ind_bam, k, bc, 'MULTI_BAM', old1[4])
-                    key_used[ind_bam] = True
-                    if old1 != mapping_tab[ind_bam]:
-                        changed = True
             else:
                 mapping_tab[sample_bam] = (sample_bam, fli[0], bc, 'SINGLE_BAM', old[4])
-            if old != mapping_tab[sample_bam]:
-                changed = True
-
-        if not changed:
-            for k, s in key_used.items():
-                if not s:
-                    changed = True
-                    break
-            
-        if changed:
-            logging.debug("Updating mapping table")
-            c.execute("DELETE FROM mapping")
-            for key, tab in mapping_tab.items():
-                c.execute("INSERT INTO mapping VALUES(?, ?, ?, ?, ?)", tab)
-            self.commit()
 
-    def check_contigs(self, sync = False):
+        if self.sync_table('mapping', mapping_tab, None if sync else old_tab):
+            logging.debug("Updated mapping table")
+        self.commit()
+
+    def check_contigs(self, sync = False, reads = None, commit = True):
+        """Rebuild the contig pools and the calling table.  With commit = False the changes are 
+        left in the current transaction for the caller to commit"""
 
         # First get list of contigs
         c = self.cursor()
@@ -307,6 +616,7 @@ class database(sqlite3.Connection):
     
         sdata = js.sampleData
         pool_size = int(config['calling'].get('contig_pool_limit', '25000000'))
+        chunk_size = int(config['calling'].get('contig_chunk_size', '0'))
         omit = config['calling'].get('omit_contigs', [])
         ctg_req_list = config['calling'].get('contig_list', [])
         ctg_pools = {}
@@ -321,11 +631,38 @@ class database(sqlite3.Connection):
         for ctg in contig_size:
             ctg_flag[ctg] = [0, None]
 
+        # Pool members are contigs or regions of a contig
+        region = lambda x: (x, None, None) if x in contig_size else contigRegion(x)
+        def member_size(x):
+            ctg, start, end = region(x)
+            return contig_size[ctg] if start == None else end - start + 1
+
+        def chunks(ctg, cost, limit = None):
+            # Contigs larger than the chunk size are split into equal sized adjacent regions, each
+            # of which is called as a separate pool.  bs_call only reports sites within the
+            # requested region, so the regions can be concatenated without overlap.  When the pools
+            # are built from read counts (limit is the pool cost limit), contigs with more reads 
+            # than a pool are also split, into enough regions to bring each under the limit (the 
+            # read counts are per contig, so the reads are taken to be spread evenly along it)
+            size = contig_size[ctg]
+            n = -(-size // chunk_size) if chunk_size > 0 else 1
+            if limit != None:
+                n = max(n, math.ceil(cost / limit))
+            if n < 2:
+                return [(ctg, [ctg], cost)]
+            step = -(-size // n)
+            chunk_list = []
+            for x in range(n):
+                start = x * step + 1
+                end = min(size, (x + 1) * step)
+                chunk_list.append(("{}@{:03d}".format(ctg, x + 1), ["{}:{}-{}".format(ctg, start, end)], cost * (end - start + 1) / size))
+            return chunk_list
         
         # Make list of contig pools already described in JSON file
         rebuild = 0;
         for pool, ctglist in js.contigs.items():
             for ctg in ctglist:
+                ctg = region(ctg)[0]
                 if ctg not in contig_size:
                     rebuild |= 1
                 else:
@@ -334,15 +671,20 @@ class database(sqlite3.Connection):
             ctg_pools[pool] = [ctglist, False, {}]
             
         # And make list of contigs already completed in table
+        old_tab = {}
         if not sync:
-            for fname, pool, smp, psize, ftype, status in c.execute("SELECT * FROM calling"):
+            for ret in c.execute("SELECT * FROM calling"):
+                old_tab[ret[0]] = ret
+                fname, pool, smp, psize, ftype, status = ret
                 if ftype == 'POOL_BCF' and status != 0:
                     if pool in ctg_pools:
                         v = ctg_pools[pool]
                         v[1] = True
                         v[2][smp] = status
                         for ctg in v[0]:
-                            ctg_flag[ctg][0] |= 2
+                            ctg = region(ctg)[0]
+                            if ctg in ctg_flag:
+                                ctg_flag[ctg][0] |= 2
                     else:
                         rebuild |= 2
                 else:
@@ -362,11 +704,15 @@ class database(sqlite3.Connection):
                 ctg_flag[ctg] = [0, None]
         else:
             for pool, v in ctg_pools.items():
+                if not v[1]:
+                    # The chunks of a contig are kept together, so if calling has started on
+                    # any of them then the remaining chunks are kept as well
+                    v[1] = any([ctg_flag[region(ctg)[0]][0] & 2 for ctg in v[0]])
                 if v[1]:
-                    pool_size = 0
+                    psize = 0
                     for ctg in v[0]:
-                        pool_size += contig_size[ctg]
-                    pool_list.append((pool, v[0], pool_size))
+                        psize += member_size(ctg)
+                    pool_list.append((pool, v[0], psize))
                     pools_used[pool] = True
 
         # Handle requested list
@@ -375,46 +721,64 @@ class database(sqlite3.Connection):
         req_list1 = []
         for ctg in ctg_req_list:
             if not ctg in contig_size:
-                raise ValueError("Requested contig '{}' not found in contig sizes file '{}'".format(ctg), ret[0])
+                raise ValueError("Requested contig '{}' not found in contig sizes file '{}'".format(ctg, ret[0]))
             if (ctg_flag[ctg][0] & 2) == 2:
                 pl = ctg_flag[ctg][1]
                 if pl not in req_list1:
                     req_list1.append(pl)
         for ctg in ctg_req_list:
             if (ctg_flag[ctg][0] & 2) == 0:
-                pool_list.append((ctg, [ctg]))
-                pools_used[ctg] = True
+                for pl in chunks(ctg, contig_size[ctg]):
+                    pool_list.append(pl)
+                    pools_used[pl[0]] = True
+                    req_list1.append(pl[0])
                 ctg_flag[ctg] = [3, ctg]
-                req_list1.append(ctg)
-        for ctg, sz in contig_size.items():
-            if (ctg_flag[ctg][0] & 2) == 0:
-                if sz < pool_size:
-                    small_contigs.append(ctg)
-                    total_small += sz
-                else:
-                    pool_list.append((ctg, [ctg], sz))
+        # The pool size limit is given in bases, so is converted to cost units using the
+        # mean cost per base of the contigs to be pooled.  The pool size stored in the calling
+        # table is the cost converted back to bases (it is used to order the calling jobs)
+        free = [ctg for ctg in contig_size if (ctg_flag[ctg][0] & 2) == 0]
+        cost = self.contig_costs(contig_size, reads)
+        free_size = sum([contig_size[ctg] for ctg in free])
+        free_cost = sum([cost[ctg] for ctg in free])
+        if free_cost <= 0:
+            cost = dict(contig_size)
+            free_cost = free_size
+        scale = free_size / free_cost if free_size > 0 else 1
+        cost_limit = pool_size / scale
+        for ctg in free:
+            if cost[ctg] < cost_limit:
+                small_contigs.append(ctg)
+                total_small += cost[ctg]
+            else:
+                for pl in chunks(ctg, cost[ctg], cost_limit if reads else None):
+                    pool_list.append((pl[0], pl[1], int(pl[2] * scale)))
                 
         if small_contigs:
-            k = (total_small // pool_size) + 1
+            # The contigs are assigned to the pools in order of decreasing cost, each 
+            # going to the pool with the lowest total cost so far (LPT) 
+            k = int(total_small // cost_limit) + 1
             pools = []
+            heap = []
             ix = 1
             pname = lambda x: "@pool_{}".format(x)
             
             for x in range(k):
                 while pname(ix) in pools_used: ix += 1
                 pools.append([pname(ix), [], 0])
+                heap.append((0, x))
                 ix += 1
-            for ctg in sorted(small_contigs, key = lambda x: (-contig_size[x], ctg)):
-                pl = sorted(pools, key = lambda x: (x[2], x[0]))[0]
-                sz = contig_size[ctg]
+            for ctg in sorted(small_contigs, key = lambda x: (-cost[x], x)):
+                load, x = heapq.heappop(heap)
+                pl = pools[x]
                 pl[1].append(ctg)
-                pl[2] = pl[2] + sz
+                heapq.heappush(heap, (load + cost[ctg], x))
+                pl[2] = int((load + cost[ctg]) * scale)
             for pl in pools:
                 pool_list.append((pl[0], pl[1], pl[2]))
         bc_list = {}
-        for k, v in sdata.items():
-            bc_list[v.sample_barcode] = v.sample_name
-        c.execute("DELETE FROM calling")
+        for bc, flis in js.samples.items():
+            bc_list[bc] = sdata[flis[-1]].sample_name
+        calling_tab = {}
         js.pools = {}
         js.contigs = {}
         for bc,sample in bc_list.items():
@@ -423,7 +787,7 @@ class database(sqlite3.Connection):
             st = mrg_list.get(bc, 0)
             if database._mem_db or sync:
                 if os.path.isfile(bcf_file): st = 1            
-            c.execute("INSERT INTO calling VALUES (?, ?, ?, ?, 'MRG_BCF', ?)", (bcf_file, '' , bc, 0, st))
+            calling_tab[bcf_file] = (bcf_file, '' , bc, 0, 'MRG_BCF', st)
             for pl in pool_list:
                 bcf_file = os.path.join(bcf, "{}_{}.bcf".format(bc, pl[0]))
                 if pl[0] in ctg_pools:
@@ -434,13 +798,16 @@ class database(sqlite3.Connection):
                         elif st == 1: st1 = 2
                 else:
                     st1 = 0
-                c.execute("INSERT INTO calling VALUES (?, ?, ?, ?, 'POOL_BCF', ?)", (bcf_file, pl[0], bc, pl[2], st1))
+                calling_tab[bcf_file] = (bcf_file, pl[0], bc, pl[2], 'POOL_BCF', st1)
+        if self.sync_table('calling', calling_tab, None if sync else old_tab):
+            logging.debug("Updated calling table")
         for pl in pool_list:
             js.contigs[pl[0]] = []
             for ctg in pl[1]:
                 js.contigs[pl[0]].append(ctg)
-                js.pools[ctg]=pl[0]
-        self.commit()
+                js.pools[region(ctg)[0]]=pl[0]
+        if commit:
+            self.commit()
 
     def check_extract(self, sync = False):
         js = database.json_data
@@ -450,24 +817,18 @@ class database(sqlite3.Connection):
 
         c = self.cursor()
         slist = {}
-        for k, v in sdata.items():
-            bc = v.sample_barcode
-            if not bc in slist: 
-                slist[bc] = v.sample_name
+        for bc, flis in js.samples.items():
+            slist[bc] = sdata[flis[0]].sample_name
 
         old_tab = {}
-        key_used = {}
         if not sync:
             for ret in c.execute("SELECT * FROM extract"):
                 old_tab[ret[0]] = ret
-                key_used[ret[0]] = False
 
         extract_tab = {}
-        changed = False
         for bc, sample in slist.items():
             cpg = cpg_dir.replace('@BARCODE', bc).replace('@SAMPLE', sample)
             sample_cpg = os.path.join(cpg, bc)
-            key_used[sample_cpg] = True
             old = old_tab.get(sample_cpg, ("","",0))
             if database._mem_db or sync:
                 st = 0
@@ -478,21 +839,10 @@ class database(sqlite3.Connection):
                 if os.path.isfile(sample_cpg + '_snps.txt.gz.tbi'): st |= 256
                 old = (old[0], old[1], st)
             extract_tab[sample_cpg] = (sample_cpg, bc, old[2])
-            if old != extract_tab[sample_cpg]:
-                changed = True
-
-        if not changed:
-            for k, s in key_used.items():
-                if not s:
-                    changed = True
-                    break
-            
-        if changed:
-            logging.debug("Updating extract table")
-            c.execute("DELETE FROM extract")
-            for key, tab in extract_tab.items():
-                c.execute("INSERT INTO extract VALUES(?, ?, ?)", tab)
-            self.commit()
+
+        if self.sync_table('extract', extract_tab, None if sync else old_tab):
+            logging.debug("Updated extract table")
+        self.commit()
 
     @staticmethod
     def _prepare_index_parameter(index, nonbs = False):
@@ -522,3 +872,36 @@ class database(sqlite3.Connection):
 
         return index
 
+def _pid_alive(pid):
+    """Check whether a process on this host is still running"""
+    if pid == os.getpid():
+        # Same pid but a different owner - left over from an earlier process
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+_network_fs_types = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'lustre', 'gpfs', 'beegfs', 'ceph', 'glusterfs', 'fuse.glusterfs', 
+                     'fuse.sshfs', 'panfs', 'afs', 'ocfs2', 'gfs2', '9p')
+
+def _network_fs(path):
+    """Check (from /proc/mounts) whether path is on a network or cluster file system"""
+    path = os.path.realpath(os.path.dirname(os.path.abspath(path)))
+    fstype = None
+    mlen = -1
+    try:
+        with open('/proc/mounts', 'r') as f:
+            for line in f:
+                fd = line.split()
+                if len(fd) < 3: continue
+                mnt = fd[1]
+                if (path == mnt or path.startswith(mnt.rstrip('/') + '/')) and len(mnt) > mlen:
+                    mlen = len(mnt)
+                    fstype = fd[2]
+    except IOError:
+        return False
+    return fstype in _network_fs_types
@@ -8,17 +8,18 @@ import json
 import sys
 import time
 import datetime
+import argparse
+import copy
 from sys import exit
 import subprocess
 import threading as th
 
-from .utils import Command, CommandException, try_get_exclusive
-from .reportStats import LaneStats,SampleStats
-from .report import buildReport as htmlBuildReport
-from .sphinx import buildReport as sphinxBuildReport
-from .bsCallReports import *
+from .utils import Command, CommandException, memorySize, contigRegion, fliChunk
+from .scheduler import Scheduler, Resources
 from .__init__ import *
 
+# The report modules (and matplotlib) are only imported by the commands that use them
+
 
 class BasicPipeline(Command):
     """General mapping pipeline class."""
@@ -121,6 +122,29 @@ Input Files:
             raise CommandException("No input file provided")
                     
      
+class Binaries(Command):
+    title = "Show binaries"
+    description = """Lists the binaries used by gemBS with the path they are run from and their versions.
+
+  The binaries are looked for in the directory given by the GEM_BS_PATH environment variable, in the gemBS installation 
+  and finally in the PATH.  Binaries that are not found are marked as missing.
+    """
+
+    def register(self, parser):
+        parser.add_argument('--no-version', dest="no_version", action="store_true", help="Do not run the binaries to get their versions")
+
+    def run(self, args):
+        for name in sorted(executables.keys()):
+            binary = executables[name]
+            if binary == None or not (os.path.isfile(binary) and os.access(binary, os.X_OK)):
+                print("{:<15} missing".format(name))
+                continue
+            version = None if args.no_version else binaryVersion(binary)
+            if version != None:
+                print("{:<15} {}  ({})".format(name, binary, version))
+            else:
+                print("{:<15} {}".format(name, binary))
+
 class Index(BasicPipeline):
     title = "Index genomes"
     description = """Reference indexing for Bisulfite GEM mapping 
@@ -238,6 +262,7 @@ class Index(BasicPipeline):
                 db.check()
                 jdict = jsonData.jsconfig
                 jdict['contigs'] = jsonData.contigs
+                jdict.pop('contig_reads', None)
                 with open(Index.gemBS_json, 'w') as of:
                     json.dump(jdict, of, indent=2)
                 
@@ -252,6 +277,26 @@ class Mapping(BasicPipeline):
   to True in the  configuration file then the individual BAM files will be deleted after the merge step has been successfully completed. 
   The --no-merge options will prevent this automatic merging - this can be useful for batch processing.
 
+  With the --stream-merge option (or 'stream_merge' set to True in the configuration file) the individual BAM files of samples with 
+  multiple datasets are only used to stream the sorted alignments into the merge: they are written as fast compressed BAM 
+  (compression level 1, no index, even if CRAM output is selected) and are always deleted after the merge, so the full compression
+  and encoding of the alignments is done only once, when the merged BAM/CRAM is written.
+
+  Very large datasets can be mapped in parallel pieces by setting 'map_chunks' in the mapping section of the configuration file.
+  Each dataset (apart from streamed and command inputs) is then split into that number of chunks, which are registered as
+  separate datasets <DATASET>@001, <DATASET>@002 etc. and can be mapped independently (on different machines or in parallel
+  using --jobs).  The reads are dealt round robin between the chunks, so each chunk reads the input files but only maps its share
+  of the reads.  As every chunk decompresses and reads all of the input, the input I/O grows with the number of chunks, so
+  map_chunks is only worthwhile when the mapping rather than reading the input is the limiting step.  The chunks are merged into the sample BAM in the usual way, and the mapping report shows each chunk separately.
+  The option '-D <DATASET>' selects all chunks of a dataset, or a single chunk can be given.
+
+  By default the datasets are mapped one at a time.  With the --jobs option (or 'jobs' in the mapping section of the configuration
+  file) up to the given number of datasets are mapped in parallel, and the merge for a sample is started as soon as all its datasets
+  have been mapped.  The threads used by the running jobs (the larger of map_threads and sort_threads for each mapping) are kept within
+  the --cores limit (or the cores key in the [DEFAULT] section; by default the number of CPUs), and the memory used (the size of the
+  GEM index plus sort_memory per sort thread) within the memory key of the [DEFAULT] section.  If the number of threads is not set 
+  then each job uses an equal share of the cores.
+
   Aside from the --no-merge option, if no disk based database is being used for gemBS and separate instances of gemBS are being run on 
   non-shared file systems then the merging will not always be performed automatically.  When the merging is not performed automatically
   for whatever reason, it can be invoked manually using the merge-bams command.
@@ -280,6 +325,8 @@ class Mapping(BasicPipeline):
         parser.add_argument('--sort-threads', dest="sort_threads", help='Number of threads for the sort operations. Default: threads',default=None)
         parser.add_argument('--merge-threads', dest="merge_threads", help='Number of threads for the merge operations. Default: threads',default=None)
         parser.add_argument('--sort-memory', dest="sort_memory", help='Per thread memory used for the sort operation. Default: 768M',default=None)
+        parser.add_argument('-j', '--jobs', dest="jobs", type=int, help='Number of datasets mapped in parallel. Default: 1')
+        parser.add_argument('-c', '--cores', dest="cores", type=int, help='Number of threads available to the parallel jobs. Default: number of CPUs')
         parser.add_argument('-T', '--type', dest="ftype", help='Type of data file (PAIRED, SINGLE, INTERLEAVED, STREAM, BAM)')
         parser.add_argument('-p', '--paired-end', dest="paired_end", action="store_true", help="Input data is Paired End")
         parser.add_argument('-r', '--remove', dest="remove", action="store_true", help='Remove individual BAM files after merging.', required=False)
@@ -290,12 +337,91 @@ class Mapping(BasicPipeline):
         parser.add_argument('-v', '--overconversion-sequence', dest="overconversion_sequence", metavar="SEQUENCE", help='Name of methylated sequencing control.', default=None,required=False)
         parser.add_argument('--non-bs', dest="non_bs", action="store_true", help="Use regular (non bisulfite) index")
         parser.add_argument('--no-merge', dest="no_merge", action="store_true", help="Do not automatically merge BAMs")
+        parser.add_argument('--stream-merge', dest="stream_merge", action="store_true", help="Write individual BAMs as fast compressed spill files for the merge")
         parser.add_argument('--dry-run', dest="dry_run", action="store_true", help="Output mapping commands without execution")
         parser.add_argument('--json', dest="dry_run_json",metavar="JSON FILE",help="Output JSON file with details of pending commands")
         parser.add_argument('--ignore-db', dest="ignore_db", action="store_true",help="Ignore database for --dry-run and --json commands")
         parser.add_argument('--benchmark-mode', dest="benchmark_mode", action="store_true",help="Omit dates etc. to make file comparison simpler", required=False)
                     
     def run(self, args):     
+        self.command = 'map'
+        # JSON data
+        self.jsonData = JSONdata(Mapping.gemBS_json)
+        self.setup(args)
+        c = self.db.cursor()
+
+        if args.sample:
+            ret = c.execute("SELECT * from mapping WHERE sample = ?", (args.sample,))
+        else:
+            ret = c.execute("SELECT * from mapping")
+        work_list = {}
+        for fname, fl, smp, ftype, status in ret:
+            if self.ignore_db:
+                status = 0
+            if not smp in work_list:
+                work_list[smp] = [None, []]
+            if ftype == 'MRG_BAM':
+                if status == 0:
+                    work_list[smp][0] = fname
+            else:
+                work_list[smp][1].append((fl, fname, ftype, status))
+        if self.jobs > 1:
+            self.run_parallel(work_list, args.fli)
+        else:
+            for smp, v in work_list.items():
+                bamlist = []
+                skipped = False
+                for fl, fname, ftype, status in v[1]:
+                    if status == 0:
+                        if args.fli != None and args.fli != fl and args.fli != self.fli_chunk(fl)[0]:
+                            skipped = True
+                        else:
+                            self.do_mapping(fl)
+                    if ftype != 'SINGLE_BAM':
+                        bamlist.append(fname)
+                if not skipped and v[0] != None and not self.no_merge:                    
+                    self.do_merge(smp, bamlist, v[0])
+                    
+        if self.dry_run_json and self.json_commands:
+            with open(self.dry_run_json, 'w') as of:
+                json.dump(self.json_commands, of, indent = 2)
+
+    def run_parallel(self, work_list, fli):
+        """Map the datasets using up to self.jobs parallel workers.
+
+        The merge for a sample is started as soon as all its datasets have been mapped, while the
+        mapping of the other samples continues.  The threads and memory of the running tasks are kept
+        within the cores and memory limits.
+        """
+        cores = self.cores if self.cores != None else os.cpu_count()
+        scheduler = Scheduler(self.jobs, cores, self.memory)
+        for ix, (smp, v) in enumerate(work_list.items()):
+            bamlist = []
+            skipped = False
+            map_tasks = []
+            for fl, fname, ftype, status in v[1]:
+                if status == 0:
+                    if fli != None and fli != fl and fli != self.fli_chunk(fl)[0]:
+                        skipped = True
+                    else:
+                        threads, memory = self.footprint(fl)
+                        map_tasks.append(scheduler.add("map {}".format(fl), self.map_dataset, (fl, fname),
+                                                       threads = threads, memory = memory, priority = (1, ix)))
+                if ftype != 'SINGLE_BAM':
+                    bamlist.append(fname)
+            if not skipped and v[0] != None and not self.no_merge:
+                try:
+                    threads = max(1, int(self.merge_threads))
+                except (TypeError, ValueError):
+                    threads = 1
+                scheduler.add("merge-bams {}".format(smp), self.merge_bams, (smp, bamlist, v[0]), deps = map_tasks,
+                              threads = threads, priority = (0, ix))
+        failed = scheduler.run()
+        if failed:
+            raise CommandException("The following tasks failed: {}".format(', '.join([task.name for task in failed])))
+
+    def setup(self, args):
+        """Read the mapping options and check the index and reference files"""
         self.all_types = ['PAIRED', 'INTERLEAVED', 'SINGLE', 'BAM', 'SAM', 'STREAM', 'PAIRED_STREAM', 'SINGLE_STREAM', 'COMMAND', 'SINGLE_COMMAND', 'PAIRED_COMMAND']
         self.paired_types = ['PAIRED', 'INTERLEAVED', 'PAIRED_STREAM', 'PAIRED_COMMAND']
         self.stream_types = ['STREAM', 'SINGLE_STREAM', 'PAIRED_STREAM']
@@ -327,26 +453,30 @@ class Mapping(BasicPipeline):
             
         if self.dry_run_json:
             self.json_commands = {}
-        self.command = 'map'
-        # JSON data
-        self.jsonData = JSONdata(Mapping.gemBS_json)
 
+        self.map_chunks = self.jsonData.check(section='mapping',key='map_chunks',default=1,int_type=True)
         sdata = self.jsonData.sampleData
         if args.fli != None:
-            args.sample = sdata[args.fli].sample_barcode
+            args.sample = sdata[self.fli_chunk(args.fli)[0]].sample_barcode
 
         if not args.sample and args.sample_name:
-            for k, v in sdata.items():
-                if v.sample_name == args.sample_name:
-                    args.sample = v.sample_barcode
-                    break
-            else:
+            args.sample = self.jsonData.sample_names.get(args.sample_name)
+            if args.sample == None:
                 raise ValueError("Sample name '{}' not found".format(args.sample_name))
             
         self.name = args.sample
         
         self.tmp_dir = self.jsonData.check(section='mapping',key='tmp_dir',arg=args.tmp_dir,dir_type=True)
-        self.threads = self.jsonData.check(section='mapping',key='threads',arg=args.threads,default='1')
+        self.jobs = self.jsonData.check(section='mapping',key='jobs',arg=args.jobs,default=1,int_type=True)
+        self.cores = self.jsonData.check(section='DEFAULT',key='cores',arg=args.cores,int_type=True)
+        self.memory = memorySize(self.jsonData.check(section='DEFAULT',key='memory'))
+        if self.dry_run or self.dry_run_json:
+            self.jobs = 1
+        # With parallel jobs the threads default to an equal share of the cores
+        threads = '1'
+        if self.jobs > 1:
+            threads = str(max(1, (self.cores if self.cores != None else os.cpu_count()) // self.jobs))
+        self.threads = self.jsonData.check(section='mapping',key='threads',arg=args.threads,default=threads)
         self.map_threads = self.jsonData.check(section='mapping',key='map_threads',arg=args.map_threads,default=self.threads)
         self.sort_threads = self.jsonData.check(section='mapping',key='sort_threads',arg=args.sort_threads,default=self.threads)
         self.merge_threads = self.jsonData.check(section='mapping',key='merge_threads',arg=args.merge_threads,default=self.threads)
@@ -357,6 +487,7 @@ class Mapping(BasicPipeline):
         if self.read_non_stranded:
             self.reverse_conv = False
         self.remove = self.jsonData.check(section='mapping',key='remove_individual_bams',arg=args.remove, boolean=True)
+        self.stream_merge = self.jsonData.check(section='mapping',key='stream_merge',arg=args.stream_merge, boolean=True)
         self.underconversion_sequence = self.jsonData.check(section='mapping',key='underconversion_sequence',arg=args.underconversion_sequence)
         self.overconversion_sequence = self.jsonData.check(section='mapping',key='overconversion_sequence',arg=args.overconversion_sequence)
 
@@ -390,66 +521,96 @@ class Mapping(BasicPipeline):
         if self.tmp_dir and not os.path.isdir(self.tmp_dir):
             raise CommandException("Temporary directory %s does not exists or is not a directory." %(self.tmp_dir))
 
-        if args.sample:
-            ret = c.execute("SELECT * from mapping WHERE sample = ?", (args.sample,))
-        else:
-            ret = c.execute("SELECT * from mapping")
-        work_list = {}
-        for fname, fl, smp, ftype, status in ret:
-            if self.ignore_db:
-                status = 0
-            if not smp in work_list:
-                work_list[smp] = [None, []]
-            if ftype == 'MRG_BAM':
-                if status == 0:
-                    work_list[smp][0] = fname
-            else:
-                work_list[smp][1].append((fl, fname, ftype, status))
-        for smp, v in work_list.items():
-            bamlist = []
-            skipped = False
-            for fl, fname, ftype, status in v[1]:
-                if status == 0:
-                    if args.fli != None and args.fli != fl:
-                        skipped = True
-                    else:
-                        self.do_mapping(fl)
-                if ftype != 'SINGLE_BAM':
-                    bamlist.append(fname)
-            if not skipped and v[0] != None and not self.no_merge:                    
-                self.do_merge(smp, bamlist, v[0])
-                    
-        if self.dry_run_json and self.json_commands:
-            with open(self.dry_run_json, 'w') as of:
-                json.dump(self.json_commands, of, indent = 2)
+    def fli_chunk(self, fli):
+        """Split a mapping file id into (dataset, chunk) (see fliChunk())"""
+        return fliChunk(fli, self.jsonData.sampleData, self.map_chunks)
+
+    def footprint(self, fli):
+        """Threads and memory (bytes) used by the mapping pipeline for a dataset.
+
+        gem-mapper loads the whole index, and samtools sort uses up to sort_memory per thread
+        """
+        fliInfo = self.jsonData.sampleData[self.fli_chunk(fli)[0]]
+        ix_type = 'index' if fliInfo.bisulfite and not self.non_bs else 'nonbs_index'
+        memory = 0
+        v = self.index_status[ix_type]
+        if v != None and os.path.exists(v[0]):
+            memory += os.path.getsize(v[0])
+        threads = []
+        for x in (self.map_threads, self.sort_threads):
+            try:
+                threads.append(max(1, int(x)))
+            except (TypeError, ValueError):
+                threads.append(1)
+        memory += threads[1] * memorySize(self.sort_memory)
+        return max(threads), memory
             
+    def completed(self, db, fname):
+        ret = db.execute("SELECT status FROM mapping WHERE filepath = ?", (fname,)).fetchone()
+        return ret != None and ret[0] == 1
+    
+    def map_dataset(self, fli, outfile):
+        """Map a dataset from a worker thread.  Returns False if the mapping was not completed here"""
+        # Work on a copy of the mapper as do_mapping() keeps the details of the current dataset in the object
+        mapper = copy.copy(self)
+        mapper.db = database()
+        try:
+            mapper.do_mapping(fli)
+            return self.completed(mapper.db, outfile)
+        finally:
+            mapper.db.close()
+
+    def merge_bams(self, sample, inputs, outfile):
+        """Merge the BAMs for a sample from a worker thread.  Returns False if the merge was not completed here"""
+        mapper = copy.copy(self)
+        mapper.db = database()
+        try:
+            mapper.do_merge(sample, list(inputs), outfile)
+            return self.completed(mapper.db, outfile)
+        finally:
+            mapper.db.close()
+
+    def input_candidates(self, input_dir, fid):
+        """Files in input_dir that could hold the data for dataset id fid.
+
+        The first time a directory is needed it is scanned once for all datasets that take their input
+        from it, and the result is kept in the db.  The directory is scanned again if a stored file has
+        gone or if nothing was found for the dataset last time.
+        """
+        files = self.db.get_input_files(input_dir, fid)
+        if files and all(os.path.exists(os.path.join(input_dir, f)) for f in files):
+            return files
+        fids = set([fid])
+        for v in self.jsonData.sampleData.values():
+            if not v.file and self.input_dir.replace('@BARCODE',v.sample_barcode).replace('@SAMPLE',v.sample_name) == input_dir:
+                fids.update([x for x in (v.getFli(), v.alt_fli) if x != None])
+        found = scanInputDir(input_dir, fids)
+        self.db.put_input_files(input_dir, found)
+        return found[fid]
+
     def do_mapping(self, fli):
         # Check if FLI still has status 0 (i.e. has not been claimed by another process)
-        self.db.isolation_level = None
         c = self.db.cursor()
-
-        try_get_exclusive(c)
         if self.ignore_db:
             c.execute("SELECT * FROM mapping WHERE fileid = ?", (fli,))
         else:
             c.execute("SELECT * FROM mapping WHERE fileid = ? AND status = 0", (fli,))
         ret = c.fetchone()
-        if ret:
-            # Claim FLI by setting status to 3
+        # Claim FLI by setting status to 3
+        if ret and self.db.claim('mapping', ret[0], prev_status = ret[4]):
             outfile, fl, smp, filetype, status = ret
-            c.execute("UPDATE mapping SET status = 3 WHERE filepath = ?", (outfile,))
-            c.execute("COMMIT")
             self.name = smp
             # Register output files and db cleanup in case of failure
             odir = os.path.dirname(outfile)
             jfile = os.path.join(odir, fl + '.json')
-            ixfile = os.path.join(odir, smp + '.bai')
-            database.reg_db_com(outfile, "UPDATE mapping SET status = 0 WHERE filepath = '{}'".format(outfile), [outfile, jfile, ixfile])                
+            database.reg_db_com(outfile, "UPDATE mapping SET status = 0 WHERE filepath = '{}'".format(outfile), [outfile, jfile, bamIndexFile(outfile), outfile + '.md5'])                
 
+            # Datasets mapped in chunks have one entry per chunk
+            dataset, chunk = self.fli_chunk(fli)
             try:
-                fliInfo = self.jsonData.sampleData[fli] 
+                fliInfo = self.jsonData.sampleData[dataset] 
             except KeyError:
-                raise ValueError('Data file {} not found in config file'.format(fli))
+                raise ValueError('Data file {} not found in config file'.format(dataset))
 
             sample = fliInfo.sample_name
             bc = fliInfo.sample_barcode
@@ -514,12 +675,12 @@ class Mapping(BasicPipeline):
                         raise ValueError("Input directory {} does not exist".format(input_dir))
 
                     # Look for likely data files in input_dir
-                    for fli in (fliInfo.getFli(),fliInfo.alt_fli):
-                        if fli == None:
+                    for fid in (fliInfo.getFli(),fliInfo.alt_fli):
+                        if fid == None:
                             continue
-                        reg = re.compile("(.*){}(.*?)([12])?[.](fastq|fq|fasta|fa|bam|sam)([.][^.]+)?$".format(fli, re.I))
+                        reg = re.compile("(.*){}(.*?)([12])?[.](fastq|fq|fasta|fa|bam|sam)([.][^.]+)?$".format(fid, re.I))
                         mlist = []
-                        for file in os.listdir(input_dir):
+                        for file in self.input_candidates(input_dir, fid):
                             m = reg.match(file)
                             if m: 
                                 if m.group(5) in [None, '.gz', '.xz', 'bz2', 'z']:
@@ -576,6 +737,7 @@ class Mapping(BasicPipeline):
                 if args.ftype: com.extend(['-T',args.ftype])
                 if args.paired_end: com.append('-p')
                 if args.remove: com.append('-r')
+                if args.stream_merge: com.append('--stream-merge')
                 if args.threads: com.extend(['-t',args.threads])
                 if args.map_threads: com.extend(['--map-threads',args.map_threads])
                 if args.sort_threads: com.extend(['--sort-threads',args.sort_threads])
@@ -613,28 +775,22 @@ class Mapping(BasicPipeline):
                               outfile=outfile,paired=self.paired,tmpDir=tmp,
                               map_threads=self.map_threads,sort_threads=self.sort_threads,sort_memory=self.sort_memory,
                               under_conversion=self.underconversion_sequence,over_conversion=self.overconversion_sequence,
-                              benchmark_mode=self.benchmark_mode, contig_md5=self.contig_md5, greference=self.fasta_reference) 
+                              benchmark_mode=self.benchmark_mode, contig_md5=self.contig_md5, greference=self.fasta_reference,
+                              spill=self.stream_merge, chunk=(chunk - 1, self.map_chunks) if chunk != None else None) 
         
                 if ret:
                     logging.gemBS.gt("Bisulfite Mapping done. Output File: %s" %(ret))
                     
             if filetype == 'SINGLE_BAM':
                 self.do_merge(smp, [], outfile)
-            c = self.db.cursor()
-            c.execute("BEGIN IMMEDIATE")
-            c.execute("UPDATE mapping SET status = 1 WHERE filepath = ?", (outfile,))
+            self.db.release('mapping', outfile, 1)
             database.del_db_com(outfile)
-            
-        c.execute("COMMIT")
-        self.db.isolation_level = 'DEFERRED'
     
     def do_merge(self, sample, inputs, fname):
         if inputs:
             inputs.sort()
-            self.db.isolation_level = None
             c = self.db.cursor()
-            try_get_exclusive(c)
-            res = c.execute("SELECT * FROM mapping WHERE sample = ?", (sample,))
+            res = c.execute("SELECT * FROM mapping WHERE sample = ?", (sample,)).fetchall()
             if res:
                 mstat = 1
                 for filename, fl, smp, ftype, status in res:
@@ -643,12 +799,10 @@ class Mapping(BasicPipeline):
                         outfile = filename
                         mstat = status
                 else:
-                    if mstat == 0:
-                        c.execute("UPDATE mapping SET status = 3 WHERE filepath = ?", (outfile,))
-                        c.execute("COMMIT")
+                    if mstat == 0 and self.db.claim('mapping', outfile):
                         # Register output files and db cleanup in case of failure
                         odir = os.path.dirname(outfile)
-                        ixfile = os.path.join(odir, smp + '.csi')
+                        ixfile = bamIndexFile(outfile)
                         md5file = outfile + '.md5'
                         database.reg_db_com(outfile, "UPDATE mapping SET status = 0 WHERE filepath = '{}'".format(outfile), [outfile, ixfile, md5file])
                         if self.dry_run or self.dry_run_json:
@@ -681,16 +835,15 @@ class Mapping(BasicPipeline):
                             if ret:
                                 logging.gemBS.gt("Merging process done for {}. Output files generated: {}".format(sample, ','.join(ret)))
                                 
-                        try_get_exclusive(c)
-                        if self.remove:
+                        extra = []
+                        # With stream_merge the individual BAMs are spill files only used for the merge
+                        if self.remove or self.stream_merge:
                             for f in inputs:
                                 if not self.dry_run or self.dry_run_json:
                                     if os.path.exists(f): os.remove(f)
-                                c.execute("UPDATE mapping SET status = 2 WHERE filepath = ?", (f,))
-                        c.execute("UPDATE mapping SET status = 1 WHERE filepath = ?", (outfile,))
+                                extra.append(("UPDATE mapping SET status = 2 WHERE filepath = ?", (f,)))
+                        self.db.release('mapping', outfile, 1, extra)
                         database.del_db_com(outfile)
-            c.execute("COMMIT")
-            self.db.isolation_level = 'DEFERRED'
         else:
             # No merging required - just create index
             if self.dry_run or self.dry_run_json:
@@ -713,7 +866,7 @@ class Mapping(BasicPipeline):
                     task['sample_barcode'] = sample
                     task['inputs'] = [fname]
                     odir = os.path.dirname(fname)
-                    ixfile = os.path.join(odir, sample + '.bai')
+                    ixfile = bamIndexFile(fname)
                     md5file = fname + '.md5'
                     logfile1 = os.path.join(odir, 'bam_index_' + sample + '.err')
                     logfile2 = os.path.join(odir, 'bam_merge_' + sample + '.err')
@@ -783,6 +936,7 @@ class Merging(Mapping):
         self.threads = self.jsonData.check(section='mapping',key='threads',arg=args.threads,default='1')
         self.merge_threads = self.jsonData.check(section='mapping',key='merge_threads',arg=args.threads,default=self.threads)
         self.remove = self.jsonData.check(section='mapping',key='remove_individual_bams',arg=args.remove, boolean=True)
+        self.stream_merge = self.jsonData.check(section='mapping',key='stream_merge', boolean=True)
         self.benchmark_mode = self.jsonData.check(section='mapping',key='benchmark_mode',arg=args.benchmark_mode, boolean=True)
         self.dry_run = args.dry_run
         self.dry_run_json = args.dry_run_json
@@ -795,13 +949,9 @@ class Merging(Mapping):
         if self.dry_run_json:
             self.json_commands = {}
         
-        sdata = self.jsonData.sampleData
         if not args.sample and args.sample_name:
-            for k, v in sdata.items():
-                if v.sample_name == args.sample_name:
-                    args.sample = v.sample_barcode
-                    break
-            else:
+            args.sample = self.jsonData.sample_names.get(args.sample_name)
+            if args.sample == None:
                 raise ValueError("Sample name '{}' not found".format(args.sample_name))
                 
         # Create Dictionary of samples and bam files, checking everything required has already been made
@@ -874,7 +1024,14 @@ class MethylationCall(BasicPipeline):
   The calling process can be restricted to a single sample using the option '-n <SAMPLE NAME>' or '-b <SAMPLE BARCODE>'.  The mapping
   can also be restricted to a list of contigs or contig pool using the option '-l <contig1, contig2, ...>' or '--pool <pool>'.  The 
   --list-pools option will list the available contig pools and exit.  More information on how contig pools are determined is given in
-  the gemBS documentation.
+  the gemBS documentation.  The --coverage-pools option rebuilds the pools that have not yet been started for any sample using the numbers
+  of mapped reads per contig from the indexes of the available BAM files, so that each calling job processes a similar number of reads.
+  If contig_chunk_size is set in the calling section of the configuration file, contigs larger than this are split into regions of
+  at most this size that are called as separate pools (named <contig>@001, <contig>@002 ...) and concatenated in order on merging.
+  With the --incremental-merge option (or the incremental_merge key) completed pools are appended to a partial sample BCF as
+  soon as all the pools before them in contig order have completed, so that after the last pool only the remaining pools need
+  to be added before the sample BCF is indexed.  If call_timeout is set in the calling section of the configuration file, a
+  bs_call job that has not completed after this many seconds is killed and treated as failed.
 
   If the dbSNP_index key has been set in the configuration file (and the index has been gemerated) then this will be used by the
   caller to add public IDs in the BCF file where available.
@@ -918,6 +1075,8 @@ class MethylationCall(BasicPipeline):
         parser.add_argument('-x','--concat-only', dest="concat", action="store_true", help="Only perform merging BCF files.")
         parser.add_argument('--no-merge', dest="no_merge", action="store_true", help="Do not automatically merge BCFs")
         parser.add_argument('--pool',dest="req_pool",metavar="POOL",help="Contig pool on which to perform the methylation calling.")
+        parser.add_argument('--coverage-pools', dest="coverage_pools", action="store_true", help="Rebuild the contig pools not yet started so that they have similar numbers of reads.")
+        parser.add_argument('--incremental-merge', dest="incremental_merge", action="store_true", help="Append pool BCFs to the sample BCF as they are completed.", default=None)
         parser.add_argument('--list-pools',dest="list_pools",metavar="LEVEL",type=int,nargs='?',help="List contig pools and exit. Level 1 - list names, level > 1 - list pool composition", default=0, const=1)
         parser.add_argument('--dry-run', dest="dry_run", action="store_true", help="Output mapping commands without execution")
         parser.add_argument('--json', dest="dry_run_json",metavar="JSON FILE",help="Output JSON file with details of pending commands")
@@ -939,139 +1098,15 @@ class MethylationCall(BasicPipeline):
                 else:
                     print(pool, v)
             return
-                    
-        self.threads = self.jsonData.check(section='calling',key='threads',arg=args.threads,default='1')
-        self.call_threads = self.jsonData.check(section='calling',key='call_threads',arg=args.threads,default=self.threads)
-        self.merge_threads = self.jsonData.check(section='calling',key='merge_threads',arg=args.threads,default=self.threads)
-        self.jobs = self.jsonData.check(section='calling',key='jobs',arg=args.jobs,default=1,int_type=True)
-        self.mapq_threshold = self.jsonData.check(section='calling',key='mapq_threshold',arg=args.mapq_threshold)
-        self.qual_threshold = self.jsonData.check(section='calling',key='qual_threshold',arg=args.qual_threshold)
-        self.left_trim = self.jsonData.check(section='calling',key='left_trim',arg=args.left_trim,default='5')
-        if isinstance(self.left_trim, list):
-            self.left_trim = ','.join(self.left_trim)
-        self.right_trim = self.jsonData.check(section='calling',key='right_trim',arg=args.right_trim,default='0')
-        if isinstance(self.right_trim, list):
-            self.right_trim = ','.join(self.right_trim)
-        self.ref_bias = self.jsonData.check(section='calling',key='reference_bias',arg=args.ref_bias)
-        self.keep_unmatched = self.jsonData.check(section='calling',key='keep_improper_pairs',arg=args.keep_unmatched,boolean=True)
-        self.keep_duplicates = self.jsonData.check(section='calling',key='keep_duplicates',arg=args.keep_duplicates,boolean=True)
-        self.ignore_duplicates = self.jsonData.check(section='calling',key='ignore_duplicate_flag',arg=args.keep_duplicates,boolean=True)
-        self.benchmark_mode = self.jsonData.check(section='calling',key='benchmark_mode',arg=args.benchmark_mode, boolean=True)
-        self.haploid = self.jsonData.check(section='calling',key='haploid',arg=args.haploid,boolean=True)
-        self.species = self.jsonData.check(section='calling',key='species',arg=args.species)
-        self.contig_list = self.jsonData.check(section='calling',key='contig_list',arg=args.contig_list,list_type=True, default = [])
-        self.conversion = self.jsonData.check(section='calling',key='conversion',arg=args.conversion)
-        if isinstance(self.conversion, list):
-            self.conversion = ','.join(self.conversion)
-        self.remove = self.jsonData.check(section='calling',key='remove_individual_bcfs',arg=args.remove, boolean=True)
-
-        self.dry_run = args.dry_run
-        self.args = args
-        self.dry_run_json = args.dry_run_json
-        self.no_merge = args.no_merge
-        if self.dry_run or self.dry_run_json:
-            self.jobs = 1
-            self.ignore_db = args.ignore_db
-            self.ignore_dep = args.ignore_dep
-        else:
-            self.ignore_db = False
-            self.ignore_dep = False
-        if self.dry_run_json:
-            self.json_commands = {}
-        else:
-            self.json_commands = None
-        sdata = self.jsonData.sampleData
-        if not args.sample and args.sample_name:
-            for k, v in sdata.items():
-                if v.sample_name == args.sample_name:
-                    args.sample = v.sample_barcode
-                    break
-            else:
-                raise ValueError("Sample name '{}' not found".format(args.sample_name))
-
-        if self.contig_list != None:
-            if len(self.contig_list) == 1:
-                if os.path.isfile(self.contig_list[0]):
-                    #Check if contig_list is a file or just a list of chromosomes
-                    #Parse file to extract chromosome list 
-                    tmp_list = []
-                    with open(self.contig_list[0] , 'r') as chromFile:
-                        for line in chromFile:
-                            tmp_list.append(line.split()[0])
-                        self.contig_list = tmp_list
-                        self.jsonData.config['calling']['contig_list'] = tmp_list
-                        
-        self.db = database(self.jsonData)
-        self.mem_db = self.db.mem_db()
-        if not self.mem_db:
-            self.db.check_index()
-            
-        # If we are doing a dry-run we will use an in memory copy of the db so the on disk db is not touched
-        if self.dry_run or self.dry_run_json:
-            self.db.copy_to_mem()
 
+        self.setup(args)
         c = self.db.cursor()
 
         self.sample_conversion = {}
-        
         if self.conversion != None and self.conversion.lower() == "auto" and not args.concat:
-            sample_lane_files = {}
-            if args.sample:
-                ret = c.execute("SELECT filepath, fileid, sample FROM mapping WHERE sample = ? AND type != 'MRG_BAM'", (args.sample,))
-            else:
-                ret = c.execute("SELECT filepath, fileid, sample FROM mapping WHERE type != 'MRG_BAM'")
-                
-            for fname, fli, smp in ret:
-                bam_dir = os.path.dirname(fname)
-                fileJson = os.path.join(bam_dir,"{}.json".format(fli))
-                if os.path.isfile(fileJson):
-                    if smp not in sample_lane_files: 
-                        sample_lane_files[smp] = {}
-                        sample_lane_files[smp][fli] = [fileJson]
-                    elif fli not in sample_lane_files[smp]:
-                        sample_lane_files[smp][fli] = [fileJson]
-                    else:
-                        sample_lane_files[smp][fli].append(fileJson)
-                
-            if len(sample_lane_files) < 1:
+            self.sample_conversion = self.get_sample_conversion(c, args.sample)
+            if not self.sample_conversion:
                 self.conversion = None
-            else:
-                for sample,fli_json in sample_lane_files.items():
-                    list_stats_lanes = []
-                    for fli,json_files in fli_json.items():  
-                        for json_file in json_files:
-                            lane = LaneStats(name=fli,json_file=json_file)
-                            list_stats_lanes.append(lane)
-                    stats = SampleStats(name=sample,list_lane_stats=list_stats_lanes)
-                    uc = stats.getUnderConversionRate()
-                    oc = stats.getOverConversionRate()
-                    if uc == "NA" or uc < 0.0:
-                        uc = 0.99
-                    elif uc < 0.95:
-                        uc = 0.95
-                    elif uc > 0.999:
-                        uc = 0.999
-                    if oc == "NA" or oc < 0.0:
-                        oc = 0.05
-                    elif oc > 0.15:
-                        oc = 0.15
-                    elif oc < 0.001:
-                        oc = 0.01
-                    self.sample_conversion[sample] = "{:.4f},{:.4f}".format(1-uc,oc)
-
-        # Get fasta reference && dbSNP index if supplied
-        self.dbSNP_index_file = None
-        for fname, ftype, status in c.execute("SELECT * FROM indexing"):
-            if ftype == 'gembs_reference':
-                if status != 1:
-                    raise CommandException("gemBS reference {} not found.  Run 'gemBS index' or correct configuration file and rerun".format(fname))
-                else:
-                    self.fasta_reference = fname            
-            elif ftype == 'dbsnp_idx':
-                if status != 1:
-                    raise CommandException("dbSNP index {} not found.  Run 'gemBS index' or correct configuration file and rerun".format(fname))
-                else:
-                    self.dbSNP_index_file = fname
                 
         #Check input bam existance
         
@@ -1092,6 +1127,9 @@ class MethylationCall(BasicPipeline):
         if not sampleBam:
             raise CommandException("No available BAM files for calling")
 
+        if self.coverage_pools and not (self.dry_run or self.dry_run_json or args.concat):
+            self.rebuild_pools(list(sampleBam.values()))
+
         # Get contig pools
         contigs = self.jsonData.contigs
         
@@ -1100,11 +1138,11 @@ class MethylationCall(BasicPipeline):
             ctg_pool = {}
             for pl, v in contigs.items():
                 for ctg in v:
-                    ctg_pool[ctg] = pl
+                    ctg_pool.setdefault(contigRegion(ctg)[0], []).append(pl)
             for ctg in self.contig_list:
-                pl = ctg_pool[ctg]
-                if not pl in tmp_list:
-                    tmp_list.append(pl)
+                for pl in ctg_pool[ctg]:
+                    if not pl in tmp_list:
+                        tmp_list.append(pl)
             self.contig_list = tmp_list
         else:
             self.contig_list = list(contigs.keys())
@@ -1209,7 +1247,8 @@ class MethylationCall(BasicPipeline):
                                      dbSNP_index_file=self.dbSNP_index_file,call_threads=self.call_threads,merge_threads=self.merge_threads,jobs=self.jobs,
                                      mapq_threshold=self.mapq_threshold,bq_threshold=self.qual_threshold,dry_run_json=self.dry_run_json,
                                      haploid=self.haploid,conversion=self.conversion,ref_bias=self.ref_bias,sample_conversion=self.sample_conversion,
-                                     benchmark_mode=self.benchmark_mode)
+                                     benchmark_mode=self.benchmark_mode,call_memory=self.call_memory,call_timeout=self.call_timeout,resources=Resources(self.cores, self.memory),
+                                     incremental=self.incremental)
                 
             if ret and not (self.dry_run or self.dry_run_json):
                 if args.concat:
@@ -1221,6 +1260,174 @@ class MethylationCall(BasicPipeline):
             with open(self.dry_run_json, 'w') as of:
                 json.dump(self.json_commands, of, indent = 2)
                 
+    def setup(self, args):
+        """Read the calling options and locate the reference files"""
+        self.threads = self.jsonData.check(section='calling',key='threads',arg=args.threads,default='1')
+        self.call_threads = self.jsonData.check(section='calling',key='call_threads',arg=args.threads,default=self.threads)
+        self.merge_threads = self.jsonData.check(section='calling',key='merge_threads',arg=args.threads,default=self.threads)
+        self.jobs = self.jsonData.check(section='calling',key='jobs',arg=args.jobs,default=1,int_type=True)
+        self.mapq_threshold = self.jsonData.check(section='calling',key='mapq_threshold',arg=args.mapq_threshold)
+        self.qual_threshold = self.jsonData.check(section='calling',key='qual_threshold',arg=args.qual_threshold)
+        self.left_trim = self.jsonData.check(section='calling',key='left_trim',arg=args.left_trim,default='5')
+        if isinstance(self.left_trim, list):
+            self.left_trim = ','.join(self.left_trim)
+        self.right_trim = self.jsonData.check(section='calling',key='right_trim',arg=args.right_trim,default='0')
+        if isinstance(self.right_trim, list):
+            self.right_trim = ','.join(self.right_trim)
+        self.ref_bias = self.jsonData.check(section='calling',key='reference_bias',arg=args.ref_bias)
+        self.keep_unmatched = self.jsonData.check(section='calling',key='keep_improper_pairs',arg=args.keep_unmatched,boolean=True)
+        self.keep_duplicates = self.jsonData.check(section='calling',key='keep_duplicates',arg=args.keep_duplicates,boolean=True)
+        self.ignore_duplicates = self.jsonData.check(section='calling',key='ignore_duplicate_flag',arg=args.keep_duplicates,boolean=True)
+        self.benchmark_mode = self.jsonData.check(section='calling',key='benchmark_mode',arg=args.benchmark_mode, boolean=True)
+        self.haploid = self.jsonData.check(section='calling',key='haploid',arg=args.haploid,boolean=True)
+        self.species = self.jsonData.check(section='calling',key='species',arg=args.species)
+        self.contig_list = self.jsonData.check(section='calling',key='contig_list',arg=args.contig_list,list_type=True, default = [])
+        self.conversion = self.jsonData.check(section='calling',key='conversion',arg=args.conversion)
+        if isinstance(self.conversion, list):
+            self.conversion = ','.join(self.conversion)
+        self.remove = self.jsonData.check(section='calling',key='remove_individual_bcfs',arg=args.remove, boolean=True)
+        self.call_memory = memorySize(self.jsonData.check(section='calling',key='call_memory'))
+        self.call_timeout = self.jsonData.check(section='calling',key='call_timeout')
+        if self.call_timeout != None:
+            self.call_timeout = float(self.call_timeout)
+        self.coverage_pools = self.jsonData.check(section='calling',key='coverage_pools',arg=args.coverage_pools,boolean=True)
+        # incremental_merge is None if not set on the command line, and False if disabled by the command (merge-bcfs)
+        if args.incremental_merge == False:
+            self.incremental = False
+        else:
+            self.incremental = self.jsonData.check(section='calling',key='incremental_merge',arg=args.incremental_merge,boolean=True)
+        self.cores = self.jsonData.check(section='DEFAULT',key='cores',int_type=True)
+        self.memory = memorySize(self.jsonData.check(section='DEFAULT',key='memory'))
+
+        self.dry_run = args.dry_run
+        self.args = args
+        self.dry_run_json = args.dry_run_json
+        self.no_merge = args.no_merge
+        if self.dry_run or self.dry_run_json:
+            self.jobs = 1
+            self.ignore_db = args.ignore_db
+            self.ignore_dep = args.ignore_dep
+        else:
+            self.ignore_db = False
+            self.ignore_dep = False
+        if self.dry_run_json:
+            self.json_commands = {}
+        else:
+            self.json_commands = None
+        if not args.sample and args.sample_name:
+            args.sample = self.jsonData.sample_names.get(args.sample_name)
+            if args.sample == None:
+                raise ValueError("Sample name '{}' not found".format(args.sample_name))
+
+        if self.contig_list != None:
+            if len(self.contig_list) == 1:
+                if os.path.isfile(self.contig_list[0]):
+                    #Check if contig_list is a file or just a list of chromosomes
+                    #Parse file to extract chromosome list 
+                    tmp_list = []
+                    with open(self.contig_list[0] , 'r') as chromFile:
+                        for line in chromFile:
+                            tmp_list.append(line.split()[0])
+                        self.contig_list = tmp_list
+                        self.jsonData.config['calling']['contig_list'] = tmp_list
+                        
+        self.db = database(self.jsonData)
+        self.mem_db = self.db.mem_db()
+        if not self.mem_db:
+            self.db.check_index()
+            
+        # If we are doing a dry-run we will use an in memory copy of the db so the on disk db is not touched
+        if self.dry_run or self.dry_run_json:
+            self.db.copy_to_mem()
+
+        c = self.db.cursor()
+
+        # Get fasta reference && dbSNP index if supplied
+        self.dbSNP_index_file = None
+        for fname, ftype, status in c.execute("SELECT * FROM indexing"):
+            if ftype == 'gembs_reference':
+                if status != 1:
+                    raise CommandException("gemBS reference {} not found.  Run 'gemBS index' or correct configuration file and rerun".format(fname))
+                else:
+                    self.fasta_reference = fname            
+            elif ftype == 'dbsnp_idx':
+                if status != 1:
+                    raise CommandException("dbSNP index {} not found.  Run 'gemBS index' or correct configuration file and rerun".format(fname))
+                else:
+                    self.dbSNP_index_file = fname
+
+    def rebuild_pools(self, bam_files):
+        """Rebuild the contig pools that have not been started for any sample so that they 
+        have similar numbers of mapped reads, using the read counts from the BAM indexes.
+        The read counts used are kept in the JSON file, and the pools are left alone if they have not changed"""
+        reads = contigReadCounts(bam_files)
+        jdict = self.jsonData.jsconfig
+        if jdict.get('contig_reads') == reads:
+            logging.gemBS.gt("Mapped read counts unchanged - contig pools not rebuilt")
+            return
+        logging.gemBS.gt("Rebuilding contig pools using BAM index statistics...")
+        # The db changes are only committed once the JSON file with the new pools is in place
+        tmp_json = MethylationCall.gemBS_json + '.tmp'
+        self.db.begin()
+        try:
+            self.db.check_contigs(reads = reads, commit = False)
+            jdict['contigs'] = self.jsonData.contigs
+            jdict['contig_reads'] = reads
+            with open(tmp_json, 'w') as of:
+                json.dump(jdict, of, indent=2)
+            os.replace(tmp_json, MethylationCall.gemBS_json)
+        except:
+            self.db.end(False)
+            if os.path.exists(tmp_json): os.remove(tmp_json)
+            raise
+        self.db.end()
+        
+    def get_sample_conversion(self, c, sample=None):
+        """Estimate the under and over conversion rates for each sample from the mapping reports"""
+        sample_conversion = {}
+        sample_lane_files = {}
+        if sample:
+            ret = c.execute("SELECT filepath, fileid, sample FROM mapping WHERE sample = ? AND type != 'MRG_BAM'", (sample,))
+        else:
+            ret = c.execute("SELECT filepath, fileid, sample FROM mapping WHERE type != 'MRG_BAM'")
+                
+        for fname, fli, smp in ret:
+            bam_dir = os.path.dirname(fname)
+            fileJson = os.path.join(bam_dir,"{}.json".format(fli))
+            if os.path.isfile(fileJson):
+                if smp not in sample_lane_files: 
+                    sample_lane_files[smp] = {}
+                    sample_lane_files[smp][fli] = [fileJson]
+                elif fli not in sample_lane_files[smp]:
+                    sample_lane_files[smp][fli] = [fileJson]
+                else:
+                    sample_lane_files[smp][fli].append(fileJson)
+                
+        from .reportStats import LaneStats, SampleStats
+        for sample,fli_json in sample_lane_files.items():
+            list_stats_lanes = []
+            for fli,json_files in fli_json.items():  
+                for json_file in json_files:
+                    lane = LaneStats(name=fli,json_file=json_file)
+                    list_stats_lanes.append(lane)
+            stats = SampleStats(name=sample,list_lane_stats=list_stats_lanes)
+            uc = stats.getUnderConversionRate()
+            oc = stats.getOverConversionRate()
+            if uc == "NA" or uc < 0.0:
+                uc = 0.99
+            elif uc < 0.95:
+                uc = 0.95
+            elif uc > 0.999:
+                uc = 0.999
+            if oc == "NA" or oc < 0.0:
+                oc = 0.05
+            elif oc > 0.15:
+                oc = 0.15
+            elif oc < 0.001:
+                oc = 0.01
+            sample_conversion[sample] = "{:.4f},{:.4f}".format(1-uc,oc)
+        return sample_conversion
+
     def extra_log(self):
         """Extra Parameters to be printed"""
         #Virtual methods, to be define in child class
@@ -1293,6 +1500,8 @@ class BsCallConcatenate(MethylationCall):
         args.list_pools = 0
         args.call_threads = None
         args.no_merge = False
+        args.coverage_pools = False
+        args.incremental_merge = False
         MethylationCall.run(self, args)
       
 class MethylationFilteringThread(th.Thread):
@@ -1377,7 +1586,45 @@ class MethylationFiltering(BasicPipeline):
 
         # JSON data
         self.jsonData = JSONdata(Mapping.gemBS_json)
+        self.setup(args)
+        c = self.db.cursor()
+        
+        self.bcf_list = []
+        if args.sample:
+            ret = c.execute("SELECT filepath, sample, status from calling WHERE sample = ? AND type = 'MRG_BCF'", (args.sample,))
+        else:
+            ret = c.execute("SELECT filepath, sample, status from calling WHERE type = 'MRG_BCF'")
+        for fname, smp, status in ret:
+            if status == 1 or self.ignore_db or self.ignore_dep:
+                self.bcf_list.append((smp, fname))
 
+        if not self.bcf_list:
+            logging.gemBS.gt("No BCF files are available for methylation extraction.")
+        else:
+            if self.jobs > len(self.bcf_list):
+                self.jobs = len(self.bcf_list)
+            self.threads = self.jobs
+            self.log_parameter()
+            logging.gemBS.gt("Methylation Extraction...")
+            if self.jobs > 1:
+                threads = []
+                lock = th.Lock()
+                for ix in range(self.jobs):
+                    thread = MethylationFilteringThread(ix, self, lock)
+                    thread.start()
+                    threads.append(thread)
+                for thread in threads:
+                    thread.join()
+            else:
+                for v in self.bcf_list:
+                    self.do_filter(v)
+                
+        if self.dry_run_json and self.json_commands:
+            with open(self.dry_run_json, 'w') as of:
+                json.dump(self.json_commands, of, indent = 2)
+
+    def setup(self, args):
+        """Read the extraction options and the contig sizes"""
         self.threads = self.jsonData.check(section='extract',key='threads')
         self.extract_threads = self.jsonData.check(section='extract',key='extract_threads',arg=args.extract_threads,default=self.threads)
         self.jobs = self.jsonData.check(section='extract',key='jobs',arg=args.jobs,default=1,int_type=True)
@@ -1423,85 +1670,32 @@ class MethylationFiltering(BasicPipeline):
         if self.snps: self.mask |= 768
         self.mask1 = self.mask & 341
         
-        sdata = self.jsonData.sampleData
         if not args.sample and args.sample_name:
-            for k, v in sdata.items():
-                if v.sample_name == args.sample_name:
-                    args.sample = v.sample_barcode
-                    break
-            else:
+            args.sample = self.jsonData.sample_names.get(args.sample_name)
+            if args.sample == None:
                 raise ValueError("Sample name '{}' not found".format(args.sample_name))
                 
-        db = database(self.jsonData)
-        self.mem_db = db.mem_db()
+        self.db = database(self.jsonData)
+        self.mem_db = self.db.mem_db()
         if not self.mem_db:
-            db.check_index()        
-            db.check_extract()
+            self.db.check_index()        
+            self.db.check_extract()
 
         # If we are doing a dry-run we will use an in memory copy of the db so the on disk db is not touched
         if self.dry_run or self.dry_run_json:
-            db.copy_to_mem()
-
-        c = db.cursor()
-        c.execute("SELECT * FROM indexing WHERE type = 'contig_sizes'")
-        ret = c.fetchone()
-        if not ret or ret[2] != 1:
-            raise CommandException("Could not open contig sizes file.")
-        self.contig_size_file = ret[0]
-        contig_size = {}
-        with open (self.contig_size_file, "r") as f:
-            for line in f:
-                fd = line.split()
-                if(len(fd) > 1):
-                    contig_size[fd[0]] = int(fd[1])
+            self.db.copy_to_mem()
 
+        self.contig_size_file, contig_size = readContigSizes()
         self.contig_list = []
         for ctg in self.jsonData.pools:
             self.contig_list.append((ctg, contig_size[ctg]))
         self.contig_list.sort(key = lambda x: x[0])
-        
-        self.bcf_list = []
-        if args.sample:
-            ret = c.execute("SELECT filepath, sample, status from calling WHERE sample = ? AND type = 'MRG_BCF'", (args.sample,))
-        else:
-            ret = c.execute("SELECT filepath, sample, status from calling WHERE type = 'MRG_BCF'")
-        for fname, smp, status in ret:
-            if status == 1 or self.ignore_db or self.ignore_dep:
-                self.bcf_list.append((smp, fname))
-
-        if not self.bcf_list:
-            logging.gemBS.gt("No BCF files are available for methylation extraction.")
-        else:
-            if self.jobs > len(self.bcf_list):
-                self.jobs = len(self.bcf_list)
-            self.threads = self.jobs
-            self.log_parameter()
-            logging.gemBS.gt("Methylation Extraction...")
-            if self.jobs > 1:
-                threads = []
-                lock = th.Lock()
-                for ix in range(self.jobs):
-                    thread = MethylationFilteringThread(ix, self, lock)
-                    thread.start()
-                    threads.append(thread)
-                for thread in threads:
-                    thread.join()
-            else:
-                for v in self.bcf_list:
-                    self.do_filter(v)
-                
-        if self.dry_run_json and self.json_commands:
-            with open(self.dry_run_json, 'w') as of:
-                json.dump(self.json_commands, of, indent = 2)
 
     def do_filter(self, v):
         sample, bcf_file = v
         self.bcf_file = bcf_file
         db = database()
-        db.isolation_level = None
         c = db.cursor()
-
-        try_get_exclusive(c)
         
         c.execute("SELECT filepath, status FROM extract WHERE sample = ?", (sample,))
         ret = c.fetchone()
@@ -1511,10 +1705,8 @@ class MethylationFiltering(BasicPipeline):
             sm = status & self.mask
             if self.ignore_db:
                 sm = 0
-            if not (sm == self.mask or sm == self.mask1):
+            if not (sm == self.mask or sm == self.mask1) and db.claim('extract', filebase, status | self.mask, status):
                 status1 = status | self.mask
-                c.execute("UPDATE extract SET status = ? WHERE filepath = ?", (status1, filebase))
-                c.execute("COMMIT")
                 files = [filebase + "_contig_list.bed"]
                 cpg, non_cpg, bigWig, bedMethyl, snps = (False, False, False, False, False)
                 if self.cpg and not (sm & 3):
@@ -1593,19 +1785,327 @@ class MethylationFiltering(BasicPipeline):
 
                     status1 = (old_stat | self.mask1) & 341
                     database.del_db_com(filebase)
-                c.execute("BEGIN IMMEDIATE")
-                c.execute("UPDATE extract SET status = ? WHERE filepath = ?", (status1, filebase))
+                db.release('extract', filebase, status1)
                
-        c.execute("COMMIT")
         db.close()
         
     def extra_log(self):
         """Extra Parameters to be printed"""
         #Virtual methods, to be define in child class
         
+class RunPipeline(BasicPipeline):
+    title = "Run pipeline"
+    description = """Runs all outstanding mapping, merging, calling and extraction steps as a single workflow.
+
+  Rather than running each stage to completion before starting the next, the run command builds a dependency graph from the
+  gemBS database and starts each task as soon as the tasks it depends on have finished.  The BAM merge for a sample starts
+  when all its datasets have been mapped, the calling of the contig pools for a sample starts as soon as its BAM is ready (while 
+  the mapping of other samples continues), the BCF merge starts when all pools for the sample have been called and the 
+  extraction follows the BCF merge.  Tasks closer to the end of the pipeline are started first, so complete results for
+  a sample become available as soon as possible.
+
+  The number of tasks run in parallel is limited by the --jobs option, and the tasks are packed so that the total number of
+  threads and the total memory used by the running tasks are kept within the --cores limit (by default the number of CPUs on 
+  the machine) and the --memory limit (by default no limit).  The defaults can be set with the cores and memory keys in the
+  [DEFAULT] section of the configuration file.  The threads used by each task are taken from the options for the corresponding
+  stage (map_threads, sort_threads, merge_threads, call_threads and extract_threads in the configuration file).  The memory 
+  used by a mapping task is the size of the GEM index plus sort_memory for each sort thread, and the memory of a calling 
+  task is estimated from the size of the contig pool (or given by the call_memory key).  All other options are also taken 
+  from the configuration file.  All contig pools are called.
+
+  Tasks that are being processed by another gemBS instance are left to that instance, and the tasks that depend on them are
+  not run.  The processing can be restricted to a single sample using the option '-n <SAMPLE NAME>' or '-b <SAMPLE BARCODE>'.
+    """
+
+    def register(self, parser):
+        parser.add_argument('-n','--sample-name',dest="sample_name",metavar="SAMPLE",help="Name of sample to be processed")
+        parser.add_argument('-b','--barcode',dest="sample",metavar="BARCODE",help="Barcode of sample to be processed")
+        parser.add_argument('-j','--jobs', dest="jobs", type=int, help='Maximum number of parallel tasks. Default: cores')
+        parser.add_argument('-c','--cores', dest="cores", type=int, help='Number of threads available to the running tasks. Default: number of CPUs')
+        parser.add_argument('-m','--memory', dest="memory", help='Memory available to the running tasks (i.e., 256G). Default: no limit')
+        parser.add_argument('--no-extract', dest="no_extract", action="store_true", help="Do not run the extraction step")
+
+    def run(self, args):
+        self.command = 'run'
+
+        # JSON data
+        self.jsonData = JSONdata(RunPipeline.gemBS_json)
+        if not args.sample and args.sample_name:
+            args.sample = self.jsonData.sample_names.get(args.sample_name)
+            if args.sample == None:
+                raise ValueError("Sample name '{}' not found".format(args.sample_name))
+
+        self.cores = self.jsonData.check(section='DEFAULT',key='cores',arg=args.cores,default=os.cpu_count(),int_type=True)
+        self.jobs = self.jsonData.check(section='DEFAULT',key='jobs',arg=args.jobs,default=self.cores,int_type=True)
+        self.memory = memorySize(self.jsonData.check(section='DEFAULT',key='memory',arg=args.memory))
+        self.no_extract = args.no_extract
+        self.name = args.sample
+
+        # Set up the individual stages using the options from the configuration file
+        self.mapper = Mapping()
+        self.mapper.command = 'map'
+        self.mapper.jsonData = self.jsonData
+        self.mapper.setup(self.stage_args(self.mapper, args))
+        self.caller = MethylationCall()
+        self.caller.jsonData = self.jsonData
+        self.caller.setup(self.stage_args(self.caller, args))
+        if self.no_extract:
+            self.extractor = None
+        else:
+            self.extractor = MethylationFiltering()
+            self.extractor.jsonData = self.jsonData
+            self.extractor.setup(self.stage_args(self.extractor, args))
+
+        caller = self.caller
+        csizes, contig_size = readContigSizes()
+        self.bsCall = BsCaller(reference=caller.fasta_reference,species=caller.species,right_trim=caller.right_trim,left_trim=caller.left_trim,
+                               keep_unmatched=caller.keep_unmatched,keep_duplicates=caller.keep_duplicates,ignore_duplicates=caller.ignore_duplicates,
+                               contig_size=contig_size,csizes=csizes,dbSNP_index_file=caller.dbSNP_index_file,
+                               call_threads=caller.call_threads,merge_threads=caller.merge_threads,
+                               mapq_threshold=caller.mapq_threshold,bq_threshold=caller.qual_threshold,haploid=caller.haploid,
+                               conversion=caller.conversion,ref_bias=caller.ref_bias,sample_conversion={},benchmark_mode=caller.benchmark_mode,
+                               call_memory=caller.call_memory,call_timeout=caller.call_timeout)
+        self.lock = th.Lock()
+        self.append_locks = {}
+
+        scheduler = Scheduler(self.jobs, self.cores, self.memory)
+        self.build(scheduler, args.sample)
+        self.ntasks = len(scheduler.tasks)
+        if not self.ntasks:
+            logging.gemBS.gt("Nothing to be done")
+            return
+        self.log_parameter()
+        failed = scheduler.run()
+        if failed:
+            raise CommandException("The following tasks failed: {}".format(', '.join([task.name for task in failed])))
+        logging.gemBS.gt("Pipeline run finished")
+
+    def stage_args(self, stage, args):
+        """Default arguments for a stage (so that its options are taken from the configuration file)"""
+        parser = argparse.ArgumentParser()
+        stage.register(parser)
+        sargs = parser.parse_args([])
+        sargs.sample = args.sample
+        return sargs
+
+    # Memory allowed for the BAM / BCF merges and the extraction
+    aux_memory = 1 << 30
+    
+    def nthreads(self, threads):
+        try:
+            return max(1, int(threads))
+        except (TypeError, ValueError):
+            return 1
+        
+    def build(self, scheduler, sample):
+        """Add the outstanding tasks from the db to the scheduler"""
+        c = self.mapper.db.cursor()
+        mapping = {}
+        calling = {}
+        extract = {}
+        if sample:
+            ret = c.execute("SELECT * FROM mapping WHERE sample = ?", (sample,)).fetchall()
+        else:
+            ret = c.execute("SELECT * FROM mapping").fetchall()
+        for fname, fl, smp, ftype, status in ret:
+            if not smp in mapping:
+                mapping[smp] = []
+            mapping[smp].append((fname, fl, ftype, status))
+        for fname, pool, smp, psize, ftype, status in c.execute("SELECT * FROM calling").fetchall():
+            if smp in mapping:
+                if not smp in calling:
+                    calling[smp] = []
+                calling[smp].append((fname, pool, psize, ftype, status))
+        for filebase, smp, status in c.execute("SELECT * FROM extract").fetchall():
+            extract[smp] = (filebase, status)
+        for ix, smp in enumerate(mapping):
+            self.add_sample(scheduler, ix, smp, mapping[smp], calling.get(smp, []), extract.get(smp))
+        
+    def add_sample(self, scheduler, ix, smp, maps, calls, ext):
+        mapper = self.mapper
+
+        # Mapping and BAM merge
+        bam = None
+        bam_task = None
+        busy = False
+        mrg_status = None
+        map_tasks = []
+        bamlist = []
+        for fname, fl, ftype, status in maps:
+            if ftype == 'MRG_BAM':
+                bam = fname
+                mrg_status = status
+                continue
+            if ftype == 'SINGLE_BAM':
+                bam = fname
+            else:
+                bamlist.append(fname)
+            if status == 0:
+                threads, memory = mapper.footprint(fl)
+                task = scheduler.add("map {}".format(fl), mapper.map_dataset, (fl, fname), threads = threads, memory = memory, priority = (4, ix, 0))
+                map_tasks.append(task)
+                if ftype == 'SINGLE_BAM':
+                    bam_task = task
+            elif status == 3:
+                busy = True
+        if mrg_status == 0 and not busy:
+            bam_task = scheduler.add("merge-bams {}".format(smp), mapper.merge_bams, (smp, bamlist, bam), deps = map_tasks,
+                                     threads = self.nthreads(mapper.merge_threads), memory = self.aux_memory, priority = (3, ix, 0))
+        elif mrg_status == 3:
+            busy = True
+        if busy:
+            logging.gemBS.gt("Sample {} is being mapped by another gemBS instance".format(smp))
+            return
+        
+        # Calling and BCF merge
+        bcf = None
+        busy = False
+        pool_tasks = []
+        for fname, pool, psize, ftype, status in calls:
+            if ftype == 'MRG_BCF':
+                bcf, bcf_status = fname, status
+        # With incremental merging the pools are called in merge (contig) order
+        order = sorted([v[0] for v in calls if v[3] == 'POOL_BCF'], key = bcfOrder)
+        for fname, pool, psize, ftype, status in calls:
+            if ftype == 'MRG_BCF':
+                continue
+            elif status == 0:
+                threads, memory = self.bsCall.footprint(self.jsonData.contigs[pool])
+                task = scheduler.add("call {} {}".format(smp, pool), self.call_pool, (smp, bam, fname, pool, bcf), deps = (bam_task,),
+                                     threads = threads, memory = memory, priority = (2, ix, order.index(fname) if self.caller.incremental else -psize))
+                pool_tasks.append(task)
+            elif status == 3:
+                busy = True
+        if bcf == None:
+            return
+        bcf_task = None
+        if bcf_status == 3 or (bcf_status == 0 and busy):
+            logging.gemBS.gt("Sample {} is being called by another gemBS instance".format(smp))
+            return
+        elif bcf_status == 0:
+            bcf_task = scheduler.add("merge-bcfs {}".format(smp), self.merge_bcfs, (smp, bcf), deps = pool_tasks,
+                                     threads = self.nthreads(self.caller.merge_threads), memory = self.aux_memory, priority = (1, ix, 0))
+
+        # Extraction
+        extractor = self.extractor
+        if extractor != None and ext != None:
+            sm = ext[1] & extractor.mask
+            if not (sm == extractor.mask or sm == extractor.mask1):
+                scheduler.add("extract {}".format(smp), self.extract, (smp, bcf), deps = (bcf_task,),
+                              threads = self.nthreads(extractor.extract_threads), memory = self.aux_memory, priority = (0, ix, 0))
+
+    def call_pool(self, sample, input_bam, bcf_file, pool, mrg_file):
+        db = database()
+        try:
+            if not db.claim('calling', bcf_file):
+                return False
+            base, ext = os.path.splitext(bcf_file)
+            database.reg_db_com(bcf_file, "UPDATE calling SET status = 0 WHERE filepath = '{}'".format(bcf_file), [bcf_file, base + '.json'])
+            odir = os.path.dirname(bcf_file)
+            if not os.path.exists(odir):
+                os.makedirs(odir, exist_ok = True)
+            conversion = self.bsCall.conversion
+            if conversion != None and conversion.lower() == "auto":
+                with self.lock:
+                    if not sample in self.bsCall.sample_conversion:
+                        self.bsCall.sample_conversion.update(self.caller.get_sample_conversion(db.cursor(), sample))
+            self.bsCall.call(sample, input_bam, bcf_file, pool, self.jsonData.contigs[pool])
+            db.release('calling', bcf_file, 1)
+            database.del_db_com(bcf_file)
+        finally:
+            db.close()
+        if self.caller.incremental and mrg_file != None:
+            self.append_bcfs(sample, mrg_file)
+        return True
+
+    def append_lock(self, sample):
+        """Lock serializing the appends and the final merge for a sample"""
+        with self.lock:
+            if not sample in self.append_locks:
+                self.append_locks[sample] = th.Lock()
+            return self.append_locks[sample]
+        
+    def append_bcfs(self, sample, bcf_file):
+        """Append the completed pools at the start of the merge order to the partial merge file for the sample.
+        The pools after the first one not yet completed are left for a later append or for the final merge"""
+        lock = self.append_lock(sample)
+        # If an append is already running for this sample then the pools will be picked up by the next one
+        if not lock.acquire(blocking = False):
+            return
+        db = database()
+        try:
+            status = {}
+            for fname, st in db.execute("SELECT filepath, status FROM calling WHERE sample = ? AND type = 'POOL_BCF'", (sample,)).fetchall():
+                status[fname] = st
+            order = sorted(status, key = bcfOrder)
+            ix = 0
+            while ix < len(order) and status[order[ix]] == 1:
+                ix += 1
+            if ix == 0 or ix == len(order) or not db.claim('calling', bcf_file):
+                return
+            database.reg_db_com(bcf_file, "UPDATE calling SET status = 0 WHERE filepath = '{}'".format(bcf_file), [])
+            try:
+                bcfAppend(order[:ix], bcf_file)
+            finally:
+                db.release('calling', bcf_file, 0)
+                database.del_db_com(bcf_file)
+        finally:
+            db.close()
+            lock.release()
+
+    def merge_bcfs(self, sample, bcf_file):
+        # Wait for an append started by the last pools to finish, as it holds the claim on the merge file
+        with self.append_lock(sample):
+            return self.merge_sample_bcfs(sample, bcf_file)
+
+    def merge_sample_bcfs(self, sample, bcf_file):
+        db = database()
+        try:
+            list_bcfs = []
+            for fname, status in db.execute("SELECT filepath, status FROM calling WHERE sample = ? AND type = 'POOL_BCF'", (sample,)).fetchall():
+                if status != 1:
+                    return False
+                list_bcfs.append(fname)
+            list_bcfs.sort(key = bcfOrder)
+            if not db.claim('calling', bcf_file):
+                return False
+            database.reg_db_com(bcf_file, "UPDATE calling SET status = 0 WHERE filepath = '{}'".format(bcf_file), [bcf_file, bcf_file + '.csi', bcf_file + '.md5'])
+            bsConcat(list_bcfs, sample, self.bsCall.merge_threads, bcf_file, self.caller.benchmark_mode, self.caller.incremental)
+            extra = []
+            if self.caller.remove:
+                for f in list_bcfs:
+                    if os.path.exists(f): os.remove(f)
+                    extra.append(("UPDATE calling SET status = 2 WHERE filepath = ?", (f,)))
+            db.release('calling', bcf_file, 1, extra)
+            database.del_db_com(bcf_file)
+        finally:
+            db.close()
+        return True
+        
+    def extract(self, sample, bcf_file):
+        self.extractor.do_filter((sample, bcf_file))
+        return True
+    
+    def extra_log(self):
+        """Extra Parameters to be printed"""
+        printer = logging.gemBS.gt
+        
+        printer("------------ Pipeline Run ------------")
+        if self.name:
+            printer("Sample barcode    : %s", self.name)
+        printer("Tasks             : %s", self.ntasks)
+        printer("Parallel jobs     : %s", self.jobs)
+        printer("Cores             : %s", self.cores)
+        if self.memory != None:
+            printer("Memory            : %s", self.memory)
+        printer("Extraction        : %s", not self.no_extract)
+        printer("")
+
 class MappingReports(BasicPipeline):
     title = "Bisulfite Mapping reports"
-    description = """Bisulfite mapping report generation.  Builds a HTML and SPHINX report per dataset and sample """
+    description = """Bisulfite mapping report generation.  Builds a HTML and SPHINX report per dataset and sample.  The statistics
+  read from the JSON files of each sample are cached in the CACHE subdirectory of the output directory, and the pages and plots
+  of a sample are only rebuilt when its JSON files have changed (or the pages are missing)."""
     
     def register(self,parser):
         ## Mapping report stats parameters
@@ -1655,11 +2155,17 @@ class MappingReports(BasicPipeline):
         if len(sample_files) < 1:
             raise CommandException("Sorry no JSON files were found")
 
+        from .reportStats import buildSampleStats
+        from .report import buildReport as htmlBuildReport
+        from .sphinx import buildReport as sphinxBuildReport
         self.log_parameter()
+        # The lane JSON files are read once for both reports, and only for the samples that have changed since the last run
+        samples, changed = buildSampleStats(inputs=sample_files,cache_dir=os.path.join(self.output_dir,'CACHE'))
+        logging.gemBS.gt("Statistics read for {} of {} samples".format(len(changed), len(samples)))
         logging.gemBS.gt("Building html reports...")
-        htmlBuildReport(inputs=sample_files,output_dir=self.output_dir,name=self.project)
+        htmlBuildReport(inputs=sample_files,output_dir=self.output_dir,name=self.project,samples=samples,changed=changed)
         logging.gemBS.gt("Building sphinx reports...")
-        sphinxBuildReport(inputs=sample_files,output_dir="%s/SPHINX/" %(self.output_dir),name=self.project)
+        sphinxBuildReport(inputs=sample_files,output_dir="%s/SPHINX/" %(self.output_dir),name=self.project,samples=samples,changed=changed)
         logging.gemBS.gt("Report Done.")
          
     def extra_log(self):
@@ -1674,7 +2180,9 @@ class MappingReports(BasicPipeline):
         
 class VariantsReports(BasicPipeline):
     title = "BS Calls reports"
-    description = """BS call report generation.  Builds a HTML and SPHINX report per Sample"""
+    description = """BS call report generation.  Builds a HTML and SPHINX report per Sample.  The statistics collected for
+  each sample are cached in the CACHE subdirectory of the output directory, and a sample's pages are only rebuilt when its
+  bs_call JSON files have changed (or the pages are missing)."""
 
     def register(self,parser):
         ## variants reports stats parameters
@@ -1720,6 +2228,7 @@ class VariantsReports(BasicPipeline):
             for smp, v in sample_missing.items():
                 logging.gemBS.gt("{}: {}".format(smp, v))                        
 
+        from .bsCallReports import buildBscallReports
         self.log_parameter()
         logging.gemBS.gt("Building variant calls html and sphinx reports...")
         buildBscallReports(inputs=sample_files,output_dir=self.output_dir,name=self.project,threads=int(self.threads))
@@ -4,7 +4,8 @@
 import os
 import json
 
-from .reportStats import NucleotideStats,LaneStats,SampleStats,RunBasicStats
+from .reportStats import NucleotideStats,RunBasicStats,buildSampleStats
+from .utils import htmlPageComplete
 
 """gemBS parsers JSON files to build an HTML report"""
 class BasicHtml(RunBasicStats):
@@ -862,11 +863,12 @@ class SampleHtml(BasicHtml):
 class IndexHtml(BasicHtml):
     """ Class which defines Index Sample Report """
     
-    def __init__(self,output_dir=None,name_project=None,vector_samples=None):
+    def __init__(self,output_dir=None,name_project=None,vector_samples=None,changed=None):
         """  Class constructor
         
              output_dir -- Output directory to store HTML reports
              name_project -- Project name
+             changed -- Set of samples whose reports have to be rebuilt (if None all are rebuilt)
         """
         #Call Parent class constructor
         BasicHtml.__init__(self)        
@@ -875,6 +877,7 @@ class IndexHtml(BasicHtml):
         self.name_project = name_project
         self.project_html_document = os.path.join(self.output_dir,"{}.html".format(self.name_project))
         self.vector_samples = vector_samples
+        self.changed = changed
         
     def run(self,vectorHtml=None):
         """ Run Lane HTML Documentation Building
@@ -892,11 +895,14 @@ class IndexHtml(BasicHtml):
             sampleHtml = os.path.join(self.output_dir,"{}.html".format(sampleStats.name))
             isizeHistogram = os.path.join(self.output_dir,"{}.isize.png".format(sampleStats.name))
             png_mapq_histogram = os.path.join(self.output_dir,"{}.mapq.png".format(sampleStats.name))
-            sampleReport = SampleHtml(project_name=self.name_project,sample_stats=sampleStats,html_parent_path=self.project_html_document,\
-                                      html_sample=sampleHtml,png_insert_size_histogram=isizeHistogram,png_mapq_histogram=png_mapq_histogram)
-            vSampleHtml = []
-            sampleReport.run(vSampleHtml)
-            RunBasicStats.saveDocument(file_name=sampleHtml,vectorContent=vSampleHtml)
+            #The pages of a sample (and its lanes) are rebuilt if its statistics have changed or a page or plot is missing
+            pages = [sampleHtml] + [os.path.join(self.output_dir,"{}.html".format(lane.name)) for lane in sampleStats.list_lane_stats]
+            if self.changed == None or sampleStats.name in self.changed or not all(htmlPageComplete(page) for page in pages):
+                sampleReport = SampleHtml(project_name=self.name_project,sample_stats=sampleStats,html_parent_path=self.project_html_document,\
+                                          html_sample=sampleHtml,png_insert_size_histogram=isizeHistogram,png_mapq_histogram=png_mapq_histogram)
+                vSampleHtml = []
+                sampleReport.run(vSampleHtml)
+                RunBasicStats.saveDocument(file_name=sampleHtml,vectorContent=vSampleHtml)
             vector_sample_links.append(os.path.basename(sampleHtml))
             
             
@@ -907,12 +913,14 @@ class IndexHtml(BasicHtml):
         self.closeHtmlReport(vectorHtml=vectorHtml)
         
         
-def buildReport(inputs=None,output_dir=None,name=None):
+def buildReport(inputs=None,output_dir=None,name=None,samples=None,changed=None):
     """ Build report per lane and sample.
     
         inputs -- Dictionary of samples and lanes [sample][fli]json_file
         output_dir -- Output directory to store html documents.
         name --  Name basic to build output results.
+        samples -- List of SampleStats from buildSampleStats() (if None they are read from inputs)
+        changed -- Set of samples whose reports have to be rebuilt (if None all are rebuilt)
     """
       
     #Check output directory
@@ -920,18 +928,13 @@ def buildReport(inputs=None,output_dir=None,name=None):
         os.makedirs(output_dir)      
 
     #Process list Lane files
-    vector_samples = []
-    for sample,fli_json in inputs.items():
-        list_stats_lanes = []
-        for fli, json_file in fli_json:
-            lane = LaneStats(name=fli,json_file=json_file)
-            list_stats_lanes.append(lane)
-
-        vector_samples.append(SampleStats(name=sample,list_lane_stats=list_stats_lanes))    
+    vector_samples = samples
+    if vector_samples == None:
+        vector_samples, changed = buildSampleStats(inputs=inputs)
                 
     #IndexHtml object
     vector_index_html = []
-    indexHtml = IndexHtml(output_dir=output_dir,name_project=name,vector_samples=vector_samples)
+    indexHtml = IndexHtml(output_dir=output_dir,name_project=name,vector_samples=vector_samples,changed=changed)
     indexHtml.run(vectorHtml=vector_index_html)
     RunBasicStats.saveDocument(file_name=indexHtml.project_html_document,vectorContent=vector_index_html)
     
@@ -1,22 +1,25 @@
 # -*- coding: utf-8 -*-
 #!/usr/bin/env python
+import os
 import json
+import math
 
-import matplotlib
-matplotlib.use('Agg')
-
-import matplotlib.pyplot as plt
-import matplotlib.pylab as pylab
-
-from matplotlib import cm
-import matplotlib.colors as colors
-
-#from mpl_toolkits.mplot3d import Axes3D
+from .utils import readCacheFile, writeCacheFile
 
-import importlib
-importlib.import_module('mpl_toolkits.mplot3d').Axes3D
+# matplotlib is only imported when the first plot is drawn
+matplotlib = plt = pylab = None
 
-import math
+def loadMatplotlib():
+    global matplotlib, plt, pylab
+    if plt == None:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot
+        import matplotlib.pylab
+        # Registers the 3d projection
+        import mpl_toolkits.mplot3d
+        plt = matplotlib.pyplot
+        pylab = matplotlib.pylab
 
 class NucleotideStats:
     """ Gets percentage of nucleotide statistics """
@@ -480,6 +483,40 @@ class SampleStats(BsStats):
         #Get First Lane Paired Status
         self.is_paired = list_lane_stats[0].is_paired
 
+#Version of the report statistics caches (here and in bsCallReports).  Increment when the statistics classes change
+stats_cache_version = 1
+
+def buildSampleStats(inputs=None,cache_dir=None):
+    """ Read the lane JSON files of each sample (once) and build the SampleStats objects used by the html and sphinx reports.
+    
+        inputs -- Dictionary of samples and lanes [sample][fli]json_file
+        cache_dir -- If set, the SampleStats of each sample are kept in this directory and reused while the names, paths, 
+                     modification times and sizes of the lane JSON files of the sample are unchanged
+        
+        returns -- list of SampleStats and set of names of the samples that have been read again
+    """
+    vector_samples = []
+    changed = set()
+    for sample,fli_json in inputs.items():
+        key = [stats_cache_version]
+        for fli, json_file in fli_json:
+            st = os.stat(json_file)
+            key.append((fli,json_file,st.st_mtime_ns,st.st_size))
+        cache_file = os.path.join(cache_dir,"{}.pickle".format(sample)) if cache_dir != None else None
+        stats = readCacheFile(cache_file, key) if cache_file != None else None
+        if stats == None:
+            list_stats_lanes = []
+            for fli, json_file in fli_json:
+                list_stats_lanes.append(LaneStats(name=fli,json_file=json_file))
+            stats = SampleStats(name=sample,list_lane_stats=list_stats_lanes)
+            changed.add(sample)
+            if cache_file != None:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                writeCacheFile(cache_file, key, stats)
+        vector_samples.append(stats)
+    return vector_samples, changed
+
 class RunBasicStats:
     """ Class responsable of basic functions """
 
@@ -641,6 +678,7 @@ class RunBasicStats:
        
         mapqList = list(range(len(readsMapq)))
      
+        loadMatplotlib()
         matplotlib.pyplot.ioff()
         figure = plt.figure()
         plt.bar(mapqList,readsMapq,width=1,align='center',facecolor='blue', alpha=0.75)
@@ -668,6 +706,7 @@ class RunBasicStats:
             iSizeList.append(int(insert_size_length))
             readsList.append(int(reads))
             
+        loadMatplotlib()
         matplotlib.pyplot.ioff()            
         figure = plt.figure()
 
@@ -706,6 +745,7 @@ class RunBasicStats:
             iSizeList.append(sizeList)
             readsList.append(readList)
             
+        loadMatplotlib()
         matplotlib.pyplot.ioff()            
         figure = plt.figure()
 
@@ -732,6 +772,7 @@ class RunBasicStats:
         for laneStats in self.mapping_stats.list_lane_stats:
             mapqFragmentsLanes.append(laneStats.mapping_quality_reads)
     
+        loadMatplotlib()
         matplotlib.pyplot.ioff()
         figure = plt.figure()
         ax = figure.add_subplot(111,projection='3d')
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""Dependency driven task scheduler used by the run command"""
+import heapq
+import logging
+import threading as th
+
+class Resources:
+    """CPU and memory budget of the host, shared by the tasks running in parallel.
+
+    A limit of None means no limit.  A task that does not fit in the budget at all is 
+    allowed to start when nothing else is running.
+    """
+    def __init__(self, threads = None, memory = None):
+        self.threads = threads
+        self.memory = memory
+        self.used_threads = 0
+        self.used_memory = 0
+        self.active = 0
+        self.cond = th.Condition(th.RLock())
+
+    def fits(self, threads, memory):
+        with self.cond:
+            if not self.active:
+                return True
+            if self.threads != None and self.used_threads + threads > self.threads:
+                return False
+            if self.memory != None and self.used_memory + memory > self.memory:
+                return False
+            return True
+
+    def take(self, threads, memory):
+        with self.cond:
+            self.active += 1
+            self.used_threads += threads
+            self.used_memory += memory
+
+    def acquire(self, threads, memory):
+        """Wait until the task fits in the budget and reserve its resources"""
+        with self.cond:
+            while not self.fits(threads, memory):
+                self.cond.wait()
+            self.take(threads, memory)
+
+    def release(self, threads, memory):
+        with self.cond:
+            self.active -= 1
+            self.used_threads -= threads
+            self.used_memory -= memory
+            self.cond.notify_all()
+
+class Task:
+    """Node of the pipeline graph.
+
+    func is called with args from a worker thread.  It returns False if the work
+    could not be completed here (i.e., it was claimed by another gemBS instance), in which
+    case the tasks that depend on it are dropped, and raises an exception on failure.
+    """
+    def __init__(self, name, func, args = (), threads = 1, memory = 0, priority = (0,)):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.threads = threads
+        self.memory = memory
+        self.priority = priority
+        self.deps = set()
+        self.dependents = []
+        self.state = 'waiting'
+        self.error = None
+
+    def after(self, *tasks):
+        """Add dependencies (None entries are ignored)"""
+        for task in tasks:
+            if task != None and task.state != 'done':
+                self.deps.add(task)
+                task.dependents.append(self)
+        return self
+
+class Scheduler:
+    """Runs a graph of tasks, starting each task as soon as all its dependencies have completed.
+
+    At most jobs tasks are run at once, and the threads and memory declared by the running tasks
+    are kept within the resource budget.  Ready tasks are considered in priority order (lowest first);
+    when a task does not fit in the remaining resources, smaller ready tasks that do fit are started
+    in its place so that the host is kept busy.
+    """
+    def __init__(self, jobs = 1, threads = None, memory = None):
+        self.jobs = max(1, jobs)
+        self.resources = Resources(threads, memory)
+        self.tasks = []
+        self.ready = []
+        self.finished = []
+        self.running = 0
+        self.seq = 0
+        self.cond = th.Condition()
+
+    def add(self, name, func, args = (), deps = (), threads = 1, memory = 0, priority = (0,)):
+        task = Task(name, func, args, threads, memory, priority)
+        task.after(*deps)
+        self.tasks.append(task)
+        return task
+
+    def push(self, task):
+        task.state = 'ready'
+        heapq.heappush(self.ready, (task.priority, self.seq, task))
+        self.seq += 1
+
+    def launch(self):
+        skipped = []
+        while self.ready and self.running < self.jobs:
+            entry = heapq.heappop(self.ready)
+            task = entry[2]
+            if self.resources.fits(task.threads, task.memory):
+                task.state = 'running'
+                self.running += 1
+                self.resources.take(task.threads, task.memory)
+                thread = th.Thread(target = self.execute, args = (task,), daemon = True)
+                thread.start()
+            else:
+                skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(self.ready, entry)
+
+    def execute(self, task):
+        try:
+            ret = task.func(*task.args)
+            state = 'incomplete' if ret == False else 'done'
+        except Exception as e:
+            logging.error("Task {} failed: {}".format(task.name, e))
+            task.error = e
+            state = 'failed'
+        with self.cond:
+            task.state = state
+            self.finished.append(task)
+            self.cond.notify()
+
+    def drop(self, task):
+        for dep in task.dependents:
+            if dep.state == 'waiting':
+                dep.state = 'dropped'
+                logging.gemBS.gt("Skipping {} ({} not completed)".format(dep.name, task.name))
+                self.drop(dep)
+
+    def collect(self):
+        while self.finished:
+            task = self.finished.pop()
+            self.running -= 1
+            self.resources.release(task.threads, task.memory)
+            if task.state == 'done':
+                for dep in task.dependents:
+                    dep.deps.discard(task)
+                    if not dep.deps and dep.state == 'waiting':
+                        self.push(dep)
+            else:
+                self.drop(task)
+
+    def run(self):
+        """Execute the graph, returning the list of failed tasks"""
+        with self.cond:
+            for task in self.tasks:
+                if not task.deps:
+                    self.push(task)
+            while True:
+                self.launch()
+                if not self.running:
+                    break
+                self.cond.wait()
+                self.collect()
+        return [task for task in self.tasks if task.state == 'failed']
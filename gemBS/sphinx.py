@@ -2,7 +2,7 @@
 #!/usr/bin/env python
 
 import os
-from .reportStats import NucleotideStats,LaneStats,SampleStats,RunBasicStats
+from .reportStats import NucleotideStats,RunBasicStats,buildSampleStats
 
 class BasicSphinx(RunBasicStats):
     """ Class responsable of basic Sphinx functions """
@@ -829,12 +829,13 @@ class SampleSphinx(BasicSphinx):
 class SumupSphinx(BasicSphinx):
     """ Class which defines Index Sample Report """
     
-    def __init__(self,output_dir=None,name_project=None,vector_samples=None):
+    def __init__(self,output_dir=None,name_project=None,vector_samples=None,changed=None):
         """  Class constructor
         
              output_dir -- Output directory to store HTML reports
              name_project -- Project name
              vector_sample -- Vector of samples
+             changed -- Set of samples whose reports have to be rebuilt (if None all are rebuilt)
         """
         #Call Parent class constructor
         BasicSphinx.__init__(self)
@@ -843,6 +844,7 @@ class SumupSphinx(BasicSphinx):
         self.name_project = name_project
         self.project_sphinx_document = os.path.join(self.output_dir,self.name_project)
         self.vector_samples = vector_samples
+        self.changed = changed
                 
     def run(self,vectorSphinx=None):
         """ Run Sumup Sphinx Documentation Building
@@ -859,6 +861,8 @@ class SumupSphinx(BasicSphinx):
         for sampleStats in self.vector_samples:
             sampleSphinx = os.path.join(self.output_dir,sampleStats.name)
             vectorDocuments.append("%s" %(sampleStats.name))
+            if self.changed != None and sampleStats.name not in self.changed and os.path.exists(sampleSphinx):
+                continue
             cdir = os.path.dirname(self.output_dir)
             isizeHistogram = os.path.join(cdir, "{}_isize.png".format(sampleStats.name))
             png_mapq_histogram = os.path.join(cdir, "{}_mapq.png".format(sampleStats.name))
@@ -1027,12 +1031,14 @@ class ConfigSphinx:
                 fileDocument.write("%s\n" %(line))
 
            
-def buildReport(inputs=None,output_dir=None,name=None):
+def buildReport(inputs=None,output_dir=None,name=None,samples=None,changed=None):
     """ Build report per lane and sample.
     
         inputs -- Dictionary of samples and lanes [sample][fli]json_file
         output_dir -- Output directory to store html documents.
         name --  Name basic to build output results.
+        samples -- List of SampleStats from buildSampleStats() (if None they are read from inputs)
+        changed -- Set of samples whose reports have to be rebuilt (if None all are rebuilt)
     """
       
     #Check output directory
@@ -1040,18 +1046,13 @@ def buildReport(inputs=None,output_dir=None,name=None):
         os.makedirs(output_dir)      
       
     #Process list Lane files
-    vector_samples = []
-    for sample,fli_json in inputs.items():
-        list_stats_lanes = []
-        for fli, json_file in fli_json:
-            lane = LaneStats(name=fli,json_file=json_file)
-            list_stats_lanes.append(lane)
-
-        vector_samples.append(SampleStats(name=sample,list_lane_stats=list_stats_lanes))    
+    vector_samples = samples
+    if vector_samples == None:
+        vector_samples, changed = buildSampleStats(inputs=inputs)
 
     #SumupSphinx object
     vector_sumup_sphinx = []
-    sumupSphinx = SumupSphinx(output_dir=output_dir,name_project=name,vector_samples=vector_samples)
+    sumupSphinx = SumupSphinx(output_dir=output_dir,name_project=name,vector_samples=vector_samples,changed=changed)
     sumupSphinx.run(vectorSphinx=vector_sumup_sphinx)
     RunBasicStats.saveDocument(file_name=sumupSphinx.project_sphinx_document,vectorContent=vector_sumup_sphinx)
     
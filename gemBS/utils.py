@@ -8,13 +8,15 @@ the command environment.
 """
 
 import os
-
+import re
 import subprocess
 import logging
 import json
 import signal
 import tempfile
-import time
+import pickle
+import hashlib
+import threading as th
 from io import IOBase
 
 class CommandException(Exception):
@@ -166,6 +168,52 @@ class Process:
         return str(self.commands)
 
 
+class DigestWriter(th.Thread):
+    """Tee stage at the end of a pipeline.  The output of the last process is copied to
+    the output file, and the md5 digest of the data is calculated on the way so that 
+    the output does not have to be read again"""
+
+    def __init__(self, stream, output, digest_file):
+        """stream      -- stdout of the last process
+        output      -- path of the output file
+        digest_file -- path of the file for the digest (in md5sum format)
+        """
+        th.Thread.__init__(self, daemon=True)
+        self.stream = stream
+        self.output = output
+        self.digest_file = digest_file
+        self.digest = None
+        self.error = None
+
+    def run(self):
+        md5 = hashlib.md5()
+        try:
+            with open(self.output, 'wb') as f:
+                while True:
+                    data = self.stream.read(1 << 20)
+                    if not data:
+                        break
+                    md5.update(data)
+                    f.write(data)
+            self.digest = md5.hexdigest()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.stream.close()
+
+    def finish(self, ok=True):
+        """Wait for the copy to complete and, if ok is True, write the digest file.
+        Returns 0 on success and 1 on error"""
+        self.join()
+        if self.error is not None:
+            logging.error("Error writing %s: %s", self.output, self.error)
+            return 1
+        if ok:
+            with open(self.digest_file, 'w') as f:
+                f.write("{}  {}\n".format(self.digest, self.output))
+        return 0
+
+
 class ProcessWrapper:
     """Class returned by run_tools that wraps around a list of processes and
     is able to wait. The wrapper is aware of the process log files and
@@ -190,6 +238,7 @@ class ProcessWrapper:
         self.force_debug = force_debug
         self.raw = raw
         self.exit_value = None
+        self.digest_writer = None
 
     def submit(self, command, input=subprocess.PIPE, output=None, env=None, logfile=None):
         """Run a command. The command must be list of command and its parameters.
@@ -240,6 +289,12 @@ class ProcessWrapper:
         self.stdin = self.processes[0].process.stdin
         self.stdout = self.processes[-1].process.stdout
 
+    def add_digest(self, output, digest_file):
+        """Copy the output of the pipeline to the file output, writing the md5 digest of the output to digest_file"""
+        self.digest_writer = DigestWriter(self.stdout, output, digest_file)
+        self.stdout = None
+        self.digest_writer.start()
+
     def wait(self):
         """Wait for all processes in the process list to
         finish. If a process is exiting with non 0, the process
@@ -255,10 +310,17 @@ class ProcessWrapper:
                     if r is not None:
                         r.wait()
             exit_value = 0
-            for process in reversed(self.processes):
-                ev = process.wait()
-                if ev != 0:
-                    exit_value = ev
+            ok = False
+            try:
+                for process in reversed(self.processes):
+                    ev = process.wait()
+                    if ev != 0:
+                        exit_value = ev
+                ok = exit_value == 0
+            finally:
+                if self.digest_writer is not None:
+                    if self.digest_writer.finish(ok) != 0 and ok:
+                        exit_value = 1
             self.exit_value = exit_value
             if exit_value != 0:
                 return exit_value
@@ -294,7 +356,7 @@ def _prepare_output(output):
     return None
     
 def run_tools(tools, input=None, output=None, name=None, keep_logfiles=True,
-              force_debug=False, env=None, logfile=None):
+              force_debug=False, env=None, logfile=None, digest=None):
     """
     Run the tools defined in the tools list using a new process per tool.
    
@@ -307,6 +369,8 @@ def run_tools(tools, input=None, output=None, name=None, keep_logfiles=True,
     output       -- optional output file name or open, writable file handle
     name         -- optional name for this process group
     logfile      -- specify a filename or a string that is used as stderr
+    digest       -- optional filename for the md5 digest of the output, which is
+                    calculated as the output is written (output must be a filename)
     """
     
     parent_process = None
@@ -323,14 +387,171 @@ def run_tools(tools, input=None, output=None, name=None, keep_logfiles=True,
         if i == len(tools) - 1:
             # prepare last process output
             process_out = _prepare_output(output)
+            if digest is not None:
+                if process_out is None:
+                    raise ProcessError("A digest requires an output file")
+                digest_out = process_out
+                process_out = subprocess.PIPE
 
         p.submit(commands, input=process_in, output=process_out, env=env, logfile=logfile)
 
     # start the run
     p.start()
+    if digest is not None:
+        p.add_digest(digest_out, digest)
     return p
 
 
+async def _terminate(procs, kill_delay):
+    """Send SIGTERM to the processes still running, and SIGKILL to any left after kill_delay seconds"""
+    import asyncio
+    live = [p for p in procs if p.returncode is None]
+    for p in live:
+        try:
+            p.terminate()
+        except ProcessLookupError:
+            pass
+    if live:
+        done, pending = await asyncio.wait([asyncio.ensure_future(p.wait()) for p in live], timeout=kill_delay)
+        if pending:
+            for p in live:
+                if p.returncode is None:
+                    try:
+                        p.kill()
+                    except ProcessLookupError:
+                        pass
+            await asyncio.wait(pending)
+
+async def run_tools_async(tools, input=None, output=None, name=None, keep_logfiles=True,
+                          force_debug=False, env=None, logfile=None, timeout=None, kill_delay=5):
+    """
+    Coroutine version of run_tools(), returning 0 when all the processes of the pipeline have
+    completed successfully.
+
+    The processes are supervised from the event loop rather than waited on in turn: as soon as
+    any of them fails, or if the pipeline has not finished after timeout seconds, the other 
+    processes are killed and ProcessError is raised.  The stderr of all processes goes to logfile
+    (or to a temporary log file unless debugging), and is printed to the log on failure.
+
+    tools, input, output, name, keep_logfiles, force_debug, env and logfile are as for run_tools()
+    timeout      -- optional limit on the run time of the pipeline (seconds)
+    kill_delay   -- seconds to wait after SIGTERM before killing processes with SIGKILL
+    """
+    # asyncio is only imported when needed as it is slow to load
+    import asyncio
+    label = name if name is not None else os.path.basename(str(tools[0][0]).split()[0])
+    pipe = " | ".join([" ".join(c) for c in tools])
+    files = []
+    fds = []
+    procs = []
+    log_name = None
+    try:
+        stdin = _prepare_input(input)
+        if stdin is not None:
+            files.append(stdin)
+        out = _prepare_output(output)
+        stdout = None
+        if out is not None:
+            stdout = open(out, 'wb')
+            files.append(stdout)
+        stderr = None
+        if logfile is None and logging.getLogger().level is not logging.DEBUG and not force_debug:
+            stderr = tempfile.NamedTemporaryFile(suffix='.err', prefix=label + ".", delete=False)
+            log_name = stderr.name
+            files.append(stderr)
+        elif isinstance(logfile, str):
+            log_name = logfile
+            stderr = open(logfile, 'wb')
+            files.append(stderr)
+        else:
+            stderr = logfile
+        logging.info("Starting:\n\t%s" % (pipe))
+        for i, commands in enumerate(tools):
+            if i < len(tools) - 1:
+                rd, wr = os.pipe()
+                fds.extend([rd, wr])
+                p_out = wr
+            else:
+                p_out = stdout
+            procs.append(await asyncio.create_subprocess_exec(*commands, stdin=stdin, stdout=p_out, stderr=stderr, env=env))
+            # The pipe ends now belong to the child processes
+            if i > 0:
+                os.close(stdin)
+                fds.remove(stdin)
+            if i < len(tools) - 1:
+                os.close(wr)
+                fds.remove(wr)
+                stdin = rd
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        waits = {asyncio.ensure_future(p.wait()): tools[i][0] for i, p in enumerate(procs)}
+        pending = set(waits)
+        while pending:
+            left = None if deadline is None else max(0, deadline - loop.time())
+            done, pending = await asyncio.wait(pending, timeout=left, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                raise ProcessError("Pipeline '%s' timed out after %s seconds" % (label, timeout))
+            for task in done:
+                exit_value = task.result()
+                logging.debug("Process '%s' finished with %d", waits[task], exit_value)
+                if exit_value != 0:
+                    raise ProcessError("Process '%s' finished with %d" % (waits[task], exit_value))
+        return 0
+    except BaseException as e:
+        await _terminate(procs, kill_delay)
+        logging.error("%s\n\t%s" % (e, pipe))
+        if log_name is not None and isinstance(e, ProcessError):
+            for f in files:
+                f.flush()
+            with open(log_name, errors='replace') as f:
+                for line in f:
+                    logging.error("%s" % (line.strip()))
+        raise
+    finally:
+        for fd in fds:
+            os.close(fd)
+        for f in files:
+            f.close()
+        if log_name is not None and logfile is None and not keep_logfiles and os.path.exists(log_name):
+            logging.debug("Removing log file: %s" % (log_name))
+            os.remove(log_name)
+
+class ProcessSupervisor:
+    """Event loop, run in a background thread, that supervises the pipelines started with 
+    run_supervised().  Any number of pipelines can be running at once without each needing a
+    thread to wait for it.  There is a single supervisor per gemBS process, made when first used.
+    """
+    _instance = None
+    _lock = th.Lock()
+
+    def __init__(self):
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        self.thread = th.Thread(target=self.run, name='gemBS-supervisor', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        import asyncio
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    @classmethod
+    def get(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = ProcessSupervisor()
+            return cls._instance
+
+    def submit(self, tools, **kwargs):
+        """Start a pipeline (arguments as for run_tools_async()), returning a concurrent.futures.Future for the result"""
+        import asyncio
+        return asyncio.run_coroutine_threadsafe(run_tools_async(tools, **kwargs), self.loop)
+
+def run_supervised(tools, **kwargs):
+    """Run a pipeline under the process supervisor and wait for it to complete.  Returns 0, and
+    raises ProcessError if any process fails or the pipeline times out"""
+    return ProcessSupervisor.get().submit(tools, **kwargs).result()
+
 def run_tool(tool, **kwargs):
     """
     Delegates to run_tools() with just a single tool
@@ -345,17 +566,112 @@ def uniqueList(seq):
     seen_add = seen.add
     return [ x for x in seq if not (x in seen or seen_add(x))]
 
-
-def try_get_exclusive(c):
-    # Sometimes (in particular with the in memory db) we get exceptions here due to
-    # multiple threads trying to get an exclusive lock at the same time.  If this
-    # happens we just sleep a little and try again
-    while(True):
-        try:
-            c.execute("BEGIN EXCLUSIVE")
-            break
-        except Exception as e:
-            if str(e).startswith('database'):
-                time.sleep(.1)
-            else:
+def memorySize(size):
+    """
+    Convert a memory size with an optional K, M, G or T suffix (i.e., 768M) to bytes
+    """
+    if size == None or isinstance(size, int):
+        return size
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$', str(size), re.I)
+    if not m:
+        raise CommandException("Invalid memory size '{}'".format(size))
+    return int(float(m.group(1)) * (1024 ** ' KMGT'.index(m.group(2).upper() or ' ')))
+
+def fileDigest(fname, digest_file):
+    """
+    Write the md5 digest of a file to digest_file (in md5sum format).  Used for outputs that are
+    not written through run_tools()
+    """
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as f:
+        while True:
+            data = f.read(1 << 20)
+            if not data:
                 break
+            md5.update(data)
+    with open(digest_file, 'w') as f:
+        f.write("{}  {}\n".format(md5.hexdigest(), fname))
+
+def readCacheFile(cache_file, key):
+    """
+    Data stored in cache_file by writeCacheFile(), or None if the cache file does not exist, can not be read
+    or was written with a different key.  The key should include a version number for the cached data so 
+    that caches from older versions are not used
+    """
+    try:
+        with open(cache_file, 'rb') as f:
+            cache = pickle.load(f)
+        if cache['key'] == key:
+            return cache['data']
+    except Exception:
+        pass
+    return None
+
+def writeCacheFile(cache_file, key, data, level = logging.WARNING):
+    """
+    Pickle data to cache_file, to be read back by readCacheFile() with the same key.  The data is written to a 
+    temporary file in the same directory that is then renamed, so a partly written cache file is never seen.  
+    A failure is only logged (at the given level, and the temporary file removed), as the cache can always 
+    be rebuilt
+    """
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(cache_file)), prefix = '.gemBS_cache')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'key': key, 'data': data}, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_file)
+    except Exception as e:
+        logging.log(level, "Could not write cache file {}: {}".format(cache_file, e))
+        if tmp != None and os.path.exists(tmp):
+            os.remove(tmp)
+
+def htmlPageComplete(html_file):
+    """ True if html_file exists and so do all of the images (<img src="...">) that it shows """
+    if not os.path.exists(html_file):
+        return False
+    with open(html_file, 'r') as f:
+        images = re.findall(r'<img src="([^"]+)"', f.read())
+    for image in images:
+        if not os.path.exists(os.path.join(os.path.dirname(html_file), image)):
+            return False
+    return True
+
+def contigRegion(member):
+    """
+    Split a contig pool member into (contig, start, end).  Members are either a contig name or
+    a region of a contig written as contig:start-end (1 based, inclusive); for a whole contig
+    start and end are None
+    """
+    m = re.match(r'^(.+):(\d+)-(\d+)$', member)
+    if m:
+        return m.group(1), int(m.group(2)), int(m.group(3))
+    return member, None, None
+
+def packageResource(name):
+    """Path to a file or directory installed with the gemBS package, or None if it does not exist"""
+    f = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+    if os.path.exists(f):
+        return f
+    return None
+
+def strtobool(val):
+    """Convert a string representation of truth to True or False (as the distutils function)"""
+    val = val.lower()
+    if val in ('y', 'yes', 't', 'true', 'on', '1'):
+        return True
+    elif val in ('n', 'no', 'f', 'false', 'off', '0'):
+        return False
+    raise ValueError("invalid truth value {}".format(val))
+
+def fliChunk(fileid, datasets, map_chunks):
+    """
+    Split a mapping file id into (dataset, chunk).  If map_chunks > 1, datasets that are mapped in chunks 
+    have one mapping entry per chunk with the file id dataset@NNN (chunks numbered from 1); for other 
+    datasets chunk is None.  Only ids made from a dataset in datasets (the datasets of the configuration) 
+    are taken as chunks, so a dataset with an id ending in @NNN is not mistaken for a chunk
+    """
+    if map_chunks > 1 and not fileid in datasets:
+        m = re.match(r'^(.+)@(\d+)$', fileid)
+        if m and m.group(1) in datasets:
+            return m.group(1), int(m.group(2))
+    return fileid, None